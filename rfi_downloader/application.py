@@ -11,16 +11,272 @@ import platform
 import webbrowser
 import logging
 import importlib.metadata
+import os
+import sys
 from pathlib import Path
+from typing import Any, Dict, List
 
 from .version import __version__
-from .utils import add_action_entries
+from .utils import add_action_entries, TransferThread
 from .utils.googleanalytics import GoogleAnalyticsContext
+from .utils.dedup import LINK_MODES
+from .utils.metrics import MetricsHTTPServer, MetricsTextfileWriter
+from .utils.postprocessing import resolve_task
+from .utils.ratelimit import parse_rate, rate_limiter
+from .utils.readyqueue import ORDERING_POLICIES
+from .utils.s3 import MINIMUM_PART_SIZE, make_client, parse_s3_url
+from .utils.schedule import Schedule
+from .utils.slots import SlotScheduler
 
 from .applicationwindow import ApplicationWindow
+from .dbusinterface import DBusInterface
 
 logger = logging.getLogger(__name__)
 
+# long name, argument type, description, argument description
+OPTION_ENTRIES = (
+    (
+        "max-active",
+        GLib.OptionArg.INT,
+        "Maximum number of files that are downloaded simultaneously, across all windows (default: 1)",
+        "N",
+    ),
+    (
+        "max-per-host",
+        GLib.OptionArg.INT,
+        "Maximum number of files that are downloaded simultaneously from a single host, across all windows (default: 0, no limit)",
+        "N",
+    ),
+    (
+        "transfer-threads",
+        GLib.OptionArg.INT,
+        "Number of threads that run the downloads, separately from the GUI (default: 1)",
+        "N",
+    ),
+    (
+        "memory-budget",
+        GLib.OptionArg.INT,
+        "Maximum number of MiB held in download buffers at any time, across all downloads (default: 0, no limit)",
+        "MIB",
+    ),
+    (
+        "small-file-threshold",
+        GLib.OptionArg.INT,
+        "Download files whose size in the URLs file is at most this number of bytes in one go, without progress updates (default: 0, disabled)",
+        "BYTES",
+    ),
+    (
+        "extract",
+        GLib.OptionArg.NONE,
+        "Unpack archives and compressed files while they are downloaded, instead of saving them",
+        None,
+    ),
+    (
+        "post-process",
+        GLib.OptionArg.STRING_ARRAY,
+        "Run this task on every downloaded file: checksum, mrc-header, thumbnail, a plugin or module:function (may be repeated)",
+        "TASK",
+    ),
+    (
+        "processing-workers",
+        GLib.OptionArg.INT,
+        "Number of processes that run the --post-process tasks (default: number of CPUs)",
+        "N",
+    ),
+    (
+        "max-pending-processing",
+        GLib.OptionArg.INT,
+        "Hold off new downloads while this number of files is waiting to be processed (default: 4 per processing worker)",
+        "N",
+    ),
+    (
+        "dedup",
+        GLib.OptionArg.NONE,
+        "Do not download files whose content is already on disk, link or copy them instead",
+        None,
+    ),
+    (
+        "dedup-index",
+        GLib.OptionArg.FILENAME,
+        "Keep the index of downloaded content in this SQLite database, implies --dedup (default: in the user data directory)",
+        "FILE",
+    ),
+    (
+        "dedup-link",
+        GLib.OptionArg.STRING,
+        "How duplicates are created: "
+        + ", ".join(LINK_MODES)
+        + " (default: auto)",
+        "MODE",
+    ),
+    (
+        "cache-dir",
+        GLib.OptionArg.FILENAME,
+        "Consult this cache directory, which may be shared with other users, before downloading, and add downloads to it",
+        "DIR",
+    ),
+    (
+        "cache-size",
+        GLib.OptionArg.INT,
+        "Evict the least recently used files once the --cache-dir grows beyond this number of GiB (default: 10)",
+        "GIB",
+    ),
+    (
+        "cache-link",
+        GLib.OptionArg.STRING,
+        "How files are taken from the --cache-dir: "
+        + ", ".join(LINK_MODES)
+        + " (default: reflink, falling back to a copy)",
+        "MODE",
+    ),
+    (
+        "storage",
+        GLib.OptionArg.STRING,
+        "Stream the downloads to S3-compatible object storage at s3://BUCKET/PREFIX, instead of writing them to the destination",
+        "URL",
+    ),
+    (
+        "s3-endpoint",
+        GLib.OptionArg.STRING,
+        "URL of the S3-compatible server, e.g. MinIO or Ceph (default: AWS)",
+        "URL",
+    ),
+    (
+        "s3-part-size",
+        GLib.OptionArg.INT,
+        "Size of the parts that are uploaded to the --storage, in MiB (default: 8, at least 5)",
+        "MIB",
+    ),
+    (
+        "s3-concurrency",
+        GLib.OptionArg.INT,
+        "Number of parts that are uploaded to the --storage simultaneously (default: 4)",
+        "N",
+    ),
+    (
+        "include",
+        GLib.OptionArg.STRING_ARRAY,
+        "When crawling directory URLs, only download files matching this glob (may be repeated)",
+        "GLOB",
+    ),
+    (
+        "exclude",
+        GLib.OptionArg.STRING_ARRAY,
+        "When crawling directory URLs, skip files and directories matching this glob (may be repeated)",
+        "GLOB",
+    ),
+    (
+        "crawl-requests",
+        GLib.OptionArg.INT,
+        "Maximum number of index pages that are fetched simultaneously (default: 8)",
+        "N",
+    ),
+    (
+        "crawl-requests-per-host",
+        GLib.OptionArg.INT,
+        "Maximum number of index pages that are fetched simultaneously from a single host (default: 2)",
+        "N",
+    ),
+    (
+        "adaptive-concurrency",
+        GLib.OptionArg.NONE,
+        "Tune the number of simultaneous downloads to the measured throughput, up to --max-active",
+        None,
+    ),
+    (
+        "ordering",
+        GLib.OptionArg.STRING,
+        "Order in which downloads are started: "
+        + ", ".join(ORDERING_POLICIES)
+        + " (default: manifest)",
+        "POLICY",
+    ),
+    (
+        "max-rate",
+        GLib.OptionArg.STRING,
+        "Maximum number of bytes/sec that are received, shared fairly between all windows, e.g. 10MB/s (default: unlimited)",
+        "RATE",
+    ),
+    (
+        "schedule",
+        GLib.OptionArg.FILENAME,
+        "Follow the windows of the week in this file, each with its own rate limit and --max-active",
+        "FILE",
+    ),
+    (
+        "schedule-pause",
+        GLib.OptionArg.NONE,
+        "Suspend the downloads outside of the windows of the --schedule, and resume them in the next window",
+        None,
+    ),
+    (
+        "stall-timeout",
+        GLib.OptionArg.INT,
+        "Restart a download that received no data for this number of seconds (default: 120, 0 to disable)",
+        "SECONDS",
+    ),
+    (
+        "low-speed-limit",
+        GLib.OptionArg.INT,
+        "Restart a download that is slower than this number of bytes/sec for --low-speed-time seconds (default: 0, disabled)",
+        "BYTES",
+    ),
+    (
+        "low-speed-time",
+        GLib.OptionArg.INT,
+        "Period over which the speed is compared with --low-speed-limit (default: 30)",
+        "SECONDS",
+    ),
+    (
+        "max-restarts",
+        GLib.OptionArg.INT,
+        "Number of times a stalled download is restarted before it is marked as failed (default: 5)",
+        "N",
+    ),
+    (
+        "worker-processes",
+        GLib.OptionArg.INT,
+        "Shard the downloads across this number of worker processes (default: 0, download in this process)",
+        "N",
+    ),
+    (
+        "coordination-db",
+        GLib.OptionArg.FILENAME,
+        "Share the URLs file with other nodes through this SQLite database on a shared filesystem",
+        "FILE",
+    ),
+    (
+        "node-id",
+        GLib.OptionArg.STRING,
+        "Unique name of this node in the coordination database (default: hostname-pid-random)",
+        "NAME",
+    ),
+    (
+        "lease-duration",
+        GLib.OptionArg.INT,
+        "Number of seconds a claimed download is reserved for this node without renewal (default: 300)",
+        "SECONDS",
+    ),
+    (
+        "report",
+        GLib.OptionArg.STRING_ARRAY,
+        "Write a report of every download and of the whole run to this file, as CSV if it ends in .csv, as JSON Lines otherwise (may be repeated)",
+        "FILE",
+    ),
+    (
+        "metrics-port",
+        GLib.OptionArg.INT,
+        "Serve Prometheus metrics on this port of localhost",
+        "PORT",
+    ),
+    (
+        "metrics-textfile",
+        GLib.OptionArg.FILENAME,
+        "Periodically write Prometheus metrics to this node-exporter textfile",
+        "FILE",
+    ),
+)
+
 
 class Application(Gtk.Application):
     def __init__(self, *args, **kwargs):
@@ -32,15 +288,160 @@ class Application(Gtk.Application):
         )
         GLib.set_application_name("RFI Downloader")
 
+        for long_name, arg, description, arg_description in OPTION_ENTRIES:
+            self.add_main_option(
+                long_name,
+                0,
+                GLib.OptionFlags.NONE,
+                arg,
+                description,
+                arg_description,
+            )
+
+        self._options: Dict[str, Any] = {}
+        self._metrics_http_server: MetricsHTTPServer = None
+        self._metrics_textfile_writer: MetricsTextfileWriter = None
+        self._transfer_threads: List[TransferThread] = []
+        self._slot_scheduler: SlotScheduler = None
+        self._dbus_interface = DBusInterface(self)
+
     @property
     def google_analytics_context(self):
         return self._google_analytics_context
 
+    @property
+    def transfer_threads(self) -> List[TransferThread]:
+        return self._transfer_threads
+
+    @property
+    def slot_scheduler(self) -> SlotScheduler:
+        """Shares the download slots between the windows"""
+        return self._slot_scheduler
+
+    @property
+    def options(self) -> Dict[str, Any]:
+        """The command-line options that were passed, keyed by long name"""
+        return self._options
+
+    def do_handle_local_options(self, options: GLib.VariantDict) -> int:
+        self._options = options.end().unpack()
+        # FILENAME options are returned as bytestrings
+        for key, value in self._options.items():
+            if isinstance(value, bytes):
+                self._options[key] = os.fsdecode(value.rstrip(b"\0"))
+
+        ordering = self._options.get("ordering", ORDERING_POLICIES[0])
+        if ordering not in ORDERING_POLICIES:
+            print(f"Invalid ordering policy {ordering}", file=sys.stderr)
+            return 1
+
+        for option in ("dedup-link", "cache-link"):
+            link_mode = self._options.get(option, LINK_MODES[0])
+            if link_mode not in LINK_MODES:
+                print(f"Invalid link mode {link_mode}", file=sys.stderr)
+                return 1
+
+        if self._options.get("max-per-host", 0) < 0:
+            print("The limit per host cannot be negative", file=sys.stderr)
+            return 1
+
+        if self._options.get("memory-budget", 0) < 0:
+            print("The memory budget cannot be negative", file=sys.stderr)
+            return 1
+
+        if self._options.get("cache-size", 1) < 1:
+            print("The cache size must be at least 1 GiB", file=sys.stderr)
+            return 1
+
+        if max_rate := self._options.get("max-rate"):
+            try:
+                parse_rate(max_rate)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 1
+
+        if schedule := self._options.get("schedule"):
+            try:
+                Schedule.from_file(schedule)
+            except (OSError, ValueError) as e:
+                print(f"Invalid schedule {schedule}: {e}", file=sys.stderr)
+                return 1
+        elif self._options.get("schedule-pause"):
+            print("--schedule-pause requires --schedule", file=sys.stderr)
+            return 1
+
+        if storage := self._options.get("storage"):
+            try:
+                parse_s3_url(storage)
+                make_client(self._options.get("s3-endpoint"))
+            except Exception as e:
+                print(f"Invalid storage {storage}: {e}", file=sys.stderr)
+                return 1
+            # these need the files on the local filesystem
+            for option in (
+                "extract",
+                "post-process",
+                "dedup",
+                "dedup-index",
+                "cache-dir",
+            ):
+                if self._options.get(option):
+                    print(
+                        f"--{option} cannot be combined with --storage",
+                        file=sys.stderr,
+                    )
+                    return 1
+            if (
+                self._options.get("s3-part-size", 8) * 1024**2
+                < MINIMUM_PART_SIZE
+            ):
+                print("The part size must be at least 5 MiB", file=sys.stderr)
+                return 1
+            if self._options.get("s3-concurrency", 1) < 1:
+                print("The S3 concurrency must be at least 1", file=sys.stderr)
+                return 1
+
+        for task in self._options.get("post-process", []):
+            try:
+                resolve_task(task)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 1
+
+        # keep going with the default processing
+        return -1
+
+    def do_dbus_register(
+        self, connection: Gio.DBusConnection, object_path: str
+    ) -> bool:
+        if not Gtk.Application.do_dbus_register(self, connection, object_path):
+            return False
+        try:
+            self._dbus_interface.register(connection, object_path)
+        except GLib.Error as e:
+            logger.warning(f"Could not export D-Bus interface: {e.message}")
+        return True
+
+    def do_dbus_unregister(
+        self, connection: Gio.DBusConnection, object_path: str
+    ):
+        self._dbus_interface.unregister()
+        Gtk.Application.do_dbus_unregister(self, connection, object_path)
+
     def do_shutdown(self):
         Gtk.Application.do_shutdown(self)
 
         self._google_analytics_context.consumer_thread.should_exit = True
 
+        for transfer_thread in self._transfer_threads:
+            transfer_thread.quit()
+
+        if self._metrics_http_server:
+            self._metrics_http_server.shutdown()
+        if self._metrics_textfile_writer:
+            self._metrics_textfile_writer.should_exit = True
+            self._metrics_textfile_writer.join()
+
     def do_startup(self):
         Gtk.Application.do_startup(self)
 
@@ -86,6 +487,39 @@ class Application(Gtk.Application):
             None,
         )
 
+        # start the threads that run the downloads
+        max_active = max(self._options.get("max-active", 1), 1)
+        self._slot_scheduler = SlotScheduler(
+            max_active, self._options.get("max-per-host", 0)
+        )
+        rate_limiter.rate = parse_rate(self._options.get("max-rate", "0"))
+        for i in range(max(self._options.get("transfer-threads", 1), 1)):
+            transfer_thread = TransferThread(name=f"transfer-{i}")
+            # keep a connection alive for every download slot,
+            # soup's defaults allow only two per host
+            session = transfer_thread.session
+            session.props.max_conns_per_host = max(
+                session.props.max_conns_per_host, max_active
+            )
+            session.props.max_conns = max(session.props.max_conns, max_active)
+            transfer_thread.start()
+            self._transfer_threads.append(transfer_thread)
+
+        # start the metrics exporters if requested
+        if (port := self._options.get("metrics-port")) is not None:
+            try:
+                self._metrics_http_server = MetricsHTTPServer(port)
+            except OSError as e:
+                logger.warning(f"Could not serve metrics on port {port}: {e}")
+            else:
+                self._metrics_http_server.start()
+
+        if textfile := self._options.get("metrics-textfile"):
+            self._metrics_textfile_writer = MetricsTextfileWriter(
+                Path(textfile)
+            )
+            self._metrics_textfile_writer.start()
+
         commonmenus_str = importlib.resources.read_text(
             "rfi_downloader.data", "menus-common.ui"
         )
@@ -11,6 +11,7 @@ from typing import Optional, Final, List
 import os
 import urllib.parse
 from threading import Thread
+import xml.etree.ElementTree as ET
 from pathlib import PurePosixPath
 
 from .utils import (
@@ -19,9 +20,24 @@ from .utils import (
     LongTaskWindow,
     get_border_width,
 )
+from .dashboard import Dashboard
 from .downloadmanager import DownloadManager
+from .utils.directories import directory_cache
+from .utils.exceptions import NotYetRunning
+from .utils.manifest import (
+    EXTRACT_AUTO,
+    EXTRACT_NONE,
+    ManifestEntry,
+    ManifestParser,
+    is_compressed,
+    open_manifest,
+)
+from .utils.metalink import is_metalink, read_metalink
+from .utils.unpack import detect_format
 from .urlobject import URLObject
-from .urllistboxrow import URLListBoxRow
+from .urlsfilemonitor import URLsFileMonitor
+from .indexcrawler import IndexCrawler, is_directory_url
+from .joblist import JobIndex, JobList, STATE_DONE, STATE_FAILED
 
 logger = logging.getLogger(__name__)
 
@@ -200,19 +216,33 @@ class ApplicationWindow(Gtk.ApplicationWindow):
         )
         controls_grid.attach(self._destination_button, 2, 1, 1, 1)
 
-        sw = Gtk.ScrolledWindow(**EXPAND_AND_FILL, has_frame=True)
-        lb = Gtk.ListBox(**EXPAND_AND_FILL)
-        sw.set_child(lb)
-        main_grid.attach(sw, 0, 2, 1, 1)
+        self._follow_check_button = Gtk.CheckButton(
+            label="Follow the URLs file, and download URLs as they are appended",
+            halign=Gtk.Align.START,
+            valign=Gtk.Align.CENTER,
+            hexpand=True,
+            vexpand=False,
+        )
+        controls_grid.attach(self._follow_check_button, 1, 2, 2, 1)
 
         self._filename: str = None
         self._destination: str = None
+        self._urls_file_monitor: URLsFileMonitor = None
+        self._manifest_parser: Optional[ManifestParser] = None
+        self._crawlers: List[IndexCrawler] = []
         self._download_manager: Final[DownloadManager] = DownloadManager(self)
+        main_grid.attach(
+            Dashboard(self._download_manager, **get_border_width(10)),
+            0,
+            2,
+            1,
+            1,
+        )
         self._model: Final[Gio.ListStore] = Gio.ListStore(item_type=URLObject)
 
-        lb.bind_model(
-            model=self._model, create_widget_func=self._create_widget_func
-        )
+        self._job_index = JobIndex(self._model)
+        self._job_index.connect("state-changed", self._job_state_changed_cb)
+        main_grid.attach(JobList(self._job_index), 0, 3, 1, 1)
 
         self._download_manager.connect(
             "notify::paused", self._download_manager_paused_changed
@@ -300,13 +330,23 @@ class ApplicationWindow(Gtk.ApplicationWindow):
 
         native.destroy()
 
-    def _create_widget_func(self, url_object: URLObject, *user_data):
-        logger.debug(
-            f"Calling _create_widget_func for {url_object.props.filename}"
-        )
-        rv = URLListBoxRow(url_object)
-        rv.show()
-        return rv
+    def _job_state_changed_cb(
+        self,
+        job_index: JobIndex,
+        url_object: URLObject,
+        old_state: str,
+        new_state: str,
+    ):
+        ga_ctxt = self.props.application.google_analytics_context
+        if new_state == STATE_FAILED:
+            logger.info(
+                f"Download failed for {url_object.props.filename}: {url_object.get_error_message()}"
+            )
+            ga_ctxt.send_event("DOWNLOAD-FILE", "FAILURE")
+        elif new_state == STATE_DONE:
+            # one event per small file would flood the analytics queue
+            if not url_object.small_file:
+                ga_ctxt.send_event("DOWNLOAD-FILE", "SUCCESS")
 
     def _delete_event_dialog_timeout(self):
         if self._download_manager.props.running:
@@ -386,6 +426,7 @@ class ApplicationWindow(Gtk.ApplicationWindow):
 
         self._urls_file_button.set_sensitive(False)
         self._destination_button.set_sensitive(False)
+        self._follow_check_button.set_sensitive(False)
         task_window = LongTaskWindow(self)
         task_window.set_text("<b>Running preflight check</b>")
         task_window.show()
@@ -393,7 +434,9 @@ class ApplicationWindow(Gtk.ApplicationWindow):
 
         self._model.remove_all()
 
-        PreflightCheckThread(self, task_window).start()
+        follow = self._follow_check_button.props.active
+        self._download_manager.follow = follow
+        PreflightCheckThread(self, task_window, follow).start()
 
     def on_pause(self, action, param):
         self.lookup_action("play").set_enabled(False)
@@ -428,6 +471,9 @@ class ApplicationWindow(Gtk.ApplicationWindow):
         task_window: LongTaskWindow,
         url_objects: List[URLObject],
         exception_msgs: Optional[List[str]],
+        offset: Optional[int],
+        manifest_parser: ManifestParser,
+        directories: List[ManifestEntry],
     ):
         task_window.set_cursor(None)
         task_window.destroy()
@@ -452,11 +498,146 @@ class ApplicationWindow(Gtk.ApplicationWindow):
 
             dialog.connect("response", _exception_messages_dialog_cb)
 
+        if directories:
+            # before starting, so the session waits for the crawl to finish
+            self._start_crawl(directories)
+
         self._download_manager_start(url_objects)
 
+        # new lines need to be parsed like the ones that came before them
+        self._manifest_parser = manifest_parser
+
+        if self._download_manager.follow and offset is None:
+            logger.warning(
+                f"Compressed URLs files and Metalinks cannot be followed"
+            )
+        elif self._download_manager.follow:
+            self._urls_file_monitor = URLsFileMonitor(
+                self._filename, offset, self._urls_file_monitor_cb
+            )
+            self._urls_file_monitor.start()
+
+    def _urls_file_monitor_cb(self, lines: List[str]):
+        for exception_msg in self.enqueue_urls(lines, self._manifest_parser):
+            logger.warning(f"Could not add URL: {exception_msg}")
+
+    def enqueue_urls(
+        self, lines: List[str], manifest_parser: Optional[ManifestParser] = None
+    ) -> List[str]:
+        """Add URLs to the running session, or start a new one.
+
+        The lines are parsed with manifest_parser, or, if not provided,
+        as plain URLs or JSON objects, each optionally followed by fields.
+        Returns the error messages for the lines that were rejected.
+        """
+        if self._destination is None:
+            return ["No destination has been selected"]
+
+        exception_msgs = []
+        entries: List[ManifestEntry] = []
+        for line in lines:
+            parser = manifest_parser or ManifestParser()
+            try:
+                entry = parser.parse_line(line)
+            except ValueError as e:
+                exception_msgs.append(f"{e} in line {line!r}")
+                continue
+            if entry is not None:
+                entries.append(entry)
+
+        return exception_msgs + self.enqueue_entries(entries)
+
+    def enqueue_entries(self, entries: List[ManifestEntry]) -> List[str]:
+        """Add downloads to the running session, or start a new one.
+        Directory URLs are crawled for the files they contain.
+
+        Returns the error messages for the entries that were rejected.
+        """
+        if self._destination is None:
+            return ["No destination has been selected"]
+
+        exception_msgs = []
+        url_objects: List[URLObject] = []
+        directories: List[ManifestEntry] = []
+        seen = set()
+        for entry in entries:
+            if is_directory_url(entry.url):
+                directories.append(entry)
+                continue
+            try:
+                url_object = url_object_from_entry(
+                    entry,
+                    self._destination,
+                    self.props.application.options.get("extract", False),
+                )
+            except ValueError as e:
+                exception_msgs.append(str(e))
+                continue
+            url = url_object.props.url
+            if url in seen or (
+                self._download_manager.props.running
+                and self._download_manager.get_url(url)
+            ):
+                exception_msgs.append(f"URL {url} has already been queued")
+                continue
+            seen.add(url)
+            url_objects.append(url_object)
+
+        if not url_objects and not directories:
+            return exception_msgs
+
+        if directories:
+            self._start_crawl(directories)
+
+        try:
+            self._download_manager.add_urls(url_objects)
+        except NotYetRunning:
+            # start a new session with these urls
+            self.lookup_action("play").set_enabled(False)
+            self._urls_file_button.set_sensitive(False)
+            self._destination_button.set_sensitive(False)
+            self._model.remove_all()
+            self._download_manager_start(url_objects)
+        else:
+            # a single items-changed signal, instead of one per download
+            self._model.splice(self._model.get_n_items(), 0, url_objects)
+
+        return exception_msgs
+
+    def _start_crawl(self, directories: List[ManifestEntry]):
+        options = self.props.application.options
+
+        def _entries_cb(entries: List[ManifestEntry]):
+            # ignore stragglers of a crawl that was stopped
+            if crawler in self._crawlers:
+                for exception_msg in self.enqueue_entries(entries):
+                    logger.warning(f"Could not add URL: {exception_msg}")
+
+        def _finished_cb(exception_msgs: List[str]):
+            for exception_msg in exception_msgs:
+                logger.warning(exception_msg)
+            if crawler in self._crawlers:
+                self._crawlers.remove(crawler)
+                self._download_manager.release()
+
+        crawler = IndexCrawler(
+            transfer_thread=self.props.application.transfer_threads[0],
+            roots=directories,
+            entries_callback=_entries_cb,
+            finished_callback=_finished_cb,
+            include=options.get("include", []),
+            exclude=options.get("exclude", []),
+            max_requests=options.get("crawl-requests", 8),
+            max_requests_per_host=options.get("crawl-requests-per-host", 2),
+        )
+        self._crawlers.append(crawler)
+        # the session may not run out of downloads while crawling
+        self._download_manager.hold()
+        crawler.start()
+
     def _download_manager_start(self, url_objects: List[URLObject]):
-        for url_object in url_objects:
-            self._model.append(url_object)
+        # the model is empty: the view is populated in one go
+        self._model.splice(0, 0, url_objects)
 
         self._download_manager_running_changed_handler_id = (
             self._download_manager.connect(
@@ -467,6 +648,13 @@ class ApplicationWindow(Gtk.ApplicationWindow):
 
     def _download_manager_finished_changed(self, download_manager, param):
         if self._download_manager.props.finished:
+            if self._urls_file_monitor:
+                self._urls_file_monitor.stop()
+                self._urls_file_monitor = None
+            for crawler in self._crawlers:
+                crawler.stop()
+                self._download_manager.release()
+            self._crawlers.clear()
             # deactivate stop and pause buttons
             self.lookup_action("play").set_enabled(False)
             self.lookup_action("stop").set_enabled(False)
@@ -493,64 +681,146 @@ class ApplicationWindow(Gtk.ApplicationWindow):
             )
 
 
+def url_object_from_entry(
+    entry: ManifestEntry, destination: str, extract: bool = False
+) -> URLObject:
+    """Turn an entry of a URLs file into a URLObject that downloads to destination.
+    If extract is set, archives are unpacked unless the entry says otherwise.
+
+    Raises ValueError if the entry does not contain a valid URL.
+    """
+    url = entry.url
+    parsed = urllib.parse.urlparse(url)
+
+    for _url in (url, *entry.mirrors):
+        if urllib.parse.urlparse(_url).scheme not in ("http", "https"):
+            raise ValueError(
+                f"URL {_url} does not follow the http or https scheme"
+            )
+
+    if entry.path:
+        relative_path = entry.path
+    elif not parsed.path:
+        raise ValueError(f"URL {url} does not contain a path component")
+    else:
+        path = PurePosixPath(urllib.parse.unquote(parsed.path[1:]))
+        relative_path = os.path.join(*path.parts)
+
+    extract_format = entry.extract or (EXTRACT_AUTO if extract else None)
+    if extract_format == EXTRACT_AUTO:
+        extract_format = detect_format(relative_path)
+    elif extract_format == EXTRACT_NONE:
+        extract_format = None
+
+    return URLObject(
+        url=url,
+        filename=os.path.join(destination, relative_path),
+        relative_path=relative_path,
+        expected_size=entry.size,
+        priority=entry.priority,
+        checksum=entry.checksum,
+        metadata=entry.metadata,
+        mirrors=entry.mirrors,
+        extract=extract_format,
+    )
+
+
 class PreflightCheckThread(Thread):
     def __init__(
-        self, appwindow: ApplicationWindow, task_window: LongTaskWindow
+        self,
+        appwindow: ApplicationWindow,
+        task_window: LongTaskWindow,
+        follow: bool = False,
     ):
         super().__init__()
         self._appwindow = appwindow
         self._task_window = task_window
+        self._follow = follow
+        self._directories: List[ManifestEntry] = []
+
+    def _append(
+        self,
+        entry: ManifestEntry,
+        url_objects: List[URLObject],
+        exception_msgs: List[str],
+        location: str = "",
+    ):
+        if is_directory_url(entry.url):
+            # to be crawled once the session has started
+            self._directories.append(entry)
+            return
+        try:
+            url_object = url_object_from_entry(
+                entry,
+                self._appwindow._destination,
+                self._appwindow.props.application.options.get("extract", False),
+            )
+        except ValueError as e:
+            exception_msgs.append(f"{location}{e}")
+            return
+        logger.debug(f"Appending {url_object.props.filename}")
+        url_objects.append(url_object)
 
     def run(self):
         exception_msgs = []
-
-        # open URLs file
-        with open(self._appwindow._filename, "r") as f:
-            lines = f.readlines()
-
-        # ignore empty lines and those starting with '#'
-        def _filter(x: str) -> bool:
-            x = x.strip()
-            if not x or x.startswith("#"):
-                return False
-            return True
-
-        lines = filter(_filter, lines)
         url_objects: List[URLObject] = list()
-
-        for line in lines:
-            line = line.split()[0]  # ignore any rubbish following the url
-            parsed = urllib.parse.urlparse(line)
-
-            if parsed.scheme not in ("http", "https"):
-                exception_msgs.append(
-                    f"URL {line} does not follow the http or https scheme"
+        manifest_parser = ManifestParser()
+        filename = self._appwindow._filename
+
+        offset: Optional[int] = None
+
+        try:
+            # compressed files can only be read from the start
+            if not is_compressed(filename):
+                offset = 0
+            # stream the URLs file, which may be huge
+            with open_manifest(filename) as f:
+                if is_metalink(f.peek(64)):
+                    # a single XML document, which cannot be followed
+                    offset = None
+                    for entry in read_metalink(f, exception_msgs):
+                        self._append(entry, url_objects, exception_msgs)
+                else:
+                    for line_number, raw_line in enumerate(f, start=1):
+                        if self._follow and not raw_line.endswith(b"\n"):
+                            # the last line may still be being written:
+                            # leave it to the URLsFileMonitor
+                            break
+                        if offset is not None:
+                            offset += len(raw_line)
+                        line = raw_line.decode("utf-8", errors="replace")
+                        try:
+                            entry = manifest_parser.parse_line(line)
+                        except ValueError as e:
+                            exception_msgs.append(f"Line {line_number}: {e}")
+                            continue
+                        if entry is not None:
+                            self._append(
+                                entry,
+                                url_objects,
+                                exception_msgs,
+                                f"Line {line_number}: ",
+                            )
+        except (OSError, EOFError, ValueError, ET.ParseError) as e:
+            exception_msgs.append(f"Could not read {filename}: {e}")
+
+        # create the destination tree in one go, instead of per file,
+        # unless the downloads go to object storage
+        if not self._appwindow.props.application.options.get("storage"):
+            exception_msgs.extend(
+                directory_cache.create_all(
+                    os.path.dirname(url_object.props.filename)
+                    for url_object in url_objects
                 )
-                continue
-
-            if not parsed.path:
-                exception_msgs.append(
-                    f"URL {line} does not contain a path component"
-                )
-                continue
-
-            path = PurePosixPath(urllib.parse.unquote(parsed.path[1:]))
-            destination_file = os.path.join(
-                self._appwindow._destination, *path.parts
-            )
-
-            url_object = URLObject(
-                url=line,
-                filename=destination_file,
-                relative_path=os.path.join(*path.parts),
             )
-            logger.debug(f"Appending {url_object.props.filename}")
-            url_objects.append(url_object)
 
         GLib.idle_add(
             self._appwindow._preflight_check_cb,
             self._task_window,
             url_objects,
             exception_msgs,
+            offset,
+            manifest_parser,
+            self._directories,
             priority=GLib.PRIORITY_DEFAULT_IDLE,
         )
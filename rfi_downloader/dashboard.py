@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import gi
+
+gi.require_version("Gtk", "4.0")
+from gi.repository import Gtk, GLib
+from humanfriendly import format_timespan
+
+from .downloadmanager import DownloadManager
+from .utils.runstats import HISTORY_LENGTH, RunSummary
+
+import logging
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Dashboard(Gtk.Grid):
+    """Summarizes the progress of the whole session: the amount of data,
+    the number of files in every state, the overall throughput and ETA,
+    and a sparkline of the recent throughput.
+
+    It is updated once per tick of the DownloadManager, however many
+    downloads there are.
+    """
+
+    def __init__(self, download_manager: DownloadManager, **kwargs):
+        super().__init__(
+            **kwargs,
+            column_spacing=10,
+            row_spacing=2,
+            halign=Gtk.Align.FILL,
+            valign=Gtk.Align.CENTER,
+            hexpand=True,
+            vexpand=False,
+        )
+
+        self._history: Tuple[float, ...] = ()
+
+        self._bytes_label = self._add_label(0)
+        self._files_label = self._add_label(1)
+        self._throughput_label = self._add_label(2)
+
+        self._sparkline = Gtk.DrawingArea(
+            content_height=40,
+            halign=Gtk.Align.FILL,
+            valign=Gtk.Align.FILL,
+            hexpand=True,
+            vexpand=False,
+        )
+        self._sparkline.set_draw_func(self._draw_sparkline)
+        self.attach(self._sparkline, 1, 0, 1, 3)
+
+        self._show(None)
+        download_manager.connect("notify::summary", self._summary_changed_cb)
+
+    def _add_label(self, row: int) -> Gtk.Label:
+        label = Gtk.Label(
+            halign=Gtk.Align.START,
+            valign=Gtk.Align.CENTER,
+            hexpand=False,
+            vexpand=False,
+            width_chars=40,
+            xalign=0,
+        )
+        self.attach(label, 0, row, 1, 1)
+        return label
+
+    def _summary_changed_cb(self, download_manager: DownloadManager, param):
+        self._show(download_manager.props.summary)
+
+    def _show(self, summary: RunSummary):
+        if summary is None:
+            self._bytes_label.props.label = "Not started"
+            self._files_label.props.label = ""
+            self._throughput_label.props.label = ""
+            self._history = ()
+            self._sparkline.queue_draw()
+            return
+
+        self._bytes_label.props.label = (
+            f"{GLib.format_size(summary.bytes_done)} downloaded"
+        )
+        files = (
+            f"{summary.files_done} done, {summary.files_active} active,"
+            + f" {summary.files_queued} queued"
+        )
+        if summary.files_failed:
+            files += f", {summary.files_failed} failed"
+        self._files_label.props.label = files
+        throughput = f"{GLib.format_size(int(summary.throughput))}/sec"
+        if summary.eta is not None and summary.files_active:
+            throughput += f", {format_timespan(summary.eta)} remaining"
+        self._throughput_label.props.label = throughput
+        self._history = summary.history
+        self._sparkline.queue_draw()
+
+    def _draw_sparkline(
+        self, area: Gtk.DrawingArea, cr, width: int, height: int, *user_data
+    ):
+        history = self._history
+        peak = max(history, default=0)
+        if len(history) < 2 or peak <= 0:
+            return
+        color = area.get_style_context().get_color()
+        cr.set_source_rgba(color.red, color.green, color.blue, color.alpha)
+        cr.set_line_width(1.5)
+        # the newest sample on the right, scrolling to the left
+        step = width / (HISTORY_LENGTH - 1)
+        offset = width - (len(history) - 1) * step
+        for index, sample in enumerate(history):
+            x = offset + index * step
+            y = height - 1 - sample / peak * (height - 2)
+            if index == 0:
+                cr.move_to(x, y)
+            else:
+                cr.line_to(x, y)
+        cr.stroke()
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+from gi.repository import Gio, GLib
+
+import logging
+from typing import Callable, Dict, Optional
+
+from .applicationwindow import ApplicationWindow
+from .utils.exceptions import CannotPause, NotYetRunning
+
+logger = logging.getLogger(__name__)
+
+INTERFACE_NAME = "uk.ac.rfi.ai.downloader.Control"
+
+INTERFACE_XML = f"""
+<node>
+  <interface name="{INTERFACE_NAME}">
+    <method name="Enqueue">
+      <arg type="as" name="urls" direction="in"/>
+      <arg type="as" name="errors" direction="out"/>
+    </method>
+    <method name="SetPriority">
+      <arg type="s" name="url" direction="in"/>
+      <arg type="i" name="priority" direction="in"/>
+    </method>
+    <method name="Pause">
+      <arg type="s" name="url" direction="in"/>
+    </method>
+    <method name="Resume">
+      <arg type="s" name="url" direction="in"/>
+    </method>
+    <method name="Cancel">
+      <arg type="s" name="url" direction="in"/>
+    </method>
+    <method name="GetStatus">
+      <arg type="a(ssidss)" name="downloads" direction="out"/>
+    </method>
+  </interface>
+</node>
+"""
+
+
+def url_state(url) -> str:
+    if url.props.finished:
+        return "failed" if url.get_error_message() else "done"
+    elif url.props.paused:
+        return "paused"
+    elif url.props.running:
+        return "running"
+    return "queued"
+
+
+class DBusInterface:
+    """Exposes the downloads of the active window on the session bus.
+
+    Allows other processes to add URLs to a running session, and to
+    inspect and control individual downloads, e.g. with:
+
+        gdbus call --session --dest uk.ac.rfi.ai.downloader \\
+            --object-path /uk/ac/rfi/ai/downloader \\
+            --method uk.ac.rfi.ai.downloader.Control.Enqueue \\
+            "['https://example.com/file.tif']"
+    """
+
+    def __init__(self, application):
+        self._application = application
+        self._node_info = Gio.DBusNodeInfo.new_for_xml(INTERFACE_XML)
+        self._registration_id: int = 0
+        self._connection: Optional[Gio.DBusConnection] = None
+        self._methods: Dict[str, Callable] = {
+            "Enqueue": self._enqueue,
+            "SetPriority": self._set_priority,
+            "Pause": self._pause,
+            "Resume": self._resume,
+            "Cancel": self._cancel,
+            "GetStatus": self._get_status,
+        }
+
+    def register(self, connection: Gio.DBusConnection, object_path: str):
+        self._connection = connection
+        self._registration_id = connection.register_object(
+            object_path,
+            self._node_info.interfaces[0],
+            self._method_call_cb,
+            None,
+            None,
+        )
+
+    def unregister(self):
+        if self._registration_id:
+            self._connection.unregister_object(self._registration_id)
+            self._registration_id = 0
+
+    def _get_window(self) -> ApplicationWindow:
+        window = self._application.get_active_window()
+        if isinstance(window, ApplicationWindow):
+            return window
+        for window in self._application.get_windows():
+            if isinstance(window, ApplicationWindow):
+                return window
+        raise LookupError("No downloader window is open")
+
+    def _get_url(self, url: str):
+        url_object = self._get_window().download_manager.get_url(url)
+        if url_object is None:
+            raise LookupError(f"URL {url} is not part of the current session")
+        return url_object
+
+    def _method_call_cb(
+        self,
+        connection: Gio.DBusConnection,
+        sender: str,
+        object_path: str,
+        interface_name: str,
+        method_name: str,
+        parameters: GLib.Variant,
+        invocation: Gio.DBusMethodInvocation,
+    ):
+        logger.debug(f"D-Bus call {method_name}{parameters} from {sender}")
+        try:
+            rv = self._methods[method_name](*parameters.unpack())
+        except LookupError as e:
+            invocation.return_dbus_error(
+                f"{INTERFACE_NAME}.Error.NotFound", str(e)
+            )
+        except NotYetRunning as e:
+            invocation.return_dbus_error(
+                f"{INTERFACE_NAME}.Error.NotRunning", str(e)
+            )
+        except CannotPause as e:
+            invocation.return_dbus_error(
+                f"{INTERFACE_NAME}.Error.CannotPause", str(e)
+            )
+        except Exception as e:
+            logger.exception(f"D-Bus call {method_name} failed")
+            invocation.return_dbus_error(
+                f"{INTERFACE_NAME}.Error.Failed", str(e)
+            )
+        else:
+            invocation.return_value(rv)
+
+    def _enqueue(self, urls):
+        errors = self._get_window().enqueue_urls(urls)
+        return GLib.Variant("(as)", (errors,))
+
+    def _set_priority(self, url: str, priority: int):
+        url_object = self._get_url(url)
+        self._get_window().download_manager.set_priority(url_object, priority)
+
+    def _pause(self, url: str):
+        url_object = self._get_url(url)
+        if url_object.props.finished:
+            raise CannotPause(f"{url} has already finished")
+        if not url_object.props.running:
+            # queued downloads are not held back, say so instead
+            raise CannotPause(
+                f"{url} is queued and has not started yet, only running downloads can be paused"
+            )
+        if url_object.small_file:
+            raise CannotPause(
+                f"{url} is a small file that is downloaded in one go, it cannot be paused"
+            )
+        url_object.pause()
+
+    def _resume(self, url: str):
+        url_object = self._get_url(url)
+        if url_object.props.paused:
+            url_object.start()
+
+    def _cancel(self, url: str):
+        url_object = self._get_url(url)
+        self._get_window().download_manager.cancel_url(url_object)
+
+    def _get_status(self):
+        downloads = [
+            (
+                url.props.url,
+                url_state(url),
+                url.props.priority,
+                url.props.progress,
+                url.get_status_message() or "",
+                url.get_error_message() or "",
+            )
+            for url in self._get_window().model
+        ]
+        return GLib.Variant("(a(ssidss))", (downloads,))
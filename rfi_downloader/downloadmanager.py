@@ -2,13 +2,42 @@ from __future__ import annotations
 
 from gi.repository import GObject, GLib
 
+from .utils.cache import SharedCache
+from .utils.concurrency import AIMDController
+from .utils.dedup import ContentStore, LINK_AUTO, LINK_REFLINK, checksum_key
 from .utils.exceptions import AlreadyRunning, NotYetRunning, AlreadyPaused
+from .utils.leases import LeaseCoordinator
+from .utils.memory import memory_budget
+from .utils.metrics import ACTIVE_JOBS, QUEUED_JOBS
+from .utils.ratelimit import parse_rate, rate_limiter
+from .utils.readyqueue import JobRanks, ReadyQueue, ORDERING_MANIFEST
+from .utils.report import RunReport
+from .utils.runstats import RunSummary, ThroughputTracker
+from .utils.schedule import Schedule, ScheduleWindow
+from .utils.slots import SlotScheduler
+from .utils.stalls import StallPolicy
+from .postprocessor import PostProcessor
+from .storage import StorageBackend, local_storage, storage_from_options
+from .urlobject import URLObject
+from .workerpool import WorkerPool
 
+from datetime import datetime
+import itertools
 import logging
+import os
 from threading import RLock
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
+# the number of queued downloads that are passed over per tick
+# because their host is busy
+_MAX_DEFERRED = 100
+# seconds before a node claims a job again that it passed over
+# because its host was busy
+_PASSED_OVER_DELAY = 10
+
 
 class DownloadManager(GObject.Object):
     def __init__(self, appwindow):
@@ -22,10 +51,72 @@ class DownloadManager(GObject.Object):
         self._should_stop: bool = False
         self._should_pause: bool = False
         self._should_resume: bool = False
-        self._max_active_urls: int = (
-            1  # this could become a configurable parameter
+        self._max_active_urls: int = max(
+            appwindow.props.application.options.get("max-active", 1), 1
+        )
+        self._adaptive_concurrency: bool = (
+            appwindow.props.application.options.get(
+                "adaptive-concurrency", False
+            )
+        )
+        self._concurrency_controller: AIMDController = None
+        options = appwindow.props.application.options
+        # shared with the other windows
+        self._slots: SlotScheduler = appwindow.props.application.slot_scheduler
+        self._time_schedule: Schedule = None
+        self._max_rate: int = parse_rate(options.get("max-rate", "0"))
+        # the window that applies, and whether the schedule suspended us
+        self._schedule_state: Optional[
+            Tuple[Optional[ScheduleWindow], bool]
+        ] = None
+        self._suspended: bool = False
+        self._stall_policy = StallPolicy(
+            low_speed_limit=options.get("low-speed-limit", 0),
+            low_speed_time=options.get("low-speed-time", 30),
+            idle_timeout=options.get("stall-timeout", 120),
+            max_restarts=options.get("max-restarts", 5),
+        )
+        self._small_file_threshold: int = options.get("small-file-threshold", 0)
+        self._finished_bytes: int = 0
+        self._transient_failures: int = 0
+        # stall restarts of the downloads that are finished
+        self._finished_restarts: int = 0
+        self._number_of_failed_urls: int = 0
+        # the expected size of the downloads that are not finished,
+        # and the number of them whose size is unknown
+        self._remaining_expected_bytes: int = 0
+        self._unknown_sizes: int = 0
+        self._throughput_tracker = ThroughputTracker()
+        self._summary: Optional[RunSummary] = None
+        self._report: RunReport = None
+        self._run_started: float = 0
+        self._active_urls: Set[URLObject] = set()
+        # stalled downloads that are waiting in the ready queue to be resumed
+        self._interrupted_urls: Set[URLObject] = set()
+        self._urls: List[URLObject] = []
+        self._number_of_finished_urls: int = 0
+        self._ready_queue: ReadyQueue[URLObject] = ReadyQueue(
+            appwindow.props.application.options.get(
+                "ordering", ORDERING_MANIFEST
+            )
+        )
+        self._url_by_string: Dict[str, URLObject] = {}
+        self._worker_processes: int = appwindow.props.application.options.get(
+            "worker-processes", 0
         )
-        self._active_urls: int = 0
+        self._worker_pool: WorkerPool = None
+        self._coordinator: LeaseCoordinator = None
+        # the ordering policy, in the jobs table of the coordinator
+        self._job_ranks: JobRanks = None
+        self._post_processor: PostProcessor = None
+        self._content_store: ContentStore = None
+        self._shared_cache: SharedCache = None
+        self._storage: StorageBackend = local_storage
+        # downloads of the same content wait for the first one, by key
+        self._primaries: Dict[str, URLObject] = {}
+        self._followers: Dict[URLObject, List[URLObject]] = {}
+        self._follow: bool = False
+        self._holds: int = 0
 
     @GObject.Property(type=bool, default=False)
     def running(self):
@@ -39,6 +130,31 @@ class DownloadManager(GObject.Object):
     def finished(self):
         return self._finished
 
+    @GObject.Property(type=object)
+    def summary(self) -> Optional[RunSummary]:
+        """The progress of the session as a whole, updated every second"""
+        return self._summary
+
+    @property
+    def follow(self) -> bool:
+        """If set, the session keeps running when all downloads are finished,
+        waiting for new ones to be added, until it is stopped"""
+        return self._follow
+
+    @follow.setter
+    def follow(self, value: bool):
+        self._follow = value
+
+    def hold(self):
+        """Keep the session running when all downloads are finished,
+        because more are on their way, until release is called"""
+        with self._model_lock:
+            self._holds += 1
+
+    def release(self):
+        with self._model_lock:
+            self._holds -= 1
+
     def start(self):
         # resume
         if self._paused:
@@ -51,16 +167,232 @@ class DownloadManager(GObject.Object):
                 "The download manager is already running. It needs to be stopped before it may be restarted"
             )
 
-        # hook up to each of the urls' finished signal
-        for url in self._appwindow._model:
-            url.connect("notify::finished", self._url_finished_cb)
+        # the transfers and the scheduler run on the transfer threads,
+        # so take a snapshot of the model, which belongs to the main thread
+        transfer_threads = self._appwindow.props.application.transfer_threads
+        options = self._appwindow.props.application.options
 
+        if coordination_db := options.get("coordination-db"):
+            self._coordinator = LeaseCoordinator(
+                path=coordination_db,
+                node_id=options.get("node-id"),
+                lease_duration=options.get("lease-duration", 300),
+            )
+            self._job_ranks = JobRanks(self._ready_queue.policy)
+            logger.info(
+                f"Coordinating downloads through {coordination_db} as {self._coordinator.node_id}"
+            )
+
+        memory_limit = options.get("memory-budget", 0) * 1024**2
+        if self._worker_processes > 0:
+            self._worker_pool = WorkerPool(
+                processes=self._worker_processes,
+                max_active=self._max_active_urls,
+                poll_thread=transfer_threads[0],
+                memory_limit=memory_limit,
+            )
+            self._worker_pool.start()
+        else:
+            memory_budget.limit = memory_limit
+
+        if options.get("dedup") or options.get("dedup-index"):
+            index = options.get("dedup-index") or os.path.join(
+                GLib.get_user_data_dir(),
+                "rfi-downloader",
+                "content-index.sqlite",
+            )
+            self._content_store = ContentStore(
+                index, options.get("dedup-link", LINK_AUTO)
+            )
+            logger.info(f"Deduplicating downloads with {index}")
+
+        self._storage = storage_from_options(options)
+        if not self._storage.local:
+            logger.info(f"Writing the downloads to {options.get('storage')}")
+
+        if cache_dir := options.get("cache-dir"):
+            self._shared_cache = SharedCache(
+                cache_dir,
+                options.get("cache-size", 10) * 1024**3,
+                options.get("cache-link", LINK_REFLINK),
+            )
+            logger.info(f"Using the shared cache in {cache_dir}")
+
+        if reports := options.get("report"):
+            self._report = RunReport(reports)
+            logger.info(f"Writing the run report to {', '.join(reports)}")
+
+        if tasks := options.get("post-process"):
+            workers = options.get("processing-workers") or os.cpu_count() or 1
+            self._post_processor = PostProcessor(
+                tasks=tasks,
+                workers=workers,
+                max_pending=options.get("max-pending-processing", 4 * workers),
+            )
+            logger.info(
+                f"Processing downloaded files with {', '.join(tasks)} on {workers} processes"
+            )
+
+        if schedule := options.get("schedule"):
+            self._time_schedule = Schedule.from_file(
+                schedule, options.get("schedule-pause", False)
+            )
+            logger.info(f"Following the schedule in {schedule}")
+
+        if self._adaptive_concurrency:
+            self._concurrency_controller = AIMDController(
+                maximum=self._max_active_urls
+            )
+            logger.info(
+                f"Tuning the number of simultaneous downloads between 1 and {self._max_active_urls}"
+            )
+
+        self._urls = []
+        self._url_by_string = {}
+        self._number_of_finished_urls = 0
+        self._interrupted_urls = set()
+        self._finished_bytes = 0
+        self._transient_failures = 0
+        self._finished_restarts = 0
+        self._number_of_failed_urls = 0
+        self._remaining_expected_bytes = 0
+        self._unknown_sizes = 0
+        self._throughput_tracker.reset()
+        self._run_started = time.time()
+        self._ready_queue = ReadyQueue(self._ready_queue.policy)
+        self._primaries = {}
+        self._followers = {}
+        self._schedule_state = None
+        self._suspended = False
+        self._finished = False
+        self._add_urls(list(self._appwindow._model))
+
+        rate_limiter.join(self)
         self._running = True
-        self._timeout_id = GLib.timeout_add_seconds(
-            1, self._model_timeout_cb, priority=GLib.PRIORITY_DEFAULT
+        self._timeout_source = transfer_threads[0].timeout_add_seconds(
+            1, self._model_timeout_cb
         )
         self.notify("running")
 
+    def _add_urls(self, urls: List[URLObject]):
+        transfer_threads = self._appwindow.props.application.transfer_threads
+        with self._model_lock:
+            for url in urls:
+                url.transfer_thread = transfer_threads[
+                    len(self._urls) % len(transfer_threads)
+                ]
+                url.worker_pool = self._worker_pool
+                url.stall_policy = self._stall_policy
+                url.rate_session = self
+                size = url.get_expected_size()
+                url.small_file = (
+                    self._worker_pool is None
+                    and self._storage.local
+                    and not url.get_extract_format()
+                    and self._small_file_threshold > 0
+                    and 0 <= size <= self._small_file_threshold
+                )
+                # hook up to the url's finished signal
+                url.connect("notify::finished", self._url_finished_cb)
+                url.connect("notify::running", self._url_running_cb)
+                url.content_store = self._content_store
+                url.shared_cache = self._shared_cache
+                url.storage = self._storage
+                if size >= 0:
+                    self._remaining_expected_bytes += size
+                else:
+                    self._unknown_sizes += 1
+                self._urls.append(url)
+                self._url_by_string[url.props.url] = url
+                self._schedule(url)
+            if self._coordinator:
+                self._coordinator.add_jobs(
+                    (
+                        url.props.url,
+                        url.props.priority,
+                        self._job_ranks.rank(
+                            url.get_expected_size(), url.get_host()
+                        ),
+                    )
+                    for url in urls
+                )
+
+    def _schedule(self, url: URLObject):
+        # queue a download, unless the same content is already on its way
+        if (
+            self._content_store
+            and self._coordinator is None
+            and not url.get_extract_format()
+        ):
+            keys = [f"url:{url.props.url}"]
+            if url.get_checksum():
+                keys.append(checksum_key(url.get_checksum()))
+            for key in keys:
+                primary = self._primaries.get(key)
+                if primary is None or primary is url:
+                    continue
+                if not primary.props.finished:
+                    self._followers.setdefault(primary, []).append(url)
+                    return
+                if not primary.get_error_message():
+                    self._copy_duplicate(url, primary)
+                    return
+            for key in keys:
+                self._primaries[key] = url
+        self._push_ready(url)
+
+    def _copy_duplicate(self, url: URLObject, primary: URLObject):
+        self._active_urls.add(url)
+        url.copy_from(primary.props.filename)
+
+    def add_urls(self, urls: List[URLObject]):
+        """Add downloads to the running session. The caller is responsible
+        for adding them to the model of the window as well."""
+        with self._model_lock:
+            if not self._running:
+                raise NotYetRunning(
+                    "The download manager needs to be started before downloads can be added."
+                )
+            self._add_urls(urls)
+
+    def get_url(self, url: str) -> Optional[URLObject]:
+        with self._model_lock:
+            return self._url_by_string.get(url)
+
+    def _push_ready(
+        self,
+        url: URLObject,
+        sequence: Optional[int] = None,
+        first: bool = False,
+    ):
+        self._ready_queue.push(
+            url,
+            priority=url.props.priority,
+            size=url.get_expected_size(),
+            host=url.get_host(),
+            sequence=sequence,
+            first=first,
+        )
+
+    def set_priority(self, url: URLObject, priority: int):
+        with self._model_lock:
+            url.props.priority = priority
+            if self._coordinator:
+                # the coordinator decides what is started next
+                self._coordinator.set_priority(url.props.url, priority)
+            if url in self._ready_queue:
+                # requeue, keeping its place in the manifest order
+                self._push_ready(url, self._ready_queue.sequence(url))
+
+    def cancel_url(self, url: URLObject):
+        with self._model_lock:
+            if url.props.finished:
+                return
+            elif url.props.running:
+                url.stop()
+            else:
+                url.skip("Download cancelled", "Cancelled before it started")
+
     def pause(self):
         # start
         if self._paused:
@@ -78,71 +410,455 @@ class DownloadManager(GObject.Object):
             )
         self._should_stop = True
 
+    def _follow_schedule(self):
+        window = self._time_schedule.window_at(datetime.now())
+        suspended = window is None and self._time_schedule.pause_outside
+        if (window, suspended) == self._schedule_state:
+            return
+        self._schedule_state = (window, suspended)
+
+        # the limits change at the boundaries of the windows only, and
+        # apply to all windows together: they follow the same schedule
+        rates = [
+            rate for rate in (self._max_rate, window and window.rate) if rate
+        ]
+        rate_limiter.rate = min(rates, default=0)
+        # the window may only lower them
+        self._slots.max_active = min(
+            self._max_active_urls,
+            (window and window.max_active) or self._max_active_urls,
+        )
+        if window:
+            logger.info(f"Entering the schedule window {window.describe()}")
+        elif suspended:
+            logger.info("Outside of the schedule, suspending the downloads")
+        else:
+            logger.info("Outside of the schedule, running without limits")
+
+        if suspended and not self._suspended:
+            # the downloads are resumed with a Range request in the next window
+            for url in list(self._active_urls):
+                url.suspend()
+        self._suspended = suspended
+
+    def _bytes_transferred(self) -> int:
+        return self._finished_bytes + sum(
+            url.get_bytes_written() for url in self._active_urls
+        )
+
+    def _stall_restarts(self) -> int:
+        # the stalled downloads are either active, or waiting to be resumed
+        return self._finished_restarts + sum(
+            url.get_restarts()
+            for url in itertools.chain(
+                self._active_urls, self._interrupted_urls
+            )
+        )
+
+    def _tune_concurrency(self):
+        # stalls are failures too, the controller backs off on them
+        self._concurrency_controller.update(
+            now=time.monotonic(),
+            bytes_transferred=self._bytes_transferred(),
+            failures=self._transient_failures + self._stall_restarts(),
+            active=len(self._active_urls),
+            queued=len(self._ready_queue),
+        )
+
+    def _notify_main(self, property_name: str):
+        # our properties are watched by the GUI, which lives on the main thread
+        GLib.idle_add(self.notify, property_name)
+
+    def _shutdown_worker_pool(self):
+        if self._worker_pool:
+            self._worker_pool.shutdown()
+            self._worker_pool = None
+
+    def _shutdown_post_processor(self, cancel: bool = False):
+        if self._post_processor:
+            self._post_processor.shutdown(cancel)
+            self._post_processor = None
+
+    def _shutdown_content_store(self):
+        if self._content_store:
+            self._content_store.close()
+            self._content_store = None
+
+    def _report_file(self, url: URLObject):
+        duration = url.get_duration()
+        now = time.time()
+        if duration is None:
+            status = "skipped"
+        elif url.get_error_class() == "cancelled":
+            status = "cancelled"
+        elif url.get_error_message():
+            status = "failed"
+        else:
+            status = "done"
+        self._report.add_file(
+            url=url.props.url,
+            path=url.props.relative_path,
+            size=url.get_bytes_written(),
+            started=now - duration if duration is not None else None,
+            finished=now,
+            peak_throughput=url.get_peak_speed(),
+            attempts=url.get_attempts(),
+            status=status,
+            error=url.get_error_message(),
+            checksum=url.get_checksum(),
+        )
+
+    def _shutdown_report(self, status: str):
+        if self._report:
+            self._report.add_summary(
+                size=self._summary.bytes_done,
+                started=self._run_started,
+                finished=time.time(),
+                peak_throughput=self._throughput_tracker.peak,
+                files=len(self._urls),
+                status=status,
+                failures=self._number_of_failed_urls,
+            )
+            self._report.close()
+            self._report = None
+
+    def _release_slots(self):
+        self._slots.release_all(self)
+        rate_limiter.leave(self)
+
+    def _shutdown_coordinator(self):
+        if self._coordinator:
+            self._coordinator.close()
+            self._coordinator = None
+
     def _url_finished_cb(self, url, param):
         with self._model_lock:
+            if not url.props.finished:
+                return
+            self._number_of_finished_urls += 1
+            self._finished_restarts += url.get_restarts()
+            if url.get_error_message():
+                self._number_of_failed_urls += 1
+            if self._report:
+                self._report_file(url)
+            if (size := url.get_expected_size()) >= 0:
+                self._remaining_expected_bytes -= size
+            else:
+                self._unknown_sizes -= 1
+            # it may have been skipped or cancelled while queued
+            self._ready_queue.remove(url)
+            self._interrupted_urls.discard(url)
+            for follower in self._followers.pop(url, []):
+                if follower.props.finished:
+                    # cancelled while waiting
+                    continue
+                if url.get_error_message():
+                    # the first of them takes over
+                    self._schedule(follower)
+                else:
+                    self._copy_duplicate(follower, url)
+            if url not in self._active_urls:
+                if self._coordinator:
+                    # skipped or cancelled while queued: without this, its
+                    # job would stay pending, and be claimed on every tick
+                    self._coordinator.skip(
+                        url.props.url, url.get_error_message() or None
+                    )
+                return
+            self._active_urls.discard(url)
+            self._slots.release(url)
+            self._finished_bytes += url.get_bytes_written()
+            if url.get_error_class() in ("network", "http_5xx"):
+                self._transient_failures += 1
+            if (
+                self._post_processor
+                and not url.get_error_message()
+                and not url.get_extract_format()
+            ):
+                self._post_processor.submit(url)
+            if self._can_start_urls():
+                # fill the slot straight away instead of on the next tick,
+                # which matters when many small files finish every second
+                self._start_ready_urls()
+            if self._coordinator:
+                if url.get_error_class() == "cancelled":
+                    # let another node (or a future run) pick this one up
+                    self._coordinator.release(url.props.url)
+                elif url.get_error_message():
+                    self._coordinator.fail(
+                        url.props.url, url.get_error_message()
+                    )
+                else:
+                    self._coordinator.complete(url.props.url)
+
+    def _url_running_cb(self, url, param):
+        with self._model_lock:
+            if (
+                url.props.running
+                or url.props.finished
+                or url not in self._active_urls
+            ):
+                return
+            # a stalled transfer gave up its connection
+            if self._should_stop:
+                # close its partially written file
+                url.stop()
+            elif self._coordinator and not self._suspended:
+                # we hold the lease on it, so restart it in its own slot
+                url.start()
+            else:
+                # free its slot, and put it at the front of the queue
+                self._active_urls.discard(url)
+                self._slots.release(url)
+                self._interrupted_urls.add(url)
+                if self._coordinator:
+                    # to be claimed again once the schedule allows it
+                    self._coordinator.release(url.props.url)
+                else:
+                    self._push_ready(url, first=True)
+
+    def _coordinate(self):
+        # keep our leases alive, and stop downloads whose lease we lost
+        if self._coordinator.renew_if_needed():
+            held = self._coordinator.held(
+                url.props.url for url in self._active_urls
+            )
+            for url in list(self._active_urls):
+                if url.props.url not in held:
+                    logger.warning(
+                        f"Lost the lease on {url.props.url}, stopping download"
+                    )
+                    url.stop()
+
+        # skip the jobs that were finished by other nodes
+        for (
+            url_string,
+            state,
+            owner,
+            error,
+        ) in self._coordinator.finished_elsewhere():
+            url = self._url_by_string.get(url_string)
+            if url is None or url.props.running or url.props.finished:
+                continue
+            if error:
+                url.skip(f"Download failed on {owner}", error)
+            else:
+                url.skip(f"Downloaded by {owner}")
+
+        if (
+            self._should_stop
+            or self._paused
+            or self._should_pause
+            or self._should_resume
+            or self._suspended
+            or self._processing_backlogged()
+        ):
+            return
+
+        # claim as many jobs as we have free slots
+        for url_string in self._coordinator.claim(self._slots.available(self)):
+            url = self._url_by_string.get(url_string)
+            if url is None:
+                # not in our manifest, leave it to the others
+                self._coordinator.release(
+                    url_string, self._coordinator.lease_duration
+                )
+                continue
             if url.props.finished:
-                self._active_urls -= 1
+                # skipped or cancelled here
+                self._coordinator.skip(
+                    url_string, url.get_error_message() or None
+                )
+                continue
+            if url.props.running or not self._slots.acquire(
+                self, url, url.get_host()
+            ):
+                # its host is busy: move on to the jobs behind it, instead of
+                # claiming it again on the next tick
+                self._coordinator.release(url_string, _PASSED_OVER_DELAY)
+                continue
+            self._ready_queue.remove(url)
+            self._interrupted_urls.discard(url)
+            url.start()
+            self._active_urls.add(url)
+
+    def _can_start_urls(self) -> bool:
+        return (
+            self._running
+            and not self._paused
+            and not self._should_pause
+            and not self._should_resume
+            and not self._should_stop
+            and not self._suspended
+            and self._coordinator is None
+            and not self._processing_backlogged()
+        )
+
+    def _processing_backlogged(self) -> bool:
+        # backpressure: let the post-processing catch up first
+        return (
+            self._post_processor is not None and self._post_processor.backlogged
+        )
+
+    def _start_ready_urls(self):
+        deferred: List[URLObject] = []
+        while (
+            len(deferred) < _MAX_DEFERRED
+            and self._slots.available(self) > 0
+            and (url := self._ready_queue.pop()) is not None
+        ):
+            if not self._slots.acquire(self, url, url.get_host()):
+                deferred.append(url)
+                continue
+            self._interrupted_urls.discard(url)
+            url.start()
+            self._active_urls.add(url)
+        # they keep their place at the front of the queue
+        for url in reversed(deferred):
+            self._push_ready(url, first=True)
+
+    def _remaining_bytes(self) -> Optional[int]:
+        # the sizes from the URLs file, or else from the server
+        remaining = self._remaining_expected_bytes
+        unknown = self._unknown_sizes
+        for url in self._active_urls:
+            size = url.get_expected_size()
+            if size < 0 and url.get_filesize() > 0:
+                size = url.get_filesize()
+                remaining += size
+                unknown -= 1
+            if size >= 0:
+                remaining -= min(url.get_bytes_written(), size)
+        if unknown > 0:
+            finished = (
+                self._number_of_finished_urls - self._number_of_failed_urls
+            )
+            if not finished:
+                return None
+            # assume that the others are like the ones that are done
+            remaining += unknown * self._finished_bytes // finished
+        return max(remaining, 0)
+
+    def _update_summary(self, number_of_running: int):
+        bytes_done = self._bytes_transferred()
+        self._throughput_tracker.update(time.monotonic(), bytes_done)
+        self._summary = RunSummary(
+            bytes_done=bytes_done,
+            files_done=self._number_of_finished_urls
+            - self._number_of_failed_urls,
+            files_failed=self._number_of_failed_urls,
+            files_active=number_of_running,
+            files_queued=len(self._ready_queue),
+            throughput=self._throughput_tracker.throughput,
+            eta=self._throughput_tracker.eta(self._remaining_bytes()),
+            history=self._throughput_tracker.history,
+        )
+        self._notify_main("summary")
 
     def _model_timeout_cb(self):
         with self._model_lock:
-            number_of_finished_urls = 0
-            number_of_running = 0
-            number_of_paused = 0
-            for url in self._appwindow._model:
-                if url.props.finished:
-                    number_of_finished_urls += 1
-                elif self._should_stop and url.props.running:
-                    logger.debug(f"Calling url.stop")
-                    url.stop()
-                elif (
-                    self._should_pause
-                    and not url.props.paused
-                    and url.props.running
-                ):
-                    # pause if necessary
-                    url.pause()
-                elif (
-                    self._running
-                    and not self._should_stop
-                    and not self._paused
-                    and not self._should_pause
-                    and not self._should_resume
-                    and self._active_urls < self._max_active_urls
+            if self._time_schedule:
+                self._follow_schedule()
+
+            if self._concurrency_controller:
+                if (
+                    self._paused
+                    or self._should_pause
+                    or self._should_resume
+                    or self._should_stop
+                    or self._suspended
                 ):
-                    # start
-                    url.start()
-                    self._active_urls += 1
-                elif url.props.running and self._should_resume:
-                    # resume
-                    url.start()
-                    # this cannot affect the number of active urls
+                    # a paused session says nothing about the throughput
+                    self._concurrency_controller.reset()
+                else:
+                    self._tune_concurrency()
+                # the limit applies to the downloads of all windows
+                self._slots.set_limit(self, self._concurrency_controller.limit)
+
+            if self._worker_pool:
+                # its processes have a rate limiter of their own
+                self._worker_pool.set_rate_limit(rate_limiter.share(self))
+
+            if self._coordinator:
+                self._coordinate()
+
+            # only the active downloads are visited: queued ones live in the ready queue
+            if self._should_stop:
+                for url in list(self._active_urls):
+                    if url.props.running:
+                        logger.debug(f"Calling url.stop")
+                        url.stop()
+                for url in list(self._interrupted_urls):
+                    url.stop()
+            elif self._should_pause:
+                for url in self._active_urls:
+                    if url.props.running and not url.props.paused:
+                        url.pause()
+            elif self._should_resume:
+                for url in self._active_urls:
+                    if url.props.paused:
+                        url.start()
+            elif self._can_start_urls():
+                self._start_ready_urls()
 
+            # the other windows leave us our share of the slots
+            self._slots.set_waiting(
+                self,
+                len(self._ready_queue) if self._can_start_urls() else 0,
+            )
+
+            number_of_finished_urls = self._number_of_finished_urls
+            number_of_running = 0
+            number_of_paused = 0
+            for url in self._active_urls:
                 if url.props.running:
                     number_of_running += 1
                 if url.props.paused:
                     number_of_paused += 1
 
-            if number_of_finished_urls == len(self._appwindow._model):
+            ACTIVE_JOBS.set(number_of_running)
+            QUEUED_JOBS.set(len(self._ready_queue))
+            self._update_summary(number_of_running)
+
+            if (
+                number_of_finished_urls == len(self._urls)
+                and not self._follow
+                and not self._holds
+                and not (self._post_processor and self._post_processor.pending)
+            ):
                 # all jobs have been finished
+                self._shutdown_worker_pool()
+                self._shutdown_post_processor()
+                self._shutdown_coordinator()
+                self._shutdown_content_store()
+                self._shutdown_report("finished")
+                self._release_slots()
                 self._running = False
-                self.notify("running")
+                self._notify_main("running")
                 self._finished = True
-                self.notify("finished")
+                self._notify_main("finished")
                 return GLib.SOURCE_REMOVE
             elif self._should_stop and number_of_running == 0:
                 self._should_stop = False
+                self._shutdown_worker_pool()
+                self._shutdown_post_processor(cancel=True)
+                self._shutdown_coordinator()
+                self._shutdown_content_store()
+                self._shutdown_report("stopped")
+                self._release_slots()
                 self._running = False
-                self.notify("running")
+                self._notify_main("running")
                 self._finished = True
-                self.notify("finished")
+                self._notify_main("finished")
+                return GLib.SOURCE_REMOVE
             elif self._should_pause and number_of_paused == number_of_running:
                 self._should_pause = False
                 self._paused = True
-                self.notify("paused")
+                self._notify_main("paused")
             elif self._should_resume and number_of_paused == 0:
                 self._should_resume = False
                 self._paused = False
-                self.notify("paused")
+                self._notify_main("paused")
 
         # keep the timeout going
         return GLib.SOURCE_CONTINUE
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import gi
+
+gi.require_version("Soup", "2.4")
+from gi.repository import GLib, Soup
+
+from collections import deque
+from fnmatch import fnmatchcase
+from html.parser import HTMLParser
+import logging
+import posixpath
+from typing import Callable, Deque, Dict, List, Sequence, Set, Tuple
+import urllib.parse
+
+from .utils import TransferThread
+from .utils.manifest import ManifestEntry, check_path
+
+logger = logging.getLogger(__name__)
+
+
+def is_directory_url(url: str) -> bool:
+    return urllib.parse.urlparse(url).path.endswith("/")
+
+
+def matches(relative_path: str, patterns: Sequence[str]) -> bool:
+    """Patterns containing a slash are matched against the path relative
+    to the crawled directory, all others against the name of the file or directory
+    """
+    name = posixpath.basename(relative_path.rstrip("/"))
+    for pattern in patterns:
+        if "/" in pattern.rstrip("/"):
+            if fnmatchcase(relative_path.rstrip("/"), pattern.strip("/")):
+                return True
+        elif fnmatchcase(name, pattern.rstrip("/")):
+            return True
+    return False
+
+
+class _LinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            for name, value in attrs:
+                if name == "href" and value:
+                    self.links.append(value)
+
+
+class IndexCrawler:
+    """Expands directory URLs into the files they contain, by crawling the
+    index pages generated by Apache, nginx and similar servers.
+
+    Only links below the directory that is crawled are followed. Excluded
+    subdirectories are never fetched. The files that are found are passed to
+    entries_callback page by page, and finished_callback is called with the
+    error messages once the crawl is complete. Both are called on the
+    main thread, while the requests run on the transfer thread.
+    """
+
+    def __init__(
+        self,
+        transfer_thread: TransferThread,
+        roots: Sequence[ManifestEntry],
+        entries_callback: Callable[[List[ManifestEntry]], None],
+        finished_callback: Callable[[List[str]], None],
+        include: Sequence[str] = (),
+        exclude: Sequence[str] = (),
+        max_requests: int = 8,
+        max_requests_per_host: int = 2,
+    ):
+        self._transfer_thread = transfer_thread
+        self._roots = roots
+        self._entries_callback = entries_callback
+        self._finished_callback = finished_callback
+        self._include = include
+        self._exclude = exclude
+        self._max_requests = max(max_requests, 1)
+        self._max_requests_per_host = max(max_requests_per_host, 1)
+
+        # directory url, root entry
+        self._pending: Deque[Tuple[str, ManifestEntry]] = deque()
+        self._visited: Set[str] = set()
+        self._requests: Dict[Soup.Message, str] = {}
+        self._requests_per_host: Dict[str, int] = {}
+        self._errors: List[str] = []
+        self._number_of_files: int = 0
+        self._stopped: bool = False
+
+    def start(self):
+        self._transfer_thread.invoke(self._start)
+
+    def stop(self):
+        self._transfer_thread.invoke(self._stop)
+
+    def _start(self):
+        for root in self._roots:
+            self._add_directory(root.url, root)
+        self._pump()
+
+    def _stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._pending.clear()
+        for message in list(self._requests):
+            self._transfer_thread.session.cancel_message(
+                message, Soup.Status.CANCELLED
+            )
+        self._finish()
+
+    def _finish(self):
+        logger.info(
+            f"Crawl found {self._number_of_files} files in {len(self._visited)} directories"
+        )
+        GLib.idle_add(self._finished_callback, self._errors)
+
+    def _add_directory(self, url: str, root: ManifestEntry):
+        url, _ = urllib.parse.urldefrag(url)
+        if url not in self._visited:
+            self._visited.add(url)
+            self._pending.append((url, root))
+
+    def _pump(self):
+        # start as many requests as the limits allow, skipping busy hosts
+        for _ in range(len(self._pending)):
+            if len(self._requests) >= self._max_requests:
+                break
+            url, root = self._pending.popleft()
+            host = urllib.parse.urlparse(url).netloc
+            if (
+                self._requests_per_host.get(host, 0)
+                >= self._max_requests_per_host
+            ):
+                self._pending.append((url, root))
+                continue
+            self._requests_per_host[host] = (
+                self._requests_per_host.get(host, 0) + 1
+            )
+            message = Soup.Message(method="GET", uri=Soup.URI.new(url))
+            self._requests[message] = host
+            logger.debug(f"Crawling {url}")
+            self._transfer_thread.session.queue_message(
+                message, self._queue_message_cb, (url, root)
+            )
+
+        if not self._requests and not self._pending and not self._stopped:
+            self._stopped = True
+            self._finish()
+
+    def _queue_message_cb(
+        self,
+        session: Soup.Session,
+        message: Soup.Message,
+        user_data: Tuple[str, ManifestEntry],
+    ):
+        url, root = user_data
+        host = self._requests.pop(message)
+        self._requests_per_host[host] -= 1
+        if self._stopped:
+            return
+
+        status_code = message.props.status_code
+        if 200 <= status_code < 300:
+            body = message.props.response_body.flatten().get_data()
+            self._parse_index(message.get_uri().to_string(False), body, root)
+        else:
+            self._errors.append(
+                f"Could not crawl {url}: {message.props.reason_phrase} ({status_code})"
+            )
+        self._pump()
+
+    def _parse_index(self, url: str, body: bytes, root: ManifestEntry):
+        parser = _LinkParser()
+        try:
+            parser.feed(body.decode("utf-8", errors="replace"))
+            parser.close()
+        except Exception as e:
+            self._errors.append(f"Could not parse the index page {url}: {e}")
+            return
+
+        root_url = urllib.parse.urlparse(root.url)
+        root_path = root_url.path
+        entries: List[ManifestEntry] = []
+        for link in parser.links:
+            # skip the column sorting links
+            if link.startswith(("?", "#")):
+                continue
+            link_url, _ = urllib.parse.urldefrag(
+                urllib.parse.urljoin(url, link)
+            )
+            parsed = urllib.parse.urlparse(link_url)
+            if parsed.query or parsed.netloc != root_url.netloc:
+                continue
+            # stay below the root, which also skips the parent directory link
+            if (
+                not parsed.path.startswith(root_path)
+                or parsed.path == root_path
+            ):
+                continue
+            relative_path = urllib.parse.unquote(parsed.path[len(root_path) :])
+            if matches(relative_path, self._exclude):
+                continue
+            if relative_path.endswith("/"):
+                self._add_directory(link_url, root)
+            elif not self._include or matches(relative_path, self._include):
+                if root.path:
+                    path = posixpath.join(root.path, relative_path)
+                else:
+                    path = urllib.parse.unquote(parsed.path.lstrip("/"))
+                try:
+                    path = check_path(path)
+                except ValueError as e:
+                    self._errors.append(f"Skipping {link_url}: {e}")
+                    continue
+                entries.append(
+                    ManifestEntry(
+                        url=link_url,
+                        path=path,
+                        priority=root.priority,
+                        metadata=root.metadata,
+                    )
+                )
+
+        if entries:
+            self._number_of_files += len(entries)
+            GLib.idle_add(self._entries_callback, entries)
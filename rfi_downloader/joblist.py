@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import gi
+
+gi.require_version("Gtk", "4.0")
+from gi.repository import Gtk, Gio, GLib, GObject
+
+from .urlobject import URLObject
+from .urlrow import URLRow
+from .utils import EXPAND_AND_FILL
+
+import logging
+from threading import Lock
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+STATE_QUEUED = "queued"
+STATE_ACTIVE = "active"
+STATE_PAUSED = "paused"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+# the states that have an index, queued downloads are only found under All
+INDEXED_STATES = (STATE_ACTIVE, STATE_PAUSED, STATE_FAILED, STATE_DONE)
+
+# label, state
+FILTERS = (
+    ("All", None),
+    ("Active", STATE_ACTIVE),
+    ("Paused", STATE_PAUSED),
+    ("Failed", STATE_FAILED),
+    ("Done", STATE_DONE),
+)
+
+
+def _size(url_object: URLObject) -> int:
+    if (size := url_object.get_expected_size()) >= 0:
+        return size
+    return url_object.get_filesize()
+
+
+# label, sort key or None for the order of the URLs file, refreshed
+SORTINGS = (
+    ("URLs file order", None, False),
+    ("Size", _size, False),
+    ("Speed", lambda url_object: url_object.get_speed(), True),
+    ("Progress", lambda url_object: url_object.props.progress, True),
+)
+
+# how often a sorting on a changing key is refreshed
+_RESORT_INTERVAL = 5  # seconds
+
+
+def job_state(url_object: URLObject) -> str:
+    if url_object.props.finished:
+        return STATE_FAILED if url_object.get_error_message() else STATE_DONE
+    if url_object.props.paused:
+        return STATE_PAUSED
+    if url_object.props.running:
+        return STATE_ACTIVE
+    return STATE_QUEUED
+
+
+class JobIndex(GObject.Object):
+    """Keeps a list model of the downloads in every state, next to the model
+    with all of them. The indexes are updated as downloads change state,
+    not on progress updates, and only the downloads that changed are visited,
+    so that switching between them is instant whatever the number of downloads.
+    """
+
+    __gsignals__ = {
+        # download, old state, new state
+        "state-changed": (
+            GObject.SignalFlags.RUN_FIRST,
+            None,
+            (URLObject, str, str),
+        ),
+    }
+
+    def __init__(self, model: Gio.ListStore):
+        GObject.Object.__init__(self)
+        self._model = model
+        self._stores: Dict[str, Gio.ListStore] = {
+            state: Gio.ListStore(item_type=URLObject)
+            for state in INDEXED_STATES
+        }
+        self._states: Dict[URLObject, str] = {}
+        self._handlers: Dict[URLObject, List[int]] = {}
+        self._pending: Set[URLObject] = set()
+        self._pending_lock = Lock()
+        model.connect("items-changed", self._items_changed_cb)
+
+    def get_model(self, state: Optional[str]) -> Gio.ListModel:
+        """The downloads in a state, or all of them if state is None"""
+        if state is None:
+            return self._model
+        return self._stores[state]
+
+    def get_count(self, state: Optional[str]) -> int:
+        return self.get_model(state).get_n_items()
+
+    def _items_changed_cb(
+        self, model: Gio.ListStore, position: int, removed: int, added: int
+    ):
+        if removed:
+            # only happens when starting over with another URLs file
+            self._clear()
+            position, added = 0, model.get_n_items()
+        added_by_state: Dict[str, List[URLObject]] = {}
+        for index in range(position, position + added):
+            url_object: URLObject = model.get_item(index)
+            state = job_state(url_object)
+            self._states[url_object] = state
+            self._handlers[url_object] = [
+                url_object.connect(f"notify::{name}", self._notify_cb)
+                for name in ("running", "paused", "finished")
+            ]
+            if state in self._stores:
+                added_by_state.setdefault(state, []).append(url_object)
+        for state, url_objects in added_by_state.items():
+            store = self._stores[state]
+            store.splice(store.get_n_items(), 0, url_objects)
+
+    def _clear(self):
+        for url_object, handler_ids in self._handlers.items():
+            for handler_id in handler_ids:
+                url_object.disconnect(handler_id)
+        self._handlers.clear()
+        self._states.clear()
+        with self._pending_lock:
+            self._pending.clear()
+        for store in self._stores.values():
+            store.remove_all()
+
+    def _notify_cb(self, url_object: URLObject, param):
+        # emitted on the transfer thread of the download
+        with self._pending_lock:
+            schedule = not self._pending
+            self._pending.add(url_object)
+        if schedule:
+            GLib.idle_add(self._update, priority=GLib.PRIORITY_DEFAULT_IDLE)
+
+    def _update(self):
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = set()
+        for url_object in pending:
+            old_state = self._states.get(url_object)
+            if old_state is None:
+                # removed in the meantime
+                continue
+            new_state = job_state(url_object)
+            if new_state == old_state:
+                continue
+            self._states[url_object] = new_state
+            if old_state in self._stores:
+                store = self._stores[old_state]
+                # downloads leave the small indexes: active and paused
+                found, position = store.find(url_object)
+                if found:
+                    store.remove(position)
+            if new_state in self._stores:
+                self._stores[new_state].append(url_object)
+            self.emit("state-changed", url_object, old_state, new_state)
+        return GLib.SOURCE_REMOVE
+
+
+class JobList(Gtk.Box):
+    """The list of downloads, with quick filters on their state,
+    a search on their path, and a choice of sorting.
+
+    Only the rows that are visible are created.
+    """
+
+    def __init__(self, index: JobIndex, **kwargs):
+        super().__init__(
+            orientation=Gtk.Orientation.VERTICAL,
+            spacing=5,
+            **EXPAND_AND_FILL,
+            **kwargs,
+        )
+        self._index = index
+        self._search_text: str = ""
+        self._sort_key = None
+        self._resort_source: Optional[int] = None
+
+        toolbar = Gtk.Box(
+            orientation=Gtk.Orientation.HORIZONTAL,
+            spacing=5,
+            halign=Gtk.Align.FILL,
+            valign=Gtk.Align.CENTER,
+            hexpand=True,
+            vexpand=False,
+        )
+        self.append(toolbar)
+
+        self._filter_dropdown = Gtk.DropDown.new_from_strings(
+            [label for label, _ in FILTERS]
+        )
+        self._filter_dropdown.connect(
+            "notify::selected", self._filter_selected_cb
+        )
+        toolbar.append(self._filter_dropdown)
+
+        search_entry = Gtk.SearchEntry(
+            placeholder_text="Search paths",
+            halign=Gtk.Align.FILL,
+            hexpand=True,
+        )
+        search_entry.connect("search-changed", self._search_changed_cb)
+        toolbar.append(search_entry)
+
+        toolbar.append(Gtk.Label(label="Sort by"))
+        self._sort_dropdown = Gtk.DropDown.new_from_strings(
+            [label for label, _, _ in SORTINGS]
+        )
+        self._sort_dropdown.connect("notify::selected", self._sort_selected_cb)
+        toolbar.append(self._sort_dropdown)
+
+        # the search filter and the sorter are only set while in use
+        self._filter = Gtk.CustomFilter.new(self._match_func, None)
+        self._filter_model = Gtk.FilterListModel(
+            model=index.get_model(None), incremental=True
+        )
+        self._sorter = Gtk.CustomSorter.new(self._sort_func, None)
+        self._sort_model = Gtk.SortListModel(
+            model=self._filter_model, incremental=True
+        )
+
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self._setup_cb)
+        factory.connect("bind", self._bind_cb)
+        factory.connect("unbind", self._unbind_cb)
+
+        list_view = Gtk.ListView(
+            model=Gtk.NoSelection(model=self._sort_model),
+            factory=factory,
+            **EXPAND_AND_FILL,
+        )
+        sw = Gtk.ScrolledWindow(**EXPAND_AND_FILL, has_frame=True)
+        sw.set_child(list_view)
+        self.append(sw)
+
+    def _setup_cb(self, factory, list_item: Gtk.ListItem):
+        list_item.set_child(URLRow())
+
+    def _bind_cb(self, factory, list_item: Gtk.ListItem):
+        list_item.get_child().bind(list_item.get_item())
+
+    def _unbind_cb(self, factory, list_item: Gtk.ListItem):
+        list_item.get_child().unbind()
+
+    def _filter_selected_cb(self, dropdown: Gtk.DropDown, param):
+        _, state = FILTERS[dropdown.props.selected]
+        # switching indexes, nothing is re-evaluated but the search
+        self._filter_model.set_model(self._index.get_model(state))
+
+    def _search_changed_cb(self, entry: Gtk.SearchEntry):
+        text = entry.get_text().strip().lower()
+        previous = self._search_text
+        self._search_text = text
+        if not text:
+            self._filter_model.set_filter(None)
+        elif self._filter_model.get_filter() is None:
+            self._filter_model.set_filter(self._filter)
+        elif previous in text:
+            self._filter.changed(Gtk.FilterChange.MORE_STRICT)
+        elif text in previous:
+            self._filter.changed(Gtk.FilterChange.LESS_STRICT)
+        else:
+            self._filter.changed(Gtk.FilterChange.DIFFERENT)
+
+    def _match_func(self, url_object: URLObject, *user_data) -> bool:
+        return self._search_text in url_object.props.relative_path.lower()
+
+    def _sort_selected_cb(self, dropdown: Gtk.DropDown, param):
+        _, self._sort_key, refresh = SORTINGS[dropdown.props.selected]
+        if self._resort_source is not None:
+            GLib.source_remove(self._resort_source)
+            self._resort_source = None
+        if self._sort_key is None:
+            self._sort_model.set_sorter(None)
+            return
+        if self._sort_model.get_sorter() is None:
+            self._sort_model.set_sorter(self._sorter)
+        else:
+            self._sorter.changed(Gtk.SorterChange.DIFFERENT)
+        if refresh:
+            # not on every progress update, which would resort all the time
+            self._resort_source = GLib.timeout_add_seconds(
+                _RESORT_INTERVAL, self._resort_cb
+            )
+
+    def _resort_cb(self):
+        self._sorter.changed(Gtk.SorterChange.DIFFERENT)
+        return GLib.SOURCE_CONTINUE
+
+    def _sort_func(self, a: URLObject, b: URLObject, *user_data) -> int:
+        # largest first
+        key_a, key_b = self._sort_key(a), self._sort_key(b)
+        if key_a > key_b:
+            return Gtk.Ordering.SMALLER
+        elif key_a < key_b:
+            return Gtk.Ordering.LARGER
+        return Gtk.Ordering.EQUAL
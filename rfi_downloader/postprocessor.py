@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from concurrent.futures import Future, ProcessPoolExecutor
+import logging
+import multiprocessing
+from threading import RLock
+from typing import Dict, Sequence
+
+from .urlobject import (
+    URLObject,
+    PROCESSING_CANCELLED,
+    PROCESSING_DONE,
+    PROCESSING_FAILED,
+    PROCESSING_QUEUED,
+)
+from .utils.metrics import PROCESSED_FILES, PROCESSING_PENDING
+from .utils.postprocessing import run_tasks
+
+logger = logging.getLogger(__name__)
+
+
+class PostProcessor:
+    """Runs post-processing tasks on downloaded files in a pool of worker
+    processes, so that CPU-heavy processing overlaps with the downloads.
+
+    The DownloadManager stops starting new downloads while the number of
+    files waiting to be processed is at max_pending.
+    """
+
+    def __init__(self, tasks: Sequence[str], workers: int, max_pending: int):
+        self._tasks = tuple(tasks)
+        self._max_pending = max(max_pending, 1)
+        self._lock = RLock()
+        self._futures: Dict[Future, URLObject] = {}
+        # spawn: forking a process with a running GTK main loop and threads is unsafe
+        self._executor = ProcessPoolExecutor(
+            max_workers=max(workers, 1),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    @property
+    def pending(self) -> int:
+        """The number of files that are queued or being processed"""
+        with self._lock:
+            return len(self._futures)
+
+    @property
+    def backlogged(self) -> bool:
+        return self.pending >= self._max_pending
+
+    def submit(self, url_object: URLObject):
+        url_object._set_processing_state(PROCESSING_QUEUED, "Processing...")
+        future = self._executor.submit(
+            run_tasks,
+            self._tasks,
+            url_object.props.filename,
+            url_object.get_metadata(),
+        )
+        with self._lock:
+            self._futures[future] = url_object
+            PROCESSING_PENDING.set(len(self._futures))
+        future.add_done_callback(self._done_cb)
+
+    def _done_cb(self, future: Future):
+        # called on a thread of the executor
+        with self._lock:
+            url_object = self._futures.pop(future)
+            PROCESSING_PENDING.set(len(self._futures))
+
+        if future.cancelled():
+            url_object._set_processing_state(
+                PROCESSING_CANCELLED, "Processing cancelled"
+            )
+            return
+
+        try:
+            messages = future.result()
+        except Exception as e:
+            logger.warning(
+                f"Processing {url_object.props.filename} failed: {e}"
+            )
+            PROCESSED_FILES.labels("failure").inc()
+            url_object._set_processing_state(
+                PROCESSING_FAILED, f"Processing failed: {e}"
+            )
+        else:
+            PROCESSED_FILES.labels("success").inc()
+            url_object._set_processing_state(
+                PROCESSING_DONE, "; ".join(messages) or "Processed"
+            )
+
+    def shutdown(self, cancel: bool = False):
+        """Stop the worker processes, after the pending files have been
+        processed, unless cancel is set"""
+        if cancel:
+            with self._lock:
+                futures = list(self._futures)
+            for future in futures:
+                future.cancel()
+        self._executor.shutdown(wait=not cancel)
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from gi.repository import Gio, GLib, GObject
+
+from .utils.s3 import MultipartUpload, make_client, parse_s3_url
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from threading import Lock
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# called with the opened stream, or the error
+CreateCallback = Callable[
+    [Optional[Gio.OutputStream], Optional[GLib.Error]], None
+]
+
+
+class StorageBackend(ABC):
+    """Where the downloads are written to.
+
+    A backend opens an output stream for every download, to which the
+    transfer writes asynchronously, and which is closed once the download
+    is finished. Only the local filesystem supports unpacking archives,
+    deduplication, the shared cache and post-processing.
+    """
+
+    # the files end up on the local filesystem, at their filename
+    local: bool = True
+
+    def location(self, filename: str, relative_path: str) -> str:
+        """Where a download ends up, for the logs and the report"""
+        return filename
+
+    @abstractmethod
+    def create_async(
+        self,
+        filename: str,
+        relative_path: str,
+        io_priority: int,
+        cancellable: Gio.Cancellable,
+        callback: CreateCallback,
+    ):
+        """Open a new output stream, replacing what was there before,
+        and call callback on the current thread"""
+
+    @abstractmethod
+    def rewind(self, outputstream: Gio.OutputStream, cancellable):
+        """Start over on a stream that was written to, raises GLib.Error"""
+
+    def abandon(self, outputstream: Gio.OutputStream):
+        """Mark the stream of a failed download, before it is closed"""
+
+
+class LocalStorage(StorageBackend):
+    def create_async(
+        self,
+        filename: str,
+        relative_path: str,
+        io_priority: int,
+        cancellable: Gio.Cancellable,
+        callback: CreateCallback,
+    ):
+        def _replace_async_cb(
+            gfile: Gio.File, result: Gio.AsyncResult, *user_data
+        ):
+            try:
+                outputstream = gfile.replace_finish(result)
+            except GLib.Error as e:
+                callback(None, e)
+                return
+            callback(outputstream, None)
+
+        Gio.File.new_for_path(filename).replace_async(
+            etag=None,
+            make_backup=False,
+            flags=Gio.FileCreateFlags.REPLACE_DESTINATION,
+            io_priority=io_priority,
+            cancellable=cancellable,
+            callback=_replace_async_cb,
+        )
+
+    def rewind(self, outputstream: Gio.FileOutputStream, cancellable):
+        outputstream.seek(0, GLib.SeekType.SET, cancellable)
+        outputstream.truncate(0, cancellable)
+
+    def abandon(self, outputstream: Gio.OutputStream):
+        # the partially written file is left behind, as it always was
+        pass
+
+
+local_storage = LocalStorage()
+
+
+def _io_error(e: Exception) -> GLib.Error:
+    return GLib.Error.new_literal(
+        Gio.io_error_quark(), str(e), Gio.IOErrorEnum.FAILED
+    )
+
+
+class S3OutputStream(Gio.OutputStream):
+    """Streams what is written to it to an object in S3.
+
+    Only the blocking virtual methods are implemented: GIO runs them on
+    its thread pool for the asynchronous operations, so the transfer
+    threads never wait for an upload.
+    """
+
+    def __init__(self, upload: MultipartUpload):
+        GObject.Object.__init__(self)
+        self._upload = upload
+        self._rewind: bool = False
+        self._abandoned: bool = False
+
+    def rewind(self):
+        # the parts that were uploaded are aborted with the next operation
+        self._rewind = True
+
+    def abandon(self):
+        self._abandoned = True
+
+    def _rewind_if_needed(self):
+        if self._rewind:
+            self._rewind = False
+            self._upload.abort()
+
+    def do_write_fn(self, buffer, cancellable) -> int:
+        try:
+            self._rewind_if_needed()
+            self._upload.write(bytes(buffer))
+        except Exception as e:
+            raise _io_error(e) from None
+        return len(buffer)
+
+    def do_close_fn(self, cancellable) -> bool:
+        if self._abandoned:
+            # no partial objects
+            self._upload.abort()
+            return True
+        try:
+            self._rewind_if_needed()
+            self._upload.complete()
+        except Exception as e:
+            self._upload.abort()
+            raise _io_error(e) from None
+        return True
+
+
+class S3Storage(StorageBackend):
+    """Streams the downloads to S3-compatible object storage, at
+    s3://bucket/prefix/relative_path, without touching the local disk.
+
+    Parts of part_size bytes are uploaded as they come in, up to
+    concurrency of them at a time, shared by all downloads.
+    """
+
+    local = False
+
+    def __init__(
+        self,
+        url: str,
+        endpoint_url: Optional[str] = None,
+        part_size: int = 8 * 1024**2,
+        concurrency: int = 4,
+    ):
+        self._bucket, self._prefix = parse_s3_url(url)
+        self._endpoint_url = endpoint_url
+        self._part_size = part_size
+        self._concurrency = max(concurrency, 1)
+        self._lock = Lock()
+        self._client = None
+        self._executor: ThreadPoolExecutor = None
+
+    def __getstate__(self):
+        # for the worker processes, which make a client of their own
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_client"] = None
+        state["_executor"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def _key(self, relative_path: str) -> str:
+        key = relative_path.replace("\\", "/")
+        return f"{self._prefix}/{key}" if self._prefix else key
+
+    def location(self, filename: str, relative_path: str) -> str:
+        return f"s3://{self._bucket}/{self._key(relative_path)}"
+
+    def _get_client(self):
+        # clients are thread-safe, and shared by all downloads
+        with self._lock:
+            if self._client is None:
+                self._client = make_client(self._endpoint_url)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._concurrency,
+                    thread_name_prefix="s3-upload",
+                )
+            return self._client
+
+    def create_async(
+        self,
+        filename: str,
+        relative_path: str,
+        io_priority: int,
+        cancellable: Gio.Cancellable,
+        callback: CreateCallback,
+    ):
+        # nothing is sent until the first part is complete
+        try:
+            client = self._get_client()
+        except ValueError as e:
+            callback(None, _io_error(e))
+            return
+        upload = MultipartUpload(
+            client,
+            self._bucket,
+            self._key(relative_path),
+            self._executor,
+            part_size=self._part_size,
+            max_pending=self._concurrency,
+        )
+        callback(S3OutputStream(upload), None)
+
+    def rewind(self, outputstream: S3OutputStream, cancellable):
+        outputstream.rewind()
+
+    def abandon(self, outputstream: S3OutputStream):
+        outputstream.abandon()
+
+
+def storage_from_options(options) -> StorageBackend:
+    """The backend chosen with --storage, the local filesystem by default"""
+    if not (url := options.get("storage")):
+        return local_storage
+    return S3Storage(
+        url,
+        endpoint_url=options.get("s3-endpoint"),
+        part_size=options.get("s3-part-size", 8) * 1024**2,
+        concurrency=options.get("s3-concurrency", 4),
+    )
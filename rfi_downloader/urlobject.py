@@ -6,23 +6,56 @@ gi.require_version("Soup", "2.4")
 from gi.repository import GObject, Soup, Gio, GLib
 from humanfriendly import format_timespan
 
+from functools import partial
 import logging
+import os
 import time
+import urllib.parse
 from threading import RLock
+from typing import Dict, Hashable, Optional, Sequence, Set
 
-from .utils import Session
+from .storage import StorageBackend, local_storage
+from .utils import TransferThread
+from .utils.metrics import (
+    BUFFERED_BYTES,
+    BYTES_TRANSFERRED,
+    CACHE_BYTES,
+    CACHE_REQUESTS,
+    DEDUPLICATED_BYTES,
+    DEDUPLICATED_FILES,
+    DOWNLOAD_DURATION,
+    FAILURES,
+    FILES_COMPLETED,
+    RESPONSE_LATENCY,
+    RETRIES,
+)
+from .utils.cache import CacheEntry, CacheWriter, SharedCache, is_cacheable
+from .utils.checksums import ChecksumVerifier
+from .utils.dedup import ContentStore, checksum_key, etag_key, link_or_copy
+from .utils.directories import directory_cache
+from .utils.memory import memory_budget
+from .utils.mirrors import mirror_selector
+from .utils.ratelimit import rate_limiter
+from .utils.stalls import StallDetector, StallPolicy
+from .utils.unpack import StreamUnpacker
 
 logger = logging.getLogger(__name__)
 
-# use a global session object
-session = Session()
-
 # read in blocks of 1MB
 block_size = 1024 * 1024
 
 # the minimum amount of time between successive progress property updates
 progress_notify_delta = 1  # seconds
 
+# the interruption of a download that is suspended by the schedule
+_SUSPENDED = "suspended"
+
+# states of the post-processing of a finished download
+PROCESSING_QUEUED = "queued"
+PROCESSING_DONE = "done"
+PROCESSING_FAILED = "failed"
+PROCESSING_CANCELLED = "cancelled"
+
 
 class URLObject(GObject.Object):
 
@@ -78,9 +111,36 @@ class URLObject(GObject.Object):
             False,
             GObject.ParamFlags.READABLE,  # flags
         ),
+        "processing": (
+            str,  # type
+            "processing",  # nick
+            "state of the post-processing, if any",  # blurb
+            None,
+            GObject.ParamFlags.READABLE,  # flags
+        ),
+        "priority": (
+            int,  # type
+            "priority",  # nick
+            "priority, higher is more urgent",  # blurb
+            -1000,  # min
+            1000,  # max
+            0,  # default
+            GObject.ParamFlags.READWRITE,  # flags
+        ),
     }
 
-    def __init__(self, url: str, filename: str, relative_path: str):
+    def __init__(
+        self,
+        url: str,
+        filename: str,
+        relative_path: str,
+        expected_size: int = -1,
+        priority: int = 0,
+        checksum: Optional[str] = None,
+        metadata: Optional[Dict[str, str]] = None,
+        mirrors: Sequence[str] = (),
+        extract: Optional[str] = None,
+    ):
         GObject.Object.__init__(self)
         self._progress: float = 0.0
         self._url: str = url
@@ -90,14 +150,74 @@ class URLObject(GObject.Object):
         self._paused: bool = False
         self._finished: bool = False
         self._error_message: str = None
+        self._error_class: str = None
         self._status_message: str = None
+        self._speed: float = 0.0
+        self._peak_speed: float = 0.0
+        # the number of requests that were sent
+        self._attempts: int = 0
+        self._processing: Optional[str] = None
+        self._processing_message: Optional[str] = None
         self._should_pause: bool = False
+        self._priority: int = priority
+        self._expected_size: int = expected_size
+        self._checksum: Optional[str] = checksum
+        self._metadata: Dict[str, str] = metadata or {}
+        self._mirrors: Sequence[str] = tuple(mirrors)
+        self._extract: Optional[str] = extract
+        # the url or mirror the current transfer comes from
+        self._current_url: str = url
+        self._failed_urls: Set[str] = set()
+        self._host: str = urllib.parse.urlparse(url).hostname or ""
+        self._start_time: float = None
+        self._finish_time: float = None
+        self._request_time: float = None
 
         self._inputstream: Gio.InputStream = None
         self._outputstream: Gio.FileOutputStream = None
         self._cancellable = Gio.Cancellable()
-        self._pause_main_loop: GLib.MainLoop = None
+        self._paused_read: tuple = None
         self._pause_lock = RLock()
+        # permits for a block from the memory budget
+        self._memory_held: bool = False
+        self._waiting_for_memory: bool = False
+        # seconds to wait for before the next read, to keep to the rate limit
+        self._throttle_delay: float = 0.0
+        self._throttle_source: GLib.Source = None
+        self._transfer_thread: TransferThread = None
+        self._worker_pool = None
+        self._filesize: int = 0
+        self._total_bytes_written: int = 0
+        self._verifier: Optional[ChecksumVerifier] = (
+            ChecksumVerifier(checksum) if checksum else None
+        )
+        # replaces the outputstream when unpacking while downloading
+        self._unpacker: StreamUnpacker = None
+
+        self._stall_policy = StallPolicy()
+        # the share of the rate limit that this download counts against
+        self._rate_session: Optional[Hashable] = None
+        self._stall_detector: StallDetector = None
+        self._stall_reason: Optional[str] = None
+        self._watchdog_source: GLib.Source = None
+        self._restarts: int = 0
+
+        self._small_file: bool = False
+        # the message of a small file transfer that is in flight
+        self._queued_message: Soup.Message = None
+        self._cancelled_handler: tuple = None
+        # the bytes of its body received so far, for the watchdog
+        self._small_file_received: int = 0
+
+        self._content_store: ContentStore = None
+        self._etag_key: Optional[str] = None
+
+        self._shared_cache: SharedCache = None
+        self._cache_entry: Optional[CacheEntry] = None
+        self._cache_writer: Optional[CacheWriter] = None
+        self._cache_failed: bool = False
+
+        self._storage: StorageBackend = local_storage
 
     def do_get_property(self, prop):
         py_prop_name: str = "_" + prop.name.replace("-", "_")
@@ -113,51 +233,686 @@ class URLObject(GObject.Object):
         else:
             raise AttributeError("unknown property %s" % prop.name)
 
+    @property
+    def transfer_thread(self) -> TransferThread:
+        """The thread all I/O for this download is dispatched on"""
+        return self._transfer_thread
+
+    @transfer_thread.setter
+    def transfer_thread(self, value: TransferThread):
+        self._transfer_thread = value
+
+    @property
+    def worker_pool(self):
+        """The WorkerPool this download is delegated to, if any"""
+        return self._worker_pool
+
+    @worker_pool.setter
+    def worker_pool(self, value):
+        self._worker_pool = value
+
+    @property
+    def stall_policy(self) -> StallPolicy:
+        """When this download is considered stalled, and restarted"""
+        return self._stall_policy
+
+    @stall_policy.setter
+    def stall_policy(self, value: StallPolicy):
+        self._stall_policy = value
+
+    @property
+    def rate_session(self) -> Optional[Hashable]:
+        """The session of the rate limiter that this download belongs to"""
+        return self._rate_session
+
+    @rate_session.setter
+    def rate_session(self, value: Optional[Hashable]):
+        self._rate_session = value
+
+    @property
+    def small_file(self) -> bool:
+        """If set, the response is buffered in memory and written in one go,
+        without progress updates in between"""
+        return self._small_file
+
+    @small_file.setter
+    def small_file(self, value: bool):
+        self._small_file = value
+
+    @property
+    def content_store(self) -> Optional[ContentStore]:
+        """The index of files on disk that identical downloads are copied from"""
+        return self._content_store
+
+    @content_store.setter
+    def content_store(self, value: Optional[ContentStore]):
+        self._content_store = value
+
+    @property
+    def shared_cache(self) -> Optional[SharedCache]:
+        """The cache directory that is consulted before downloading"""
+        return self._shared_cache
+
+    @shared_cache.setter
+    def shared_cache(self, value: Optional[SharedCache]):
+        self._shared_cache = value
+
+    @property
+    def storage(self) -> StorageBackend:
+        """Where the download is written to"""
+        return self._storage
+
+    @storage.setter
+    def storage(self, value: StorageBackend):
+        self._storage = value
+
+    def get_location(self) -> str:
+        """Where the download ends up, the filename unless in object storage"""
+        return self._storage.location(self._filename, self._relative_path)
+
+    def get_expected_size(self) -> int:
+        """The size announced by the URLs file, or -1 if unknown"""
+        return self._expected_size
+
+    def get_checksum(self) -> Optional[str]:
+        """The checksum announced by the URLs file, as algorithm:hexdigest"""
+        return self._checksum
+
+    def get_metadata(self) -> Dict[str, str]:
+        """The columns of the URLs file that have no meaning to the downloader"""
+        return self._metadata
+
+    def get_extract_format(self) -> Optional[str]:
+        """The archive format that is unpacked while downloading, if any"""
+        return self._extract
+
+    def get_mirrors(self) -> Sequence[str]:
+        """Alternative urls for this download, in order of preference"""
+        return self._mirrors
+
+    def get_current_url(self) -> str:
+        """The url or mirror the download is currently coming from"""
+        return self._current_url
+
+    def get_host(self) -> str:
+        return self._host
+
+    def _get_io_priority(self) -> int:
+        # higher priority maps onto a lower, i.e. more urgent, I/O priority
+        return max(
+            GLib.PRIORITY_HIGH,
+            min(GLib.PRIORITY_LOW, GLib.PRIORITY_DEFAULT - self._priority),
+        )
+
+    def _get_message_priority(self) -> Soup.MessagePriority:
+        if self._priority >= 100:
+            return Soup.MessagePriority.VERY_HIGH
+        elif self._priority > 0:
+            return Soup.MessagePriority.HIGH
+        elif self._priority <= -100:
+            return Soup.MessagePriority.VERY_LOW
+        elif self._priority < 0:
+            return Soup.MessagePriority.LOW
+        return Soup.MessagePriority.NORMAL
+
+    def get_bytes_written(self) -> int:
+        return self._total_bytes_written
+
+    def get_filesize(self) -> int:
+        return self._filesize
+
     def get_error_message(self) -> str:
         return self._error_message
 
+    def get_speed(self) -> float:
+        """The current speed in bytes/sec, updated with the progress"""
+        return self._speed
+
+    def get_peak_speed(self) -> float:
+        return self._peak_speed
+
+    def get_attempts(self) -> int:
+        return self._attempts
+
+    def get_restarts(self) -> int:
+        """The number of times the transfer was restarted after a stall"""
+        return self._restarts
+
+    def get_duration(self) -> Optional[float]:
+        """Seconds from the start of the download until it finished,
+        or until now, None if it was never started"""
+        if self._start_time is None:
+            return None
+        return (self._finish_time or time.monotonic()) - self._start_time
+
     def get_status_message(self) -> str:
         return self._status_message
 
+    def get_error_class(self) -> str:
+        return self._error_class
+
+    def get_processing_message(self) -> Optional[str]:
+        return self._processing_message
+
+    def _set_processing_state(self, state: str, message: str):
+        # called by the PostProcessor, from any thread
+        self._processing_message = message
+        self._processing = state
+        self.notify("processing")
+
+    def _set_error(self, error_class: str, message: str):
+        self._error_class = error_class
+        self._error_message = message
+
+    def _set_http_error(self, status_code: int):
+        if 400 <= status_code < 500:
+            error_class = "http_4xx"
+        elif 500 <= status_code < 600:
+            error_class = "http_5xx"
+        else:
+            error_class = "http_other"
+        self._set_error(
+            error_class,
+            f"{self._message.props.reason_phrase}: {status_code}",
+        )
+
+    def _set_error_from_gerror(self, error_class: str, e: GLib.Error):
+        if e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+            error_class = "cancelled"
+        self._set_error(error_class, e.message)
+
+    def _set_finished(self):
+        if self._error_message:
+            FAILURES.labels(self._host, self._error_class or "other").inc()
+        else:
+            FILES_COMPLETED.labels(self._host).inc()
+            DOWNLOAD_DURATION.labels(self._host).observe(
+                time.monotonic() - self._start_time
+            )
+            self._remember_content()
+        self._speed = 0.0
+        self._finish_time = time.monotonic()
+        # set both before notifying, so that a download that is no longer
+        # running is never mistaken for one that was interrupted
+        self._running = False
+        self._finished = True
+        self.notify("running")
+        self.notify("finished")
+
     def start(self):
         logger.debug(f"Starting {self._url}")
 
         with self._pause_lock:
             if self._paused:
                 logger.debug("Resuming download")
-                self._pause_main_loop.quit()
-                self._pause_main_loop = None
+                if self._worker_pool:
+                    # paused will be switched off by the worker process
+                    self._worker_pool.resume(self)
+                    return
                 self._paused = False
                 self.notify("paused")
+                # pick up where we left off, with the read that completed while pausing
+                self._transfer_thread.invoke(
+                    self._read_bytes_async_cb, *self._paused_read
+                )
+                self._paused_read = None
                 return
 
-        self._message = Soup.Message(method="GET", uri=Soup.URI.new(self._url))
-        session.send_async(
+        # set this straight away, so the scheduler doesn't start us twice
+        self._running = True
+        self.notify("running")
+        if self._worker_pool:
+            self._start_time = time.monotonic()
+            # the requests that are sent by the worker are not counted
+            self._attempts += 1
+            self._last_progress_update = time.time()
+            self._total_bytes_written_progress = 0
+            self._bytes_transferred_metric = BYTES_TRANSFERRED.labels(
+                self._host
+            )
+            self._worker_pool.submit(self)
+        else:
+            self._transfer_thread.invoke(self._start_transfer)
+
+    def copy_from(self, source: str):
+        """Finish this download with a local copy of source, which holds
+        the same content, instead of downloading it"""
+        self._running = True
+        self.notify("running")
+        self._transfer_thread.invoke(self._copy_from, source, False)
+
+    def _start_transfer(self):
+        if (
+            self._content_store
+            and self._checksum
+            and not self._extract
+            and not self._outputstream
+        ):
+            source = self._content_store.find(
+                [checksum_key(self._checksum)], exclude=self._filename
+            )
+            if source:
+                self._copy_from(source, True)
+                return
+        self._send_async()
+
+    def _copy_from(self, source: str, download_on_failure: bool):
+        if self._start_time is None:
+            self._start_time = time.monotonic()
+        if self._content_store:
+            materialize = self._content_store.materialize
+        else:
+            materialize = link_or_copy
+        try:
+            method = directory_cache.create_in(
+                self._filename, partial(materialize, source, self._filename)
+            )
+            size = os.path.getsize(self._filename)
+        except OSError as e:
+            if download_on_failure:
+                logger.warning(
+                    f"Could not copy {source} to {self._filename}, downloading it instead: {e}"
+                )
+                self._send_async()
+                return
+            self._set_error("filesystem", f"Could not copy {source}: {e}")
+            self._set_finished()
+            return
+
+        logger.info(f"{self._filename} is identical to {source} ({method})")
+        DEDUPLICATED_FILES.labels(method).inc()
+        DEDUPLICATED_BYTES.inc(size)
+        self._filesize = self._total_bytes_written = size
+        self._progress = 1.0
+        self._status_message = (
+            f"Identical to {os.path.basename(source)} ({method})"
+        )
+        self.notify("progress")
+        self._set_finished()
+
+    def _remember_content(self):
+        if not self._content_store or self._extract:
+            return
+        keys = [self._etag_key]
+        if self._checksum:
+            keys.append(checksum_key(self._checksum))
+        self._content_store.add(keys, self._filename)
+
+    def skip(self, status_message: str, error_message: Optional[str] = None):
+        """Mark this download as finished without ever starting it"""
+        logger.debug(f"Skipping {self._url}: {status_message}")
+        self._status_message = status_message
+        if error_message:
+            self._error_message = error_message
+        else:
+            self._progress = 1.0
+        self.notify("progress")
+        self._finished = True
+        self.notify("finished")
+
+    def _send_async(self):
+        candidates = [
+            url
+            for url in (self._url, *self._mirrors)
+            if url not in self._failed_urls
+        ] or [self._url, *self._mirrors]
+        self._current_url = mirror_selector.choose(candidates)
+        self._message = Soup.Message(
+            method="GET", uri=Soup.URI.new(self._current_url)
+        )
+        self._message.props.priority = self._get_message_priority()
+        if self._outputstream or self._unpacker:
+            # resume an interrupted transfer where it left off
+            self._message.props.request_headers.set_range(
+                self._total_bytes_written, -1
+            )
+            # the cache only gets complete responses
+            self._abort_cache_writer()
+        elif (
+            self._shared_cache and not self._extract and not self._cache_failed
+        ):
+            self._cache_entry = self._shared_cache.lookup(self._current_url)
+            if self._cache_entry:
+                self._add_conditional_headers(self._cache_entry)
+        self._request_time = time.monotonic()
+        self._attempts += 1
+        if self._start_time is None:
+            self._start_time = self._request_time
+        self._bytes_transferred_metric = BYTES_TRANSFERRED.labels(self._host)
+        self._small_file_received = 0
+        self._start_watchdog()
+        if self._small_file:
+            self._queue_message()
+            return
+        self._transfer_thread.session.send_async(
             msg=self._message,
             cancellable=self._cancellable,
             callback=self._send_async_cb,
         )
-        self._running = True
+
+    def _add_conditional_headers(self, entry: CacheEntry):
+        headers: Soup.MessageHeaders = self._message.props.request_headers
+        if entry.etag:
+            headers.append("If-None-Match", entry.etag)
+        if entry.last_modified:
+            headers.append("If-Modified-Since", entry.last_modified)
+
+    def _open_cache_writer(self, message: Soup.Message):
+        headers: Soup.MessageHeaders = message.props.response_headers
+        etag = headers.get_one("ETag")
+        last_modified = headers.get_one("Last-Modified")
+        if self._cache_entry:
+            CACHE_REQUESTS.labels("stale").inc()
+            self._cache_entry = None
+        else:
+            CACHE_REQUESTS.labels("miss").inc()
+        if not is_cacheable(
+            etag, last_modified, headers.get_one("Cache-Control")
+        ):
+            return
+        try:
+            self._cache_writer = self._shared_cache.writer(
+                self._current_url, etag, last_modified
+            )
+        except OSError as e:
+            logger.warning(
+                f"Could not add {self._current_url} to the cache: {e}"
+            )
+
+    def _write_cache(self, data: bytes):
+        try:
+            self._cache_writer.write(data)
+        except OSError as e:
+            # the download itself carries on
+            logger.warning(
+                f"Could not add {self._current_url} to the cache: {e}"
+            )
+            self._abort_cache_writer()
+
+    def _commit_cache_writer(self):
+        writer = self._cache_writer
+        self._cache_writer = None
+        try:
+            writer.commit(self._filesize)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Could not add {self._current_url} to the cache: {e}"
+            )
+
+    def _abort_cache_writer(self):
+        if self._cache_writer:
+            self._cache_writer.abort()
+            self._cache_writer = None
+
+    def _copy_from_cache(self):
+        entry = self._cache_entry
+        self._cache_entry = None
+        try:
+            method = directory_cache.create_in(
+                self._filename,
+                partial(self._shared_cache.materialize, entry, self._filename),
+            )
+        except OSError as e:
+            # e.g. evicted in the meantime
+            logger.warning(
+                f"Could not copy {self._current_url} from the cache, downloading it instead: {e}"
+            )
+            self._cache_failed = True
+            self._send_async()
+            return
+
+        logger.info(f"{self._filename} was copied from the cache ({method})")
+        CACHE_REQUESTS.labels("hit").inc()
+        CACHE_BYTES.inc(entry.size)
+        self._filesize = self._total_bytes_written = entry.size
+        self._progress = 1.0
+        self._status_message = f"Copied from the cache ({method})"
+        self.notify("progress")
+        self._set_finished()
+
+    def _queue_message(self):
+        # soup reads the whole body, and keeps the connection alive for the next one
+        message = self._message
+        self._queued_message = message
+        cancellable = self._cancellable
+        self._cancelled_handler = (
+            cancellable,
+            cancellable.connect("cancelled", self._cancelled_cb, message),
+        )
+        message.connect("got-chunk", self._got_chunk_cb)
+        self._transfer_thread.session.queue_message(
+            message, self._queue_message_cb, None
+        )
+        if cancellable.is_cancelled():
+            self._cancel_queued_message(message)
+
+    def _got_chunk_cb(self, message: Soup.Message, chunk: Soup.Buffer):
+        # emitted on the transfer thread, like the watchdog
+        if self._queued_message is message:
+            self._small_file_received += chunk.length
+
+    def _cancelled_cb(
+        self, cancellable: Gio.Cancellable, message: Soup.Message
+    ):
+        # this may be emitted on any thread
+        self._transfer_thread.invoke(self._cancel_queued_message, message)
+
+    def _cancel_queued_message(self, message: Soup.Message):
+        if self._queued_message is message:
+            self._transfer_thread.session.cancel_message(
+                message, Soup.Status.CANCELLED
+            )
+
+    def _queue_message_cb(
+        self, session: Soup.Session, message: Soup.Message, *user_data
+    ):
+        self._queued_message = None
+        cancellable, handler_id = self._cancelled_handler
+        cancellable.disconnect(handler_id)
+        self._cancelled_handler = None
+
+        status_code = message.props.status_code
+        if status_code == Soup.Status.CANCELLED:
+            self._set_error("cancelled", "Download cancelled")
+            self._abort()
+            return
+        elif status_code == Soup.Status.NOT_MODIFIED and self._cache_entry:
+            self._stop_watchdog()
+            self._copy_from_cache()
+            return
+        elif status_code < 100:
+            # libsoup reports transport errors as status codes
+            self._set_error("network", message.props.reason_phrase)
+            self._fail_over_or_abort()
+            return
+        elif status_code < 200 or status_code >= 300:
+            self._set_http_error(status_code)
+            self._fail_over_or_abort()
+            return
+
+        latency = time.monotonic() - self._request_time
+        RESPONSE_LATENCY.labels(self._host).observe(latency)
+        mirror_selector.record_latency(self._current_url, latency)
+
+        data = message.props.response_body.flatten().get_data()
+        if self._verifier:
+            self._verifier.update(data)
+        if self._shared_cache and not self._extract:
+            self._open_cache_writer(message)
+            if self._cache_writer:
+                self._write_cache(data)
+        # a single buffered write is cheaper than the async machinery
+        try:
+            with directory_cache.create_in(
+                self._filename, partial(open, self._filename, "wb")
+            ) as f:
+                f.write(data)
+        except OSError as e:
+            self._set_error("filesystem", str(e))
+            self._abort()
+            return
+
+        self._filesize = self._total_bytes_written = len(data)
+        self._bytes_transferred_metric.inc(len(data))
+        # counts against the rate limit, which holds back the other downloads
+        rate_limiter.consume(len(data), self._rate_session)
+        self._etag_key = self._get_etag_key(message)
+        if self._finish_output():
+            self._set_complete_progress()
+        self._abort()
+
+    def _start_watchdog(self):
+        if not self._stall_policy.enabled:
+            return
+        self._stall_detector = StallDetector(
+            self._stall_policy, time.monotonic(), self._stall_progress()
+        )
+        self._watchdog_source = self._transfer_thread.timeout_add_seconds(
+            1, self._watchdog_cb
+        )
+
+    def _stall_progress(self) -> int:
+        # small files are written once complete, until then their body
+        # counts as it comes in
+        return self._total_bytes_written + self._small_file_received
+
+    def _stop_watchdog(self):
+        if self._watchdog_source:
+            self._watchdog_source.destroy()
+            self._watchdog_source = None
+
+    def _watchdog_cb(self):
+        now = time.monotonic()
+        with self._pause_lock:
+            if (
+                self._paused
+                or self._should_pause
+                or self._waiting_for_memory
+                or self._throttle_source
+            ):
+                # a paused transfer is not stalled, nor one held back by us
+                self._stall_detector.reset(now, self._stall_progress())
+                return GLib.SOURCE_CONTINUE
+            reason = self._stall_detector.check(now, self._stall_progress())
+            if reason is None:
+                return GLib.SOURCE_CONTINUE
+            # the pending operation fails with G_IO_ERROR_CANCELLED,
+            # after which _abort takes care of the restart
+            logger.warning(
+                f"Transfer of {self._url} from {self._current_url} stalled: {reason}"
+            )
+            # prefer another mirror when restarting
+            mirror_selector.record_failure(self._current_url)
+            self._stall_reason = reason
+            self._watchdog_source = None
+            self._cancellable.cancel()
+        return GLib.SOURCE_REMOVE
+
+    def _interrupt(self, reason: str):
+        """Drop the connection of a stalled transfer, keeping the partially
+        written file, and give up the download slot until started again"""
+        suspended = reason == _SUSPENDED
+        if not suspended:
+            self._restarts += 1
+            RETRIES.labels(self._host).inc()
+        self._close_inputstream()
+
+        if self._restarts > self._stall_policy.max_restarts:
+            self._set_error(
+                "network",
+                f"Transfer stalled {self._restarts} times, last time because of {reason}",
+            )
+            self._abort()
+            return
+
+        # clear the cancellation error
+        self._error_class = None
+        self._error_message = None
+        if suspended:
+            logger.info(
+                f"Suspended {self._url} at byte {self._total_bytes_written}"
+            )
+            self._status_message = "Waiting for the next window of the schedule"
+        else:
+            logger.info(
+                f"Restarting {self._url} at byte {self._total_bytes_written} (attempt {self._restarts + 1})"
+            )
+            self._status_message = (
+                f"Stalled ({reason}), waiting to be restarted"
+            )
+        self.notify("progress")
+        self._running = False
         self.notify("running")
 
+    def _close_inputstream(self):
+        if self._inputstream:
+            self._inputstream.close_async(
+                io_priority=self._get_io_priority(),
+                cancellable=None,
+                callback=self._input_stream_close_async_cb,
+            )
+            self._inputstream = None
+
+    def _fail_over_or_abort(self):
+        """After a network or HTTP error, carry on with the next best mirror,
+        resuming where the failed one left off. Abort if there is none left."""
+        if self._error_class not in (
+            "network",
+            "http_4xx",
+            "http_5xx",
+            "http_other",
+        ):
+            self._abort()
+            return
+        if self._mirrors:
+            mirror_selector.record_failure(self._current_url)
+        self._failed_urls.add(self._current_url)
+        if all(url in self._failed_urls for url in (self._url, *self._mirrors)):
+            self._abort()
+            return
+
+        logger.warning(
+            f"Download from {self._current_url} failed ({self._error_message}), switching to another mirror"
+        )
+        RETRIES.labels(self._host).inc()
+        self._stop_watchdog()
+        self._close_inputstream()
+        self._error_class = None
+        self._error_message = None
+        self._send_async()
+
     def _abort(self):
+        self._stop_watchdog()
+        with self._pause_lock:
+            reason = self._stall_reason
+            self._stall_reason = None
+            if reason:
+                self._cancellable = Gio.Cancellable()
+        if reason:
+            self._interrupt(reason)
+            return
+
         if self._inputstream:
             self._inputstream.close_async(
-                io_priority=GLib.PRIORITY_DEFAULT,
+                io_priority=self._get_io_priority(),
                 cancellable=None,
                 callback=self._input_stream_close_async_cb,
             )
+        if self._unpacker:
+            # close the file that was being unpacked, if any
+            self._unpacker.abort()
+        self._abort_cache_writer()
+        self._release_memory()
         if self._outputstream:
+            if self._error_message:
+                self._storage.abandon(self._outputstream)
             self._outputstream.close_async(
-                io_priority=GLib.PRIORITY_DEFAULT,
+                io_priority=self._get_io_priority(),
                 cancellable=None,
                 callback=self._output_stream_close_async_cb,
             )
         else:
-            self._running = False
-            self.notify("running")
-            self._finished = True
-            self.notify("finished")
+            self._set_finished()
 
     def _input_stream_close_async_cb(
         self, inputstream: Gio.InputStream, result: Gio.AsyncResult, *user_data
@@ -180,12 +935,9 @@ class URLObject(GObject.Object):
             logger.warning(f"Error closing outputstream {e.message}")
             if self._error_message:
                 logger.warning(f"Previous error message: {self._error_message}")
-            self._error_message = e.message
+            self._set_error_from_gerror("filesystem", e)
 
-        self._running = False
-        self.notify("running")
-        self._finished = True
-        self.notify("finished")
+        self._set_finished()
 
     def _send_async_cb(
         self, session: Soup.Session, result: Gio.AsyncResult, *user_data
@@ -193,8 +945,20 @@ class URLObject(GObject.Object):
         try:
             self._inputstream = session.send_finish(result)
         except GLib.Error as e:
-            self._error_message = e.message
-            self._abort()
+            self._set_error_from_gerror("network", e)
+            self._fail_over_or_abort()
+            return
+
+        latency = time.monotonic() - self._request_time
+        RESPONSE_LATENCY.labels(self._host).observe(latency)
+
+        if (
+            self._message.props.status_code == Soup.Status.NOT_MODIFIED
+            and self._cache_entry
+        ):
+            self._stop_watchdog()
+            self._close_inputstream()
+            self._copy_from_cache()
             return
 
         # confirm that we didnt run into an HTTP error code
@@ -202,13 +966,30 @@ class URLObject(GObject.Object):
             self._message.props.status_code < 200
             or self._message.props.status_code >= 300
         ):
-            self._error_message = f"{self._message.props.reason_phrase}: {self._message.props.status_code}"
-            self._abort()
+            self._set_http_error(self._message.props.status_code)
+            self._fail_over_or_abort()
+            return
+
+        mirror_selector.record_latency(self._current_url, latency)
+
+        if self._outputstream or self._unpacker:
+            self._resume_transfer()
             return
 
         self._filesize = (
             self._message.props.response_headers.get_content_length()
         )
+        self._etag_key = self._get_etag_key(self._message)
+        if self._content_store and self._etag_key and not self._extract:
+            # the same content was downloaded before: skip the body
+            source = self._content_store.find(
+                [self._etag_key], exclude=self._filename
+            )
+            if source:
+                self._stop_watchdog()
+                self._close_inputstream()
+                self._copy_from(source, False)
+                return
         logger.debug(f"File size: {self._filesize} for {self._filename}")
 
         # Open the file for writing
@@ -217,45 +998,180 @@ class URLObject(GObject.Object):
         self._total_bytes_written_progress = (
             0  # used only for updating the progressbars
         )
-        gfile: Gio.File = Gio.File.new_for_path(self._filename)
+        # create the parent directories if necessary:
+        # usually they were created in bulk during the preflight check
+        if self._storage.local and (parent := os.path.dirname(self._filename)):
+            try:
+                directory_cache.ensure(parent)
+            except OSError as e:
+                self._set_error("filesystem", str(e))
+                self._abort()
+                return
 
-        # create the parent directories if necessary
-        parent: Gio.File = gfile.get_parent()
-        try:
-            if parent:
-                # there is no async variant of this method, otherwise I would have used it!
-                parent.make_directory_with_parents(
-                    cancellable=self._cancellable
+        if self._shared_cache and not self._extract:
+            self._open_cache_writer(self._message)
+
+        if self._extract:
+            if not self._storage.local:
+                self._set_error(
+                    "extraction",
+                    f"Cannot unpack into {self.get_location()}",
                 )
-        except GLib.Error as e:
-            if e.code != Gio.IOErrorEnum.EXISTS:
-                self._error_message = e.message
                 self._abort()
                 return
+            # the archive never touches the disk, only its contents do
+            try:
+                self._unpacker = StreamUnpacker(self._extract, self._filename)
+            except ValueError as e:
+                self._set_error("extraction", str(e))
+                self._abort()
+                return
+            self._read_async()
+            return
+
+        self._create_output(retry=True)
 
-        gfile.replace_async(
-            etag=None,
-            make_backup=False,
-            flags=Gio.FileCreateFlags.REPLACE_DESTINATION,
-            io_priority=GLib.PRIORITY_DEFAULT,
+    def _create_output(self, retry: bool):
+        self._storage.create_async(
+            self._filename,
+            self._relative_path,
+            io_priority=self._get_io_priority(),
             cancellable=self._cancellable,
-            callback=self._replace_async_cb,
+            callback=partial(self._create_async_cb, retry),
         )
 
-    def _replace_async_cb(
-        self, gfile: Gio.File, result: Gio.AsyncResult, *user_data
+    def _create_async_cb(
+        self,
+        retry: bool,
+        outputstream: Optional[Gio.OutputStream],
+        error: Optional[GLib.Error],
     ):
-        try:
-            self._outputstream = gfile.replace_finish(result)
-        except GLib.Error as e:
-            self._error_message = e.message
+        if (
+            error
+            and retry
+            and self._storage.local
+            and error.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND)
+            and (parent := os.path.dirname(self._filename))
+        ):
+            # the directory was removed behind our back
+            directory_cache.discard(parent)
+            try:
+                directory_cache.ensure(parent)
+            except OSError as e:
+                self._set_error("filesystem", str(e))
+                self._abort()
+                return
+            self._create_output(retry=False)
+            return
+        if error:
+            self._set_error_from_gerror("filesystem", error)
             self._abort()
             return
+        self._outputstream = outputstream
 
         # The file is now open for writing -> start copying data from the inputstream
+        self._read_async()
+
+    def _get_etag_key(self, message: Soup.Message) -> Optional[str]:
+        headers: Soup.MessageHeaders = message.props.response_headers
+        return etag_key(
+            self._current_url,
+            headers.get_one("ETag"),
+            headers.get_content_length(),
+        )
+
+    def _resume_transfer(self):
+        headers: Soup.MessageHeaders = self._message.props.response_headers
+        has_range, start, end, total = headers.get_content_range()
+        if (
+            self._message.props.status_code == Soup.Status.PARTIAL_CONTENT
+            and has_range
+            and start == self._total_bytes_written
+        ):
+            if total > 0:
+                self._filesize = total
+            else:
+                self._filesize = start + headers.get_content_length()
+            logger.debug(f"Resuming {self._filename} at byte {start}")
+        else:
+            # the server ignored the Range header: start over
+            logger.info(f"{self._url} cannot be resumed, starting over")
+            if self._unpacker:
+                self._unpacker.abort()
+                self._unpacker.reset()
+            else:
+                try:
+                    self._storage.rewind(self._outputstream, self._cancellable)
+                except GLib.Error as e:
+                    self._set_error_from_gerror("filesystem", e)
+                    self._abort()
+                    return
+            if self._verifier:
+                self._verifier.reset()
+            self._filesize = headers.get_content_length()
+            self._total_bytes_written = 0
+            self._total_bytes_written_progress = 0
+        self._read_async()
+
+    def _read_async(self):
+        if self._throttle_delay > 0:
+            # keep to the rate limit, without blocking the other downloads
+            # on this thread
+            with self._pause_lock:
+                self._throttle_source = self._transfer_thread.timeout_add(
+                    max(int(self._throttle_delay * 1000), 1),
+                    self._throttle_cb,
+                )
+            self._throttle_delay = 0.0
+            return
+        # wait for room in the memory budget while the writes are behind
+        with self._pause_lock:
+            self._waiting_for_memory = not memory_budget.acquire(
+                block_size, self._memory_granted_cb
+            )
+            if self._waiting_for_memory:
+                return
+        self._read_bytes()
+
+    def _throttle_cb(self):
+        with self._pause_lock:
+            if self._throttle_source is None:
+                # cut short in the meantime
+                return GLib.SOURCE_REMOVE
+            self._throttle_source = None
+        self._read_async()
+        return GLib.SOURCE_REMOVE
+
+    def _cut_throttle_short(self):
+        # let a transfer that waits for the rate limit
+        # run into the cancellable straight away
+        with self._pause_lock:
+            source, self._throttle_source = self._throttle_source, None
+        if source:
+            source.destroy()
+            self._transfer_thread.invoke(self._read_async)
+
+    def _memory_granted_cb(self):
+        # called on the thread that released the permits
+        self._transfer_thread.invoke(self._memory_granted)
+
+    def _memory_granted(self):
+        with self._pause_lock:
+            self._waiting_for_memory = False
+        self._read_bytes()
+
+    def _release_memory(self):
+        if self._memory_held:
+            self._memory_held = False
+            memory_budget.release(block_size)
+            BUFFERED_BYTES.set(memory_budget.in_use)
+
+    def _read_bytes(self):
+        self._memory_held = True
+        BUFFERED_BYTES.set(memory_budget.in_use)
         self._inputstream.read_bytes_async(
             count=block_size,
-            io_priority=GLib.PRIORITY_DEFAULT,
+            io_priority=self._get_io_priority(),
             cancellable=self._cancellable,
             callback=self._read_bytes_async_cb,
         )
@@ -265,55 +1181,85 @@ class URLObject(GObject.Object):
     ):
         with self._pause_lock:
             if self._should_pause:
-                self._pause_main_loop = GLib.MainLoop.new(None, False)
+                # hold on to the completed read until we are resumed,
+                # without blocking the other downloads on this thread
                 self._should_pause = False
                 self._paused = True
+                self._paused_read = (inputstream, result)
                 self.notify("paused")
-
-        # this has to be done outside the mutex as it will start a blocking loop
-        if self._pause_main_loop:
-            self._pause_main_loop.run()
+                return
 
         try:
             gbytes: GLib.Bytes = inputstream.read_bytes_finish(result)
         except GLib.Error as e:
-            self._error_message = e.message
-            self._abort()
+            self._release_memory()
+            self._set_error_from_gerror("network", e)
+            self._fail_over_or_abort()
             return
 
         if gbytes.get_size() == 0:
+            self._release_memory()
             # EOF -> download complete
             logger.info(f"No bytes returned for {self._filename}")
-            self._progress = 1.0
-            filesize_str = GLib.format_size(self._filesize)
-            self._status_message = f"{filesize_str} of {filesize_str}"
-            self.notify("progress")
+            if self._finish_output():
+                self._set_complete_progress()
             self._abort()
             return
+
+        self._throttle_delay = rate_limiter.consume(
+            gbytes.get_size(), self._rate_session
+        )
+        if self._verifier:
+            # over the bytes as they were sent, also when unpacking
+            self._verifier.update(gbytes.get_data())
+        if self._cache_writer:
+            self._write_cache(gbytes.get_data())
+
+        if self._unpacker:
+            try:
+                self._unpacker.write(gbytes.get_data())
+            except OSError as e:
+                self._set_error("filesystem", str(e))
+                self._abort()
+                return
+            except ValueError as e:
+                self._set_error("extraction", str(e))
+                self._abort()
+                return
+            self._release_memory()
+            self._bytes_written(gbytes.get_size())
+            self._read_async()
         else:
             # write bytes to file
             self._outputstream.write_bytes_async(
                 bytes=gbytes,
-                io_priority=GLib.PRIORITY_DEFAULT,
+                io_priority=self._get_io_priority(),
                 cancellable=self._cancellable,
                 callback=self._write_bytes_async_cb,
             )
 
-    def _write_bytes_async_cb(
-        self,
-        outputstream: Gio.OutputStream,
-        result: Gio.AsyncResult,
-        *user_data,
-    ):
-        try:
-            bytes_written = outputstream.write_bytes_finish(result)
-        except GLib.Error as e:
-            self._error_message = e.message
-            self._abort()
-            return
-
-        self._total_bytes_written += bytes_written
+    def _finish_output(self) -> bool:
+        """Check the download once it is complete, sets the error if not OK"""
+        if self._unpacker:
+            try:
+                self._unpacker.close()
+            except OSError as e:
+                self._set_error("filesystem", str(e))
+                return False
+            except ValueError as e:
+                self._set_error("extraction", str(e))
+                return False
+        if self._verifier:
+            try:
+                self._verifier.verify()
+            except ValueError as e:
+                self._set_error("checksum", str(e))
+                return False
+        if self._cache_writer:
+            self._commit_cache_writer()
+        return True
 
+    def _update_progress(self):
         now = time.time()
         current_delta = now - self._last_progress_update
 
@@ -322,44 +1268,183 @@ class URLObject(GObject.Object):
             speed = (
                 self._total_bytes_written - self._total_bytes_written_progress
             ) / current_delta  # bytes/sec
+            self._speed = speed
+            self._peak_speed = max(self._peak_speed, speed)
             self._total_bytes_written_progress = self._total_bytes_written
             remaining_bytes = self._filesize - self._total_bytes_written
-            remaining_time = remaining_bytes / speed  # sec
             self._status_message = (
                 f"{GLib.format_size_full(self._total_bytes_written, GLib.FormatSizeFlags.LONG_FORMAT)}"
                 + f" of {GLib.format_size(self._filesize)}"
-                + f" ({self._progress:.1%}, {GLib.format_size(speed)}/sec),"
-                + f" {format_timespan(remaining_time)} remaining"
+                + f" ({self._progress:.1%}, {GLib.format_size(speed)}/sec)"
             )
+            if not self._worker_pool:
+                mirror_selector.record_throughput(self._current_url, speed)
+            if speed > 0:
+                remaining_time = remaining_bytes / speed  # sec
+                self._status_message += (
+                    f", {format_timespan(remaining_time)} remaining"
+                )
             self._last_progress_update = now
             self.notify("progress")
 
+    def _set_complete_progress(self):
+        self._progress = 1.0
+        filesize_str = GLib.format_size(self._filesize)
+        self._status_message = f"{filesize_str} of {filesize_str}"
+        if self._unpacker:
+            self._status_message += f", {self._unpacker.files} files unpacked"
+        self.notify("progress")
+
+    def _write_bytes_async_cb(
+        self,
+        outputstream: Gio.OutputStream,
+        result: Gio.AsyncResult,
+        *user_data,
+    ):
+        self._release_memory()
+        try:
+            bytes_written = outputstream.write_bytes_finish(result)
+        except GLib.Error as e:
+            self._set_error_from_gerror("filesystem", e)
+            self._abort()
+            return
+
+        self._bytes_written(bytes_written)
+
         # read some more bytes
-        self._inputstream.read_bytes_async(
-            count=block_size,
-            io_priority=GLib.PRIORITY_DEFAULT,
-            cancellable=self._cancellable,
-            callback=self._read_bytes_async_cb,
-        )
+        self._read_async()
+
+    def _bytes_written(self, bytes_written: int):
+        self._total_bytes_written += bytes_written
+        self._bytes_transferred_metric.inc(bytes_written)
+        self._update_progress()
+
+    def _set_remote_progress(self, bytes_written: int, filesize: int):
+        # called by the WorkerPool with the state in its progress table
+        if bytes_written > self._total_bytes_written:
+            self._bytes_transferred_metric.inc(
+                bytes_written - self._total_bytes_written
+            )
+            self._total_bytes_written = bytes_written
+        self._filesize = filesize
+        self._update_progress()
+
+    def _set_remote_paused(self, paused: bool):
+        with self._pause_lock:
+            if paused == self._paused:
+                return
+            self._paused = paused
+            self.notify("paused")
+
+    def _set_remote_finished(
+        self, error_class: Optional[str], error_message: Optional[str]
+    ):
+        if error_message:
+            self._set_error(error_class, error_message)
+        else:
+            self._set_complete_progress()
+        self._paused = False
+        self._set_finished()
 
     def stop(self):
         logger.debug(f"Calling stop")
         if self._finished:
             return
+        if self._worker_pool:
+            if self._running:
+                self._worker_pool.cancel(self)
+            return
+        paused_read = None
         with self._pause_lock:
+            # a stop overrides a pending restart
+            self._stall_reason = None
+            if (
+                not self._running
+                and self._start_time is not None
+                and not self._error_message
+            ):
+                # interrupted after a stall, waiting to be restarted
+                self._set_error("cancelled", "Download cancelled")
+                self._transfer_thread.invoke(self._abort)
+                return
+            if self._waiting_for_memory and memory_budget.cancel(
+                self._memory_granted_cb
+            ):
+                # there is no pending operation to run into the cancellable
+                self._waiting_for_memory = False
+                self._set_error("cancelled", "Download cancelled")
+                self._transfer_thread.invoke(self._abort)
+                return
             if self._paused:
-                self._pause_main_loop.quit()
                 self._paused = (
                     False  # no need to bother with notifications at this point
                 )
+                paused_read = self._paused_read
+                self._paused_read = None
 
         if self._running:
             logger.debug(f"Cancelling")
             self._cancellable.cancel()
+            self._cut_throttle_short()
+
+        if paused_read:
+            # let the pending read run into the cancellable
+            self._transfer_thread.invoke(
+                self._read_bytes_async_cb, *paused_read
+            )
+
+    def suspend(self):
+        """Drop the connection, keeping the partially written file, and give
+        up the download slot until started again, like after a stall but
+        without counting as a restart. Paused downloads, and downloads in
+        a worker process, carry on."""
+        logger.debug(f"Calling suspend")
+        with self._pause_lock:
+            if (
+                not self._running
+                or self._paused
+                or self._should_pause
+                or self._worker_pool
+            ):
+                return
+        # on the transfer thread, in between the operations, like the watchdog
+        self._transfer_thread.invoke(self._suspend)
+
+    def _suspend(self):
+        with self._pause_lock:
+            if (
+                not self._running
+                or self._finished
+                or self._paused
+                or self._should_pause
+                or self._stall_reason
+            ):
+                return
+            self._stall_reason = _SUSPENDED
+            # there is no pending operation to run into the cancellable
+            waiting = self._waiting_for_memory and memory_budget.cancel(
+                self._memory_granted_cb
+            )
+            if waiting:
+                self._waiting_for_memory = False
+        if waiting:
+            self._abort()
+            return
+        # the pending operation fails with G_IO_ERROR_CANCELLED,
+        # after which _abort takes care of the interruption
+        self._stop_watchdog()
+        self._cancellable.cancel()
+        self._cut_throttle_short()
 
     def pause(self):
         logger.debug(f"Calling pause")
         with self._pause_lock:
             if self._paused or self._should_pause or not self._running:
                 return
+            if self._small_file and not self._worker_pool:
+                # there is nothing to hold on to: let it complete
+                return
+            if self._worker_pool:
+                self._worker_pool.pause(self)
+                return
             self._should_pause = True
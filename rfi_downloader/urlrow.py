@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import gi
+
+gi.require_version("Gtk", "4.0")
+from gi.repository import Gtk, Pango, GLib
+
+from .urlobject import URLObject, PROCESSING_FAILED, PROCESSING_QUEUED
+from .utils import EXPAND_AND_FILL, get_border_width
+
+import logging
+from threading import Lock
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_COLORS = ("orange", "red", "green")
+
+
+class URLRow(Gtk.Frame):
+    """Shows the state of a download in the job list.
+
+    Rows are recycled by the list view: they are bound to a download
+    while they are visible, and show its state from scratch when bound.
+    """
+
+    def __init__(self):
+        super().__init__(
+            **EXPAND_AND_FILL,
+            **get_border_width(2),
+            has_tooltip=True,
+        )
+
+        self._url_object: Optional[URLObject] = None
+        self._handler_id: Optional[int] = None
+        self._update_pending: bool = False
+        self._update_lock = Lock()
+
+        grid = Gtk.Grid(
+            **EXPAND_AND_FILL,
+            **get_border_width(2),
+            column_spacing=4,
+            row_spacing=2,
+        )
+        self.set_child(grid)
+
+        self._image: Gtk.Image = Gtk.Image(
+            icon_name="emblem-downloads",
+            icon_size=Gtk.IconSize.LARGE,
+            hexpand=False,
+            vexpand=True,
+            halign=Gtk.Align.START,
+            valign=Gtk.Align.CENTER,
+            name="color_image",
+        )
+        grid.attach(
+            self._image,
+            0,
+            0,
+            1,
+            3,
+        )
+
+        self._path_label = Gtk.Label(
+            use_markup=True,
+            ellipsize=Pango.EllipsizeMode.START,
+            halign=Gtk.Align.START,
+            valign=Gtk.Align.CENTER,
+            hexpand=True,
+            vexpand=False,
+        )
+        grid.attach(self._path_label, 1, 0, 1, 1)
+
+        self._progress_bar = Gtk.ProgressBar(
+            halign=Gtk.Align.FILL,
+            valign=Gtk.Align.CENTER,
+            hexpand=True,
+            vexpand=False,
+        )
+        grid.attach(self._progress_bar, 1, 1, 1, 1)
+
+        self._status_label = Gtk.Label(
+            use_markup=True,
+            ellipsize=Pango.EllipsizeMode.START,
+            halign=Gtk.Align.START,
+            valign=Gtk.Align.CENTER,
+            hexpand=True,
+            vexpand=False,
+        )
+        grid.attach(self._status_label, 1, 2, 1, 1)
+
+    def bind(self, url_object: URLObject):
+        self._url_object = url_object
+        self._path_label.props.label = (
+            f"<b>{GLib.markup_escape_text(url_object.props.relative_path)}</b>"
+        )
+        self._handler_id = url_object.connect("notify", self._notify_cb)
+        self._update()
+
+    def unbind(self):
+        if self._url_object is not None:
+            self._url_object.disconnect(self._handler_id)
+        self._url_object = None
+        self._handler_id = None
+
+    def _notify_cb(self, url_object: URLObject, param):
+        # This is emitted on the transfer thread of the download:
+        # coalesce all changes into a single update on the main thread.
+        with self._update_lock:
+            if self._update_pending:
+                return
+            self._update_pending = True
+        GLib.idle_add(self._update, priority=GLib.PRIORITY_DEFAULT_IDLE)
+
+    def _update(self):
+        with self._update_lock:
+            self._update_pending = False
+
+        url_object = self._url_object
+        if url_object is None:
+            # unbound in the meantime
+            return GLib.SOURCE_REMOVE
+
+        self._progress_bar.set_fraction(url_object.props.progress)
+        processing = url_object.props.processing
+        if processing:
+            if processing == PROCESSING_QUEUED:
+                self._set_color("orange")
+            elif processing == PROCESSING_FAILED:
+                self._set_color("red")
+            else:
+                self._set_color("green")
+            status = url_object.get_processing_message()
+        elif url_object.props.finished:
+            if url_object.get_error_message():
+                self._set_color("red")
+                status = "Download failed!"
+            else:
+                self._set_color("green")
+                status = url_object.get_status_message()
+        elif url_object.props.paused:
+            self._set_color("orange")
+            status = f"Paused at {url_object.props.progress:%} completed"
+        elif url_object.props.running:
+            self._set_color("orange")
+            status = url_object.get_status_message() or "Starting..."
+        else:
+            self._set_color(None)
+            status = url_object.get_status_message() or "Download not started"
+        self._status_label.props.label = status or ""
+
+        return GLib.SOURCE_REMOVE
+
+    def _set_color(self, color: Optional[str]):
+        for _color in _COLORS:
+            if _color == color:
+                self._image.add_css_class(_color)
+            else:
+                self._image.remove_css_class(_color)
+
+    def do_query_tooltip(self, x, y, keyboard_mode, tooltip: Gtk.Tooltip):
+        if self._url_object is None:
+            return False
+        if (error_msg := self._url_object.get_error_message()) is None:
+            return False
+
+        tooltip.set_icon_from_icon_name("network-error")
+        tooltip.set_text(error_msg)
+
+        return True
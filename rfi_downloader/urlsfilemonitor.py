@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from gi.repository import Gio
+
+import logging
+import os
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class URLsFileMonitor:
+    """Follows a URLs file that is being appended to.
+
+    Whenever the file changes, only the bytes following the offset
+    that was reached previously are read, and the complete lines among them
+    are handed to the callback. An incomplete last line is kept until
+    its newline has been written.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        offset: int,
+        callback: Callable[[List[str]], None],
+    ):
+        self._filename = filename
+        self._offset = offset
+        self._callback = callback
+        self._monitor: Gio.FileMonitor = None
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    def start(self):
+        gfile: Gio.File = Gio.File.new_for_path(self._filename)
+        self._monitor = gfile.monitor_file(Gio.FileMonitorFlags.NONE, None)
+        self._monitor.connect("changed", self._changed_cb)
+        # catch up with anything that was appended since the offset was determined
+        self._read_new_lines()
+
+    def stop(self):
+        if self._monitor:
+            self._monitor.cancel()
+            self._monitor = None
+
+    def _changed_cb(
+        self,
+        monitor: Gio.FileMonitor,
+        file: Gio.File,
+        other_file: Gio.File,
+        event_type: Gio.FileMonitorEvent,
+    ):
+        if event_type in (
+            Gio.FileMonitorEvent.CHANGED,
+            Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+            Gio.FileMonitorEvent.CREATED,
+        ):
+            self._read_new_lines()
+
+    def _read_new_lines(self):
+        try:
+            with open(self._filename, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self._offset:
+                    logger.warning(
+                        f"{self._filename} was truncated, reading it from the start"
+                    )
+                    self._offset = 0
+                f.seek(self._offset)
+                data = f.read()
+        except OSError as e:
+            logger.warning(f"Could not read {self._filename}: {e}")
+            return
+
+        # only consume complete lines
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return
+        self._offset += end
+
+        lines = [
+            line
+            for line in data[:end]
+            .decode("utf-8", errors="replace")
+            .splitlines()
+            if (stripped := line.strip()) and not stripped.startswith("#")
+        ]
+        if lines:
+            logger.debug(f"Read {len(lines)} new lines from {self._filename}")
+            self._callback(lines)
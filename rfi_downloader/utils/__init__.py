@@ -157,3 +157,84 @@ class Session(Soup.Session):
             else:
                 self.props.tls_database = db
                 self.props.ssl_use_system_ca_file = False
+
+
+class TransferThread(Thread):
+    """A thread running a GLib.MainLoop on its own GLib.MainContext.
+
+    The context is pushed as thread-default, so all Soup and Gio async
+    operations started from within this thread will have their callbacks
+    dispatched here too, and not on the GTK main thread.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name=name, daemon=True)
+        self._context = GLib.MainContext()
+        self._main_loop = GLib.MainLoop.new(self._context, False)
+        self._session = Session()
+
+    @property
+    def context(self) -> GLib.MainContext:
+        return self._context
+
+    @property
+    def session(self) -> Session:
+        return self._session
+
+    def run(self):
+        self._context.push_thread_default()
+        try:
+            self._main_loop.run()
+        finally:
+            self._context.pop_thread_default()
+
+    def quit(self):
+        self._main_loop.quit()
+
+    def is_current(self) -> bool:
+        return self._context.is_owner()
+
+    def invoke(
+        self,
+        callback: Callable[..., None],
+        *args,
+        priority: int = GLib.PRIORITY_DEFAULT,
+    ) -> GLib.Source:
+        """Run callback once with args in this thread"""
+
+        def _invoke_cb(*user_data):
+            callback(*args)
+            return GLib.SOURCE_REMOVE
+
+        source = GLib.Idle(priority)
+        source.set_callback(_invoke_cb)
+        source.attach(self._context)
+        return source
+
+    def timeout_add(
+        self, interval: int, callback: Callable[..., bool], *args
+    ) -> GLib.Source:
+        """Call callback with args every interval milliseconds in this thread,
+        until it returns GLib.SOURCE_REMOVE"""
+
+        def _timeout_cb(*user_data):
+            return callback(*args)
+
+        source = GLib.Timeout(interval)
+        source.set_callback(_timeout_cb)
+        source.attach(self._context)
+        return source
+
+    def timeout_add_seconds(
+        self, interval: int, callback: Callable[..., bool], *args
+    ) -> GLib.Source:
+        """Call callback with args every interval seconds in this thread,
+        until it returns GLib.SOURCE_REMOVE"""
+
+        def _timeout_cb(*user_data):
+            return callback(*args)
+
+        source = GLib.timeout_source_new_seconds(interval)
+        source.set_callback(_timeout_cb)
+        source.attach(self._context)
+        return source
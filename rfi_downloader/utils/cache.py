@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Iterator, NamedTuple, Optional, Union
+import uuid
+
+from .dedup import LINK_MODES, LINK_REFLINK, link_or_copy
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# after an eviction, the cache is trimmed to this fraction of its budget
+_LOW_WATERMARK = 0.9
+# temporary files of processes that died are removed after this many seconds
+_STALE_TEMPORARY_AGE = 24 * 3600
+
+
+def _make_shared_directory(path: Path):
+    """Create a directory that all users of the cache can add to and evict
+    from. The setgid bit hands its group down to what is added to it."""
+    try:
+        path.mkdir()
+    except FileExistsError:
+        return
+    # mkdir applies the umask
+    os.chmod(path, 0o2777)
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    path: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    size: int
+
+
+def is_cacheable(
+    etag: Optional[str],
+    last_modified: Optional[str],
+    cache_control: Optional[str],
+) -> bool:
+    """Only responses that can be revalidated are cached"""
+    if cache_control and any(
+        directive.strip().lower() in ("no-store", "private")
+        for directive in cache_control.split(",")
+    ):
+        return False
+    return bool(etag or last_modified)
+
+
+class CacheWriter:
+    """Fills a cache entry while the download comes in.
+
+    The entry only becomes visible to other processes on commit.
+    """
+
+    def __init__(
+        self,
+        cache: SharedCache,
+        url: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+    ):
+        self._cache = cache
+        self._url = url
+        self._etag = etag
+        self._last_modified = last_modified
+        self._size = 0
+        self._path = os.path.join(
+            cache.directory, "tmp", f"{uuid.uuid4().hex}.{os.getpid()}"
+        )
+        fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self._size += len(data)
+
+    def commit(self, expected_size: int = -1):
+        """Publish the entry, unless its size is not the expected one"""
+        self._file.close()
+        if expected_size >= 0 and expected_size != self._size:
+            self.abort()
+            raise ValueError(
+                f"expected {expected_size} bytes, received {self._size}"
+            )
+        try:
+            self._cache._commit(
+                self._path,
+                CacheEntry(
+                    self._url, "", self._etag, self._last_modified, self._size
+                ),
+            )
+        except OSError:
+            self.abort()
+            raise
+
+    def abort(self):
+        self._file.close()
+        for path in (self._path, f"{self._path}.json"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class SharedCache:
+    """A cache directory that is shared by several users and processes,
+    keyed by URL, and revalidated with conditional requests.
+
+    Entries are evicted in least recently used order once the cache grows
+    beyond max_size bytes. File locks keep entries from being evicted
+    while they are copied, and readers from seeing half-written entries.
+    """
+
+    def __init__(
+        self,
+        directory: Union[os.PathLike, str],
+        max_size: int,
+        link_mode: str = LINK_REFLINK,
+    ):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {link_mode}")
+        self._directory = Path(directory)
+        self._max_size = max_size
+        self._link_mode = link_mode
+        # the size of the cache is only measured now and then
+        self._size_estimate: Optional[int] = None
+        self._directory.parent.mkdir(parents=True, exist_ok=True)
+        _make_shared_directory(self._directory)
+        for subdirectory in ("objects", "tmp"):
+            _make_shared_directory(self._directory / subdirectory)
+        lock = self._directory / "lock"
+        try:
+            os.close(os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            pass
+        else:
+            # writable by all, for the exclusive locks on NFS
+            os.chmod(lock, 0o666)
+
+    def __getstate__(self):
+        # sent to worker processes, which keep their own estimate
+        return (self._directory, self._max_size, self._link_mode)
+
+    def __setstate__(self, state):
+        self._directory, self._max_size, self._link_mode = state
+        self._size_estimate = None
+
+    @property
+    def directory(self) -> str:
+        return str(self._directory)
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        path = self._directory / "lock"
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        except PermissionError:
+            # made by another user before it was shared: flock takes
+            # any lock through a read-only file, except on NFS
+            fd = os.open(path, os.O_RDONLY)
+        with os.fdopen(fd, "rb") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _paths(self, url: str):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        data = self._directory / "objects" / digest[:2] / digest
+        return data, data.with_name(f"{digest}.json")
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """The entry for url, if there is a complete one"""
+        data, metadata = self._paths(url)
+        try:
+            with self._locked(exclusive=False):
+                with open(metadata) as f:
+                    fields = json.load(f)
+                size = os.path.getsize(data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the cache entry of {url}: {e}")
+            return None
+        if fields.get("url") != url or fields.get("size") != size:
+            return None
+        return CacheEntry(
+            url,
+            str(data),
+            fields.get("etag"),
+            fields.get("last_modified"),
+            size,
+        )
+
+    def materialize(self, entry: CacheEntry, destination: str) -> str:
+        """Copy an entry to destination, and mark it as recently used.
+
+        Returns the method that was used, see link_or_copy.
+        Raises OSError if the entry is gone or cannot be copied.
+        """
+        _, metadata = self._paths(entry.url)
+        with self._locked(exclusive=False):
+            method = link_or_copy(entry.path, destination, self._link_mode)
+            try:
+                os.utime(metadata)
+            except OSError:
+                # owned by another user, it may be evicted a bit too early
+                pass
+        return method
+
+    def writer(
+        self, url: str, etag: Optional[str], last_modified: Optional[str]
+    ) -> CacheWriter:
+        """Start a new entry, raises OSError if that is not possible"""
+        return CacheWriter(self, url, etag, last_modified)
+
+    def _commit(self, temporary: str, entry: CacheEntry):
+        data, metadata = self._paths(entry.url)
+        _make_shared_directory(data.parent)
+        fields = {
+            "url": entry.url,
+            "etag": entry.etag,
+            "last_modified": entry.last_modified,
+            "size": entry.size,
+            "added": time.time(),
+        }
+        metadata_temporary = f"{temporary}.json"
+        with open(metadata_temporary, "w") as f:
+            json.dump(fields, f)
+        with self._locked(exclusive=True):
+            os.replace(temporary, data)
+            os.replace(metadata_temporary, metadata)
+
+        if self._size_estimate is not None:
+            self._size_estimate += entry.size
+        if self._size_estimate is None or self._size_estimate > self._max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries, until the cache is
+        within its budget"""
+        with self._locked(exclusive=True):
+            entries = []
+            total = 0
+            for metadata in (self._directory / "objects").glob("*/*.json"):
+                data = metadata.with_suffix("")
+                try:
+                    last_used = metadata.stat().st_mtime
+                    size = data.stat().st_size
+                except FileNotFoundError:
+                    # a leftover of an interrupted eviction
+                    self._remove(metadata, data)
+                    continue
+                entries.append((last_used, size, metadata, data))
+                total += size
+
+            if total > self._max_size:
+                entries.sort(key=lambda entry: entry[0])
+                target = self._max_size * _LOW_WATERMARK
+                for _, size, metadata, data in entries:
+                    if total <= target:
+                        break
+                    if self._remove(metadata, data):
+                        total -= size
+                logger.info(
+                    f"Evicted cache entries, {total} bytes left in {self._directory}"
+                )
+            self._size_estimate = total
+
+            now = time.time()
+            for temporary in (self._directory / "tmp").iterdir():
+                try:
+                    if now - temporary.stat().st_mtime > _STALE_TEMPORARY_AGE:
+                        temporary.unlink()
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _remove(metadata: Path, data: Path) -> bool:
+        try:
+            # metadata first, so that a half-removed entry is never found
+            metadata.unlink(missing_ok=True)
+            data.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Could not evict {data}: {e}")
+            return False
+        return True
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Tuple
+
+
+def parse_checksum(checksum: str) -> Tuple[str, str]:
+    """Split algorithm:hexdigest into its lowercase parts.
+
+    Raises ValueError if the format or the algorithm is not supported.
+    """
+    algorithm, sep, digest = checksum.strip().partition(":")
+    algorithm = algorithm.strip().lower()
+    digest = digest.strip().lower()
+    if not sep or not algorithm or not digest:
+        raise ValueError("expected algorithm:hexdigest")
+    # shake digests have a variable length
+    if algorithm not in hashlib.algorithms_available or algorithm.startswith(
+        "shake"
+    ):
+        raise ValueError(f"unsupported algorithm {algorithm}")
+    try:
+        bytes.fromhex(digest)
+    except ValueError:
+        raise ValueError(f"{digest} is not a hexadecimal digest") from None
+    return algorithm, digest
+
+
+class ChecksumVerifier:
+    """Computes the checksum of a download while its bytes come in"""
+
+    def __init__(self, checksum: str):
+        self._algorithm, self._expected = parse_checksum(checksum)
+        self._hash = hashlib.new(self._algorithm)
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+
+    def reset(self):
+        self._hash = hashlib.new(self._algorithm)
+
+    def verify(self):
+        """Raises ValueError if the checksum does not match"""
+        actual = self._hash.hexdigest()
+        if actual != self._expected:
+            raise ValueError(
+                f"{self._algorithm} checksum mismatch: expected {self._expected}, got {actual}"
+            )
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import logging
+import math
+from typing import Optional
+
+from .metrics import CONCURRENCY_ADJUSTMENTS, CONCURRENCY_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+class AIMDController:
+    """Tunes the number of simultaneous downloads to the measured throughput.
+
+    Every interval, the aggregate throughput, the throughput per stream and
+    the number of transient failures are compared with the previous interval:
+
+    * failures: multiplicative decrease of the limit
+    * per-stream throughput collapsed without a gain in aggregate throughput:
+      multiplicative decrease, the server or the disk is saturated
+    * aggregate throughput improved while all slots were in use:
+      additive increase, probe for more
+    * no improvement after an increase: undo the increase, and hold for a
+      while before probing again
+
+    The limit always stays between minimum and maximum.
+    """
+
+    def __init__(
+        self,
+        minimum: int = 1,
+        maximum: int = 16,
+        initial: Optional[int] = None,
+        interval: float = 5.0,
+        increase: int = 1,
+        decrease: float = 0.5,
+        gain_threshold: float = 0.05,
+        collapse_threshold: float = 0.5,
+        hold_intervals: int = 6,
+    ):
+        if minimum < 1 or maximum < minimum:
+            raise ValueError(f"Invalid limits {minimum} - {maximum}")
+        self._minimum = minimum
+        self._maximum = maximum
+        self._limit = min(max(initial or minimum, minimum), maximum)
+        self._interval = interval
+        self._increase = increase
+        self._decrease = decrease
+        self._gain_threshold = gain_threshold
+        self._collapse_threshold = collapse_threshold
+        self._hold_intervals = hold_intervals
+
+        self._sample_time: Optional[float] = None
+        self._sample_bytes: int = 0
+        self._sample_failures: int = 0
+        self._previous_throughput: Optional[float] = None
+        self._previous_per_stream: Optional[float] = None
+        self._increased: bool = False
+        self._hold: int = 0
+        CONCURRENCY_LIMIT.set(self._limit)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def reset(self):
+        """Forget the samples taken so far, e.g. after a pause"""
+        self._sample_time = None
+        self._previous_throughput = None
+        self._previous_per_stream = None
+        self._increased = False
+
+    def _set_limit(self, limit: int, reason: str):
+        limit = min(max(limit, self._minimum), self._maximum)
+        if limit == self._limit:
+            return
+        direction = "up" if limit > self._limit else "down"
+        logger.info(
+            f"Adjusting number of simultaneous downloads from {self._limit} to {limit}: {reason}"
+        )
+        CONCURRENCY_ADJUSTMENTS.labels(direction).inc()
+        CONCURRENCY_LIMIT.set(limit)
+        self._limit = limit
+
+    def _decrease_limit(self, reason: str):
+        self._set_limit(math.floor(self._limit * self._decrease), reason)
+        self._increased = False
+        self._hold = self._hold_intervals
+
+    def update(
+        self,
+        now: float,
+        bytes_transferred: int,
+        failures: int,
+        active: int,
+        queued: int,
+    ) -> int:
+        """Feed the running totals of bytes transferred and transient
+        failures, and the current number of active and queued downloads.
+        Returns the new limit."""
+        if self._sample_time is None:
+            self._sample_time = now
+            self._sample_bytes = bytes_transferred
+            self._sample_failures = failures
+            return self._limit
+
+        elapsed = now - self._sample_time
+        if elapsed < self._interval:
+            return self._limit
+
+        # restarted downloads may make the total go down
+        throughput = max(bytes_transferred - self._sample_bytes, 0) / elapsed
+        new_failures = failures - self._sample_failures
+        per_stream = throughput / active if active else None
+        previous_throughput = self._previous_throughput
+        previous_per_stream = self._previous_per_stream
+
+        self._sample_time = now
+        self._sample_bytes = bytes_transferred
+        self._sample_failures = failures
+        self._previous_throughput = throughput
+        self._previous_per_stream = per_stream
+        if self._hold:
+            self._hold -= 1
+
+        logger.debug(
+            f"Throughput {throughput:.0f} B/s over {active} streams, {new_failures} failures, limit {self._limit}"
+        )
+
+        if new_failures > 0:
+            self._decrease_limit(f"{new_failures} transient failures")
+        elif previous_throughput is None or active == 0:
+            pass
+        elif (
+            per_stream is not None
+            and previous_per_stream
+            and per_stream < previous_per_stream * self._collapse_threshold
+            and throughput < previous_throughput * (1 + self._gain_threshold)
+        ):
+            self._decrease_limit(
+                f"throughput per stream fell from {previous_per_stream:.0f} to {per_stream:.0f} B/s"
+            )
+        elif self._increased and throughput < previous_throughput * (
+            1 + self._gain_threshold
+        ):
+            self._set_limit(
+                self._limit - self._increase,
+                f"no gain in throughput ({throughput:.0f} B/s)",
+            )
+            self._increased = False
+            self._hold = self._hold_intervals
+        elif self._hold == 0 and active >= self._limit and queued > 0:
+            # only probe when the current slots are all in use
+            self._increased = self._limit < self._maximum
+            self._set_limit(
+                self._limit + self._increase,
+                f"probing for more throughput ({throughput:.0f} B/s)",
+            )
+        else:
+            self._increased = False
+
+        return self._limit
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import errno
+import logging
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import sys
+from threading import RLock
+import time
+from typing import Iterator, List, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+LINK_AUTO = "auto"
+LINK_REFLINK = "reflink"
+LINK_HARDLINK = "hardlink"
+LINK_COPY = "copy"
+LINK_MODES = (LINK_AUTO, LINK_REFLINK, LINK_HARDLINK, LINK_COPY)
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    added REAL NOT NULL,
+    PRIMARY KEY (key, path)
+);
+"""
+
+
+def checksum_key(checksum: str) -> str:
+    return f"checksum:{checksum.lower()}"
+
+
+def etag_key(url: str, etag: str, size: int) -> Optional[str]:
+    """ETags only identify versions of a single resource: servers derive
+    them from e.g. the modification time and the size, which different files
+    share all the time, so they are never compared across urls. Only strong
+    ones are used, as weak ETags do not promise identical bytes."""
+    if not etag or etag.startswith("W/") or size < 0:
+        return None
+    return f"etag:{url}:{etag}:{size}"
+
+
+def _reflink(source: str, destination: str):
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are only supported on Linux")
+    import fcntl
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def link_or_copy(source: str, destination: str, mode: str = LINK_AUTO) -> str:
+    """Make destination a copy of source, as cheaply as the mode and the
+    filesystem allow. The destination is replaced atomically.
+
+    Returns the method that was used: reflink, hardlink or copy.
+    Raises OSError if all of them fail.
+    """
+    if mode == LINK_AUTO:
+        methods = (LINK_REFLINK, LINK_HARDLINK, LINK_COPY)
+    elif mode == LINK_COPY:
+        methods = (LINK_COPY,)
+    else:
+        methods = (mode, LINK_COPY)
+
+    temporary = os.path.join(
+        os.path.dirname(destination) or ".",
+        f".{os.path.basename(destination)}.{os.getpid()}.dedup",
+    )
+    for method in methods:
+        try:
+            if method == LINK_REFLINK:
+                _reflink(source, temporary)
+            elif method == LINK_HARDLINK:
+                os.link(source, temporary)
+            else:
+                shutil.copyfile(source, temporary)
+            os.replace(temporary, destination)
+            return method
+        except OSError as e:
+            try:
+                os.unlink(temporary)
+            except FileNotFoundError:
+                pass
+            if method == methods[-1]:
+                raise
+            # e.g. EXDEV across filesystems, or EOPNOTSUPP
+            logger.debug(f"Could not {method} {source}: {e}")
+
+
+class ContentStore:
+    """A persistent index of downloaded files, by checksum and ETag,
+    so that files whose content is already on disk need not be downloaded again.
+
+    Files that were changed or removed since they were added are ignored
+    and forgotten. The index is shared by the transfer threads.
+    """
+
+    def __init__(
+        self, path: Union[os.PathLike, str], link_mode: str = LINK_AUTO
+    ):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {link_mode}")
+        self._path = Path(path)
+        self._link_mode = link_mode
+        self._lock = RLock()
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(
+            str(self._path),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+
+    @property
+    def link_mode(self) -> str:
+        return self._link_mode
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    yield cursor
+                except BaseException:
+                    cursor.execute("ROLLBACK")
+                    raise
+                else:
+                    cursor.execute("COMMIT")
+            finally:
+                cursor.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def find(
+        self, keys: Sequence[str], exclude: Optional[str] = None
+    ) -> Optional[str]:
+        """A file that matches one of the keys, and is unchanged since it was
+        added, other than exclude"""
+        keys = [key for key in keys if key]
+        if not keys:
+            return None
+        try:
+            return self._find(keys, exclude)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not search the content index: {e}")
+            return None
+
+    def _find(self, keys: List[str], exclude: Optional[str]) -> Optional[str]:
+        excluded = os.path.abspath(exclude) if exclude else None
+        with self._transaction() as cursor:
+            rows = cursor.execute(
+                f"SELECT key, path, size, mtime_ns FROM files WHERE key IN ({','.join('?' * len(keys))})",
+                keys,
+            ).fetchall()
+            for key, path, size, mtime_ns in rows:
+                if path == excluded:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    stat = None
+                if (
+                    stat
+                    and stat.st_size == size
+                    and stat.st_mtime_ns == mtime_ns
+                ):
+                    return path
+                cursor.execute(
+                    "DELETE FROM files WHERE key = ? AND path = ?", (key, path)
+                )
+        return None
+
+    def add(self, keys: Sequence[str], path: str):
+        """Record that the file at path has the content identified by keys"""
+        keys = [key for key in keys if key]
+        if not keys:
+            return
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            logger.warning(f"Could not add {path} to the content index: {e}")
+            return
+        now = time.time()
+        try:
+            self._add(keys, os.path.abspath(path), stat, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not update the content index: {e}")
+
+    def _add(
+        self, keys: List[str], path: str, stat: os.stat_result, now: float
+    ):
+        with self._transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO files (key, path, size, mtime_ns, added) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (key, path, stat.st_size, stat.st_mtime_ns, now)
+                    for key in keys
+                ),
+            )
+
+    def materialize(self, source: str, destination: str) -> str:
+        """Copy source to destination, see link_or_copy"""
+        return link_or_copy(source, destination, self._link_mode)
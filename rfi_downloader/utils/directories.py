@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import PurePath
+from threading import RLock
+from typing import Callable, Dict, Iterable, List, Set, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# metadata operations on network filesystems are latency bound
+_CREATION_THREADS = 8
+
+T = TypeVar("T")
+
+
+def _split(path: str) -> Tuple[str, ...]:
+    # the first part is the anchor of absolute paths, e.g. / or C:\
+    return PurePath(os.path.normpath(path)).parts
+
+
+def deepest_directories(paths: Iterable[str]) -> List[str]:
+    """Deduplicate directories with a trie, keeping only those that are not
+    an ancestor of another one: creating these creates all of them."""
+    root: Dict[str, dict] = {}
+    for path in paths:
+        node = root
+        for part in _split(path):
+            node = node.setdefault(part, {})
+
+    rv: List[str] = []
+    stack: List[Tuple[Tuple[str, ...], Dict[str, dict]]] = [((), root)]
+    while stack:
+        parts, node = stack.pop()
+        if not node:
+            if parts:
+                rv.append(os.path.join(*parts))
+            continue
+        for part, child in node.items():
+            stack.append((parts + (part,), child))
+    return rv
+
+
+class DirectoryCache:
+    """Remembers which destination directories exist, so that creating the
+    parent directory of a file is usually a set lookup, instead of a round-trip
+    to a possibly slow filesystem."""
+
+    def __init__(self):
+        self._lock = RLock()
+        self._existing: Set[str] = set()
+
+    def _add(self, path: str):
+        with self._lock:
+            while path and path not in self._existing:
+                self._existing.add(path)
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+
+    def ensure(self, path: str):
+        """Create a directory and its parents, unless known to exist.
+
+        Raises OSError if that fails.
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            if path in self._existing:
+                return
+        os.makedirs(path, exist_ok=True)
+        self._add(path)
+
+    def discard(self, path: str):
+        """Forget about a directory, e.g. after it turned out to be missing"""
+        with self._lock:
+            self._existing.discard(os.path.normpath(path))
+
+    def create_in(self, filename: str, create: Callable[[], T]) -> T:
+        """Ensure the parent directory of a file, then call create, which
+        writes the file. If the directory was removed behind our back,
+        it is created again, and create is retried once.
+
+        Raises OSError if that fails.
+        """
+        parent = os.path.dirname(filename)
+        if not parent:
+            return create()
+        self.ensure(parent)
+        try:
+            return create()
+        except FileNotFoundError:
+            self.discard(parent)
+            self.ensure(parent)
+            return create()
+
+    def create_all(self, paths: Iterable[str]) -> List[str]:
+        """Create many directories at once, in parallel.
+
+        Returns the error messages for the directories that could not be created.
+        """
+        paths = {os.path.normpath(path) for path in paths}
+        with self._lock:
+            paths.difference_update(self._existing)
+        leaves = deepest_directories(paths)
+        if not leaves:
+            return []
+        logger.debug(
+            f"Creating {len(leaves)} directory trees for {len(paths)} directories"
+        )
+
+        def _create(path: str):
+            try:
+                self.ensure(path)
+            except OSError as e:
+                return f"Could not create directory {path}: {e}"
+            return None
+
+        with ThreadPoolExecutor(max_workers=_CREATION_THREADS) as executor:
+            return [msg for msg in executor.map(_create, leaves) if msg]
+
+
+# process-wide, shared by all downloads
+directory_cache = DirectoryCache()
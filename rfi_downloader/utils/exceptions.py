@@ -11,3 +11,7 @@ class AlreadyPaused(Exception):
 
 class NotYetRunning(Exception):
     pass
+
+
+class CannotPause(Exception):
+    pass
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import logging
+import os
+from pathlib import Path
+import platform
+import sqlite3
+from threading import RLock
+import time
+import uuid
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+STATE_PENDING = "pending"
+STATE_LEASED = "leased"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    url TEXT UNIQUE NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expiry REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    sequence INTEGER,
+    priority INTEGER NOT NULL DEFAULT 0,
+    rank INTEGER
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('sequence', 0);
+"""
+
+# added after the first release, for the ordering of the jobs
+_COLUMNS = (
+    ("priority", "INTEGER NOT NULL DEFAULT 0"),
+    ("rank", "INTEGER"),
+)
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_sequence ON jobs (sequence);
+CREATE INDEX IF NOT EXISTS jobs_order
+    ON jobs (state, priority DESC, rank IS NULL, rank, id);
+"""
+
+# the order in which jobs are claimed: highest priority first,
+# then by rank, jobs without a rank last, and in the order they were added
+_ORDER = " ORDER BY priority DESC, rank IS NULL, rank, id"
+
+# a job: the URL, its priority and its rank, see LeaseCoordinator.add_jobs
+Job = Tuple[str, int, Optional[int]]
+
+
+def default_node_id() -> str:
+    # unique per coordinator: the windows of one process have one each
+    return f"{platform.node()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class LeaseCoordinator:
+    """Lets several downloaders share one manifest through an SQLite database.
+
+    Every node adds the same jobs to the database, and claims pending jobs
+    by taking a lease on them. Leases must be renewed before they expire,
+    otherwise they may be claimed by another node: this is how the jobs of a
+    node that died are picked up again. Jobs that are done are never claimed again.
+
+    Jobs are claimed by priority, then by rank, which carries the ordering
+    policy of the node that added them.
+
+    The database should live on a filesystem that is shared by all nodes, and
+    supports POSIX locks (GPFS and NFSv4 do). Lease expiry is based on
+    wall-clock time, so the clocks of the nodes need to be synchronized.
+    """
+
+    def __init__(
+        self,
+        path: Union[os.PathLike, str],
+        node_id: Optional[str] = None,
+        lease_duration: float = 300,
+    ):
+        self._path = Path(path)
+        self._node_id = node_id or default_node_id()
+        self._lease_duration = lease_duration
+        self._lock = RLock()
+        # the scheduler and the transfer callbacks live on different threads,
+        # so the connection is shared, guarded by our own lock
+        self._connection = sqlite3.connect(
+            str(self._path),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        with self._lock:
+            # executescript manages its own transaction
+            self._connection.executescript(_SCHEMA)
+        with self._transaction() as cursor:
+            columns = {
+                row[1]
+                for row in cursor.execute("PRAGMA table_info(jobs)").fetchall()
+            }
+            for name, definition in _COLUMNS:
+                if name not in columns:
+                    cursor.execute(
+                        f"ALTER TABLE jobs ADD COLUMN {name} {definition}"
+                    )
+            # leases of an earlier run under the same name that crashed:
+            # renew would otherwise keep them alive forever
+            cursor.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, lease_expiry = NULL"
+                " WHERE state = ? AND owner = ?",
+                (STATE_PENDING, STATE_LEASED, self._node_id),
+            )
+            if cursor.rowcount:
+                logger.info(
+                    f"Released {cursor.rowcount} leases left behind by an earlier run of {self._node_id}"
+                )
+            # jobs finished before now are reported by finished_elsewhere,
+            # whoever finished them
+            (self._start_sequence,) = cursor.execute(
+                "SELECT value FROM counters WHERE name = 'sequence'"
+            ).fetchone()
+        with self._lock:
+            self._connection.executescript(_INDEXES)
+        self._last_renewal = time.monotonic()
+        self._last_sequence: int = 0
+
+    @property
+    def node_id(self) -> str:
+        return self._node_id
+
+    @property
+    def lease_duration(self) -> float:
+        return self._lease_duration
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                # take the write lock straight away, to avoid deadlocks
+                # between readers that want to upgrade to writers
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    yield cursor
+                except BaseException:
+                    cursor.execute("ROLLBACK")
+                    raise
+                else:
+                    cursor.execute("COMMIT")
+            finally:
+                cursor.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def add_jobs(self, jobs: Iterable[Job]):
+        """Add jobs to the shared manifest. Jobs that are already known are left alone.
+
+        Jobs with a lower rank are claimed first, those without one last."""
+        with self._transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO jobs (url, priority, rank)"
+                " VALUES (?, ?, ?)",
+                jobs,
+            )
+
+    def set_priority(self, url: str, priority: int):
+        """Change the priority of a job, for all nodes"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET priority = ? WHERE url = ?", (priority, url)
+            )
+
+    def claim(self, limit: int) -> List[str]:
+        """Claim up to limit jobs that are pending, or whose lease has expired.
+        Jobs this node released with a delay are left to the others until
+        the delay is over."""
+        if limit <= 0:
+            return []
+        now = time.time()
+        with self._transaction() as cursor:
+            # two queries, each of which can walk the jobs_order index
+            rows = cursor.execute(
+                "SELECT id, url, state, owner, priority, rank FROM jobs"
+                " WHERE state = ? AND (owner IS NULL OR owner != ?"
+                " OR lease_expiry < ?)" + _ORDER + " LIMIT ?",
+                (STATE_PENDING, self._node_id, now, limit),
+            ).fetchall()
+            rows += cursor.execute(
+                "SELECT id, url, state, owner, priority, rank FROM jobs"
+                " WHERE state = ? AND lease_expiry < ?" + _ORDER + " LIMIT ?",
+                (STATE_LEASED, now, limit),
+            ).fetchall()
+            rows.sort(
+                key=lambda row: (-row[4], row[5] is None, row[5] or 0, row[0])
+            )
+            del rows[limit:]
+            cursor.executemany(
+                "UPDATE jobs SET state = ?, owner = ?, lease_expiry = ?,"
+                " attempts = attempts + 1 WHERE id = ?",
+                (
+                    (
+                        STATE_LEASED,
+                        self._node_id,
+                        now + self._lease_duration,
+                        _id,
+                    )
+                    for _id, *_ in rows
+                ),
+            )
+        for _, url, state, owner, _, _ in rows:
+            if state == STATE_LEASED and owner != self._node_id:
+                logger.info(f"Reclaimed expired lease of {owner} on {url}")
+        return [url for _, url, *_ in rows]
+
+    def renew(self) -> None:
+        """Extend all leases held by this node"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET lease_expiry = ? WHERE state = ? AND owner = ?",
+                (
+                    time.time() + self._lease_duration,
+                    STATE_LEASED,
+                    self._node_id,
+                ),
+            )
+        self._last_renewal = time.monotonic()
+
+    def renew_if_needed(self) -> bool:
+        """Renew the leases once a third of their duration has passed"""
+        if time.monotonic() - self._last_renewal < self._lease_duration / 3:
+            return False
+        self.renew()
+        return True
+
+    def held(self, urls: Iterable[str]) -> Set[str]:
+        """Return those urls that are currently leased by this node"""
+        urls = list(urls)
+        rv: Set[str] = set()
+        with self._transaction() as cursor:
+            # stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for i in range(0, len(urls), 500):
+                chunk = urls[i : i + 500]
+                rows = cursor.execute(
+                    "SELECT url FROM jobs WHERE state = ? AND owner = ?"
+                    f" AND url IN ({','.join('?' * len(chunk))})",
+                    (STATE_LEASED, self._node_id, *chunk),
+                ).fetchall()
+                rv.update(url for (url,) in rows)
+        return rv
+
+    def _finish(
+        self,
+        url: str,
+        state: str,
+        error: Optional[str],
+        condition: str = "",
+        parameters: tuple = (),
+    ):
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET state = ?, owner = ?, lease_expiry = NULL,"
+                " error = ?, sequence = (SELECT value + 1 FROM counters"
+                " WHERE name = 'sequence') WHERE url = ?" + condition,
+                (state, self._node_id, error, url, *parameters),
+            )
+            if cursor.rowcount:
+                cursor.execute(
+                    "UPDATE counters SET value = value + 1"
+                    " WHERE name = 'sequence'"
+                )
+
+    def complete(self, url: str):
+        self._finish(url, STATE_DONE, None)
+
+    def fail(self, url: str, error: str):
+        self._finish(url, STATE_FAILED, error)
+
+    def skip(self, url: str, error: Optional[str] = None):
+        """Finish a job that this node gave up on without downloading it,
+        e.g. because it was cancelled while queued, so that it is not claimed
+        over and over again. Jobs that are finished, or leased by another
+        node, are left alone."""
+        self._finish(
+            url,
+            STATE_FAILED if error else STATE_DONE,
+            error,
+            " AND (state = ? OR (state = ? AND (owner = ? OR lease_expiry < ?)))",
+            (STATE_PENDING, STATE_LEASED, self._node_id, time.time()),
+        )
+
+    def release(self, url: str, delay: float = 0):
+        """Give up the lease on a job that was not finished, e.g. when stopping.
+        With a delay, this node does not claim it again until it is over."""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET state = ?, owner = ?, lease_expiry = ?"
+                " WHERE url = ? AND state = ? AND owner = ?",
+                (
+                    STATE_PENDING,
+                    self._node_id if delay > 0 else None,
+                    time.time() + delay if delay > 0 else None,
+                    url,
+                    STATE_LEASED,
+                    self._node_id,
+                ),
+            )
+
+    def finished_elsewhere(self) -> List[Tuple[str, str, str, Optional[str]]]:
+        """Return (url, state, owner, error) for all jobs that were finished by
+        other nodes since the previous call. The first call also returns the
+        jobs that were finished before this coordinator was created, by any
+        node, including an earlier run under the same name."""
+        with self._transaction() as cursor:
+            rows = cursor.execute(
+                "SELECT url, state, owner, error, sequence FROM jobs"
+                " WHERE sequence > ? ORDER BY sequence",
+                (self._last_sequence,),
+            ).fetchall()
+        if rows:
+            self._last_sequence = rows[-1][4]
+        return [
+            (url, state, owner, error)
+            for url, state, owner, error, sequence in rows
+            if owner != self._node_id or sequence <= self._start_sequence
+        ]
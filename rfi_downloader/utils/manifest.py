@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import json
+import os
+from pathlib import PurePosixPath
+from typing import BinaryIO, Dict, NamedTuple, Optional, Tuple, Union
+
+from .checksums import parse_checksum
+
+FORMAT_TEXT = "text"
+FORMAT_TSV = "tsv"
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# columns that are understood, any others end up in the metadata
+_URL_COLUMN = "url"
+_PATH_COLUMNS = ("path", "destination")
+_SIZE_COLUMN = "size"
+_PRIORITY_COLUMN = "priority"
+_CHECKSUM_COLUMN = "checksum"
+_CHECKSUM_ALGORITHMS = ("md5", "sha1", "sha256", "sha512")
+_MIRROR_COLUMNS = ("mirror", "mirrors")
+_EXTRACT_COLUMN = "extract"
+# values of the extract column, besides the name of a format
+EXTRACT_AUTO = "auto"
+EXTRACT_NONE = "none"
+_TRUE_VALUES = ("1", "true", "yes")
+_FALSE_VALUES = ("0", "false", "no")
+
+
+class ManifestEntry(NamedTuple):
+    """A single download, as described by a row of a manifest"""
+
+    url: str
+    # destination relative to the destination folder, if not derived from the url
+    path: Optional[str] = None
+    # expected size in bytes, -1 if unknown
+    size: int = -1
+    priority: int = 0
+    # algorithm:hexdigest, e.g. sha256:e3b0c442...
+    checksum: Optional[str] = None
+    # alternative urls for the same file, in order of preference
+    mirrors: Tuple[str, ...] = ()
+    # all other columns
+    metadata: Dict[str, str] = {}
+    # unpack while downloading: auto, none or an archive format, None if not given
+    extract: Optional[str] = None
+
+
+def _split_mirrors(value: str) -> Tuple[str, ...]:
+    return tuple(value.replace("|", " ").split())
+
+
+def check_path(path: str) -> str:
+    parts = PurePosixPath(path).parts
+    if not parts or path.startswith("/") or ".." in parts:
+        raise ValueError(
+            "must be relative, and stay within the destination folder"
+        )
+    return os.path.join(*parts)
+
+
+def _parse_extract(value: str) -> str:
+    # imported here, as unpack depends on this module
+    from .unpack import FORMAT_NAMES
+
+    value = value.strip().lower()
+    if value in _TRUE_VALUES or value == EXTRACT_AUTO:
+        return EXTRACT_AUTO
+    elif value in _FALSE_VALUES or value == EXTRACT_NONE:
+        return EXTRACT_NONE
+    elif value.lstrip(".") in FORMAT_NAMES:
+        return value.lstrip(".")
+    raise ValueError(f"expected auto, none or one of {', '.join(FORMAT_NAMES)}")
+
+
+def entry_from_fields(fields: Dict[str, Union[str, int, list, None]]):
+    """Build a ManifestEntry from a mapping of column names to values.
+
+    Raises ValueError if the url is missing, or a value is invalid.
+    """
+    url = None
+    path = None
+    size = -1
+    priority = 0
+    checksum = None
+    mirrors: Tuple[str, ...] = ()
+    metadata: Dict[str, str] = {}
+    extract = None
+
+    for key, value in fields.items():
+        if value is None or value == "":
+            continue
+        key = key.strip().lower()
+        try:
+            if key == _URL_COLUMN:
+                url = str(value).strip()
+            elif key in _PATH_COLUMNS:
+                path = check_path(str(value))
+            elif key == _SIZE_COLUMN:
+                size = int(value)
+            elif key == _PRIORITY_COLUMN:
+                priority = int(value)
+            elif key == _CHECKSUM_COLUMN:
+                checksum = str(value).strip()
+                parse_checksum(checksum)
+            elif key in _CHECKSUM_ALGORITHMS:
+                checksum = f"{key}:{str(value).strip()}"
+                parse_checksum(checksum)
+            elif key == _EXTRACT_COLUMN:
+                extract = _parse_extract(str(value))
+            elif key in _MIRROR_COLUMNS or (
+                key.startswith("mirror") and key[6:].isdigit()
+            ):
+                if isinstance(value, (list, tuple)):
+                    mirrors += tuple(str(mirror) for mirror in value)
+                else:
+                    mirrors += _split_mirrors(str(value))
+            else:
+                metadata[key] = str(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid {key} {value!r}: {e}") from None
+
+    if not url:
+        raise ValueError("No url found")
+
+    return ManifestEntry(
+        url=url,
+        path=path,
+        size=size,
+        priority=priority,
+        checksum=checksum,
+        mirrors=mirrors,
+        metadata=metadata,
+        extract=extract,
+    )
+
+
+class ManifestParser:
+    """Parses the lines of a manifest into ManifestEntry objects.
+
+    The following formats are supported, one record per line:
+
+    * text: a url, optionally followed by key=value fields, e.g. size=1024
+    * tsv and csv: a header line naming the columns, one of which is url
+    * jsonl: a JSON object per line, with at least a url key
+
+    If no format is given, it is determined from the first line that is
+    not empty and not a comment. Lines starting with '#' are ignored.
+    """
+
+    def __init__(self, format: Optional[str] = None):
+        if format not in (
+            None,
+            FORMAT_TEXT,
+            FORMAT_TSV,
+            FORMAT_CSV,
+            FORMAT_JSONL,
+        ):
+            raise ValueError(f"Unknown manifest format {format}")
+        self._format = format
+        self._columns: Optional[Tuple[str, ...]] = None
+
+    @property
+    def format(self) -> Optional[str]:
+        return self._format
+
+    def _detect_format(self, line: str) -> str:
+        if line.startswith("{"):
+            return FORMAT_JSONL
+        for format, delimiter in ((FORMAT_TSV, "\t"), (FORMAT_CSV, ",")):
+            if delimiter in line:
+                columns = next(csv.reader([line], delimiter=delimiter))
+                if _URL_COLUMN in (
+                    column.strip().lower() for column in columns
+                ):
+                    return format
+        return FORMAT_TEXT
+
+    def parse_line(self, line: str) -> Optional[ManifestEntry]:
+        """Returns the entry on this line, or None if it does not hold one.
+
+        Raises ValueError if the line is invalid.
+        """
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            return None
+
+        if self._format is None:
+            self._format = self._detect_format(stripped)
+
+        if self._format == FORMAT_JSONL:
+            try:
+                fields = json.loads(stripped)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON: {e}") from None
+            if not isinstance(fields, dict):
+                raise ValueError("Expected a JSON object")
+            return entry_from_fields(fields)
+        elif self._format in (FORMAT_TSV, FORMAT_CSV):
+            delimiter = "\t" if self._format == FORMAT_TSV else ","
+            values = next(
+                csv.reader([line.rstrip("\r\n")], delimiter=delimiter)
+            )
+            if self._columns is None:
+                self._columns = tuple(values)
+                if _URL_COLUMN not in (
+                    column.strip().lower() for column in self._columns
+                ):
+                    raise ValueError("The header does not contain a url column")
+                return None
+            if len(values) > len(self._columns):
+                raise ValueError(
+                    f"Expected {len(self._columns)} columns, found {len(values)}"
+                )
+            return entry_from_fields(dict(zip(self._columns, values)))
+
+        url, *tokens = stripped.split()
+        fields = {_URL_COLUMN: url}
+        for token in tokens:
+            key, sep, value = token.partition("=")
+            if not sep:
+                # ignore any rubbish following the url
+                continue
+            if key.lower() in _MIRROR_COLUMNS and key.lower() in fields:
+                fields[key.lower()] += " " + value
+            else:
+                fields[key.lower()] = value
+        return entry_from_fields(fields)
+
+
+def is_compressed(path: Union[os.PathLike, str]) -> bool:
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    return magic.startswith(_GZIP_MAGIC) or magic.startswith(_ZSTD_MAGIC)
+
+
+def open_manifest(path: Union[os.PathLike, str]) -> BinaryIO:
+    """Open a manifest for reading, as a stream that is decompressed on the
+    fly if the file is gzip or zstd compressed"""
+    f = open(path, "rb")
+    magic = f.read(4)
+    f.seek(0)
+    if magic.startswith(_GZIP_MAGIC):
+        f.close()
+        return gzip.open(path, "rb")
+    elif magic.startswith(_ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            f.close()
+            raise ValueError(
+                f"{path} is zstd compressed, which requires the zstandard package"
+            ) from None
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        )
+    return f
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from collections import deque
+import logging
+from threading import RLock
+from typing import Callable, Deque, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """Caps the number of bytes that the transfers of this process hold in
+    buffers at any time, e.g. blocks that were read but not yet written.
+
+    A transfer acquires permits before reading a block and releases them
+    once the block has been written. Transfers that do not get permits
+    straight away are called back, in the order they asked, as soon as
+    enough permits are released. The transfer threads are never blocked.
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, limit: int = 0):
+        self._lock = RLock()
+        self._limit = limit
+        self._in_use: int = 0
+        self._peak: int = 0
+        self._waiters: Deque[Tuple[int, Callable[[], None]]] = deque()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        with self._lock:
+            self._limit = max(value, 0)
+            granted = self._grant()
+        self._notify(granted)
+
+    @property
+    def in_use(self) -> int:
+        with self._lock:
+            return self._in_use
+
+    @property
+    def peak(self) -> int:
+        """The largest number of bytes that were ever in use at once"""
+        with self._lock:
+            return self._peak
+
+    def _fits(self, nbytes: int) -> bool:
+        # a request bigger than the limit gets it all to itself
+        return (
+            not self._limit
+            or self._in_use + nbytes <= self._limit
+            or self._in_use == 0
+        )
+
+    def _take(self, nbytes: int):
+        self._in_use += nbytes
+        self._peak = max(self._peak, self._in_use)
+
+    def acquire(self, nbytes: int, callback: Callable[[], None]) -> bool:
+        """Take nbytes of permits, and return True if they were available.
+
+        Otherwise return False: the callback is called once they were
+        taken, on the thread that released them.
+        """
+        with self._lock:
+            if not self._waiters and self._fits(nbytes):
+                self._take(nbytes)
+                return True
+            self._waiters.append((nbytes, callback))
+            return False
+
+    def cancel(self, callback: Callable[[], None]) -> bool:
+        """Stop waiting for permits, returns False if the callback
+        was not waiting, e.g. because it was granted in the meantime"""
+        with self._lock:
+            for waiter in self._waiters:
+                if waiter[1] == callback:
+                    self._waiters.remove(waiter)
+                    granted = self._grant()
+                    break
+            else:
+                return False
+        self._notify(granted)
+        return True
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self._in_use = max(self._in_use - nbytes, 0)
+            granted = self._grant()
+        self._notify(granted)
+
+    def _grant(self):
+        granted = []
+        while self._waiters and self._fits(self._waiters[0][0]):
+            nbytes, callback = self._waiters.popleft()
+            self._take(nbytes)
+            granted.append(callback)
+        return granted
+
+    @staticmethod
+    def _notify(granted):
+        # outside of the lock, the callbacks may acquire again
+        for callback in granted:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Memory budget callback failed")
+
+
+memory_budget = MemoryBudget()
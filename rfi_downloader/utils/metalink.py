@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+import xml.etree.ElementTree as ET
+
+from .manifest import ManifestEntry, check_path
+
+METALINK4_NAMESPACE = "urn:ietf:params:xml:ns:metalink"
+METALINK3_NAMESPACE = "http://www.metalinker.org/"
+
+# strongest first
+_HASH_TYPES = (
+    ("sha-512", "sha512"),
+    ("sha512", "sha512"),
+    ("sha-256", "sha256"),
+    ("sha256", "sha256"),
+    ("sha-1", "sha1"),
+    ("sha1", "sha1"),
+    ("md5", "md5"),
+)
+
+
+def is_metalink(head: bytes) -> bool:
+    """Check if the first bytes of a file look like XML"""
+    head = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    return head.startswith(b"<?xml") or head.startswith(b"<metalink")
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _checksum(file: ET.Element) -> Optional[str]:
+    hashes = {
+        (element.get("type") or "").lower(): (element.text or "").strip()
+        for element in file.iter()
+        if _local_name(element.tag) == "hash"
+        # v4 also lists piece hashes, which are nested in <pieces>
+        and element.text
+    }
+    for metalink_type, algorithm in _HASH_TYPES:
+        if hashes.get(metalink_type):
+            return f"{algorithm}:{hashes[metalink_type]}"
+    return None
+
+
+def _urls(file: ET.Element, version: int) -> List[str]:
+    ranked: List[Tuple[float, int, str]] = []
+    for index, element in enumerate(file.iter()):
+        if _local_name(element.tag) != "url" or not element.text:
+            continue
+        url = element.text.strip()
+        if not url.lower().startswith(("http://", "https://")):
+            continue
+        if version == 4:
+            # 1 is the most preferred, urls without priority come last
+            rank = float(element.get("priority", "inf"))
+        else:
+            # 100 is the most preferred
+            rank = -float(element.get("preference", "0"))
+        ranked.append((rank, index, url))
+    return [url for _, _, url in sorted(ranked)]
+
+
+def read_metalink(
+    stream: BinaryIO, errors: List[str]
+) -> Iterator[ManifestEntry]:
+    """Yield an entry for every file in a Metalink document (RFC 5854,
+    or the older version 3), while it is being parsed.
+
+    The most preferred HTTP(S) url of a file becomes the url of its entry,
+    the others its mirrors. Files that cannot be used are reported in errors.
+    """
+    version = 4
+    for event, element in ET.iterparse(stream, events=("start", "end")):
+        name = _local_name(element.tag)
+        if event == "start":
+            if name == "metalink" and element.tag.startswith(
+                "{" + METALINK3_NAMESPACE
+            ):
+                version = 3
+            continue
+        if name != "file":
+            continue
+
+        file_name = element.get("name", "")
+        try:
+            path = check_path(file_name)
+            urls = _urls(element, version)
+            if not urls:
+                raise ValueError("no HTTP or HTTPS urls")
+            size = -1
+            for child in element:
+                if _local_name(child.tag) == "size" and child.text:
+                    size = int(child.text)
+        except ValueError as e:
+            errors.append(f"Metalink file {file_name!r}: {e}")
+        else:
+            yield ManifestEntry(
+                url=urls[0],
+                path=path,
+                size=size,
+                checksum=_checksum(element),
+                mirrors=tuple(urls[1:]),
+                metadata={},
+            )
+        # keep memory use flat for huge documents
+        element.clear()
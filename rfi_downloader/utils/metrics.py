@@ -0,0 +1,442 @@
+from __future__ import annotations
+
+from . import ExitableThread
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import os
+from pathlib import Path
+from threading import Thread, local
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# default latency buckets, in seconds
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    1800.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    elif value == -math.inf:
+        return "-Inf"
+    elif float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(
+    labelnames: Sequence[str], labelvalues: Sequence[str]
+) -> str:
+    if not labelnames:
+        return ""
+    pairs = (
+        f'{name}="{_escape_label_value(value)}"'
+        for name, value in zip(labelnames, labelvalues)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Shards:
+    """Per-thread cells of a child, summed when the metric is rendered.
+
+    Each thread only ever updates its own cell, so updates need no lock,
+    which keeps them cheap on the per-block path, even with several
+    transfer threads sharing the children of a host.
+    """
+
+    __slots__ = ("_local", "_cells", "_new_cell")
+
+    def __init__(self, new_cell: Callable[[], list]):
+        self._local = local()
+        self._cells: List[list] = []
+        self._new_cell = new_cell
+
+    def get(self) -> list:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = self._new_cell()
+            # list.append is atomic
+            self._cells.append(cell)
+            return cell
+
+    def __iter__(self) -> Iterator[list]:
+        return iter(list(self._cells))
+
+
+class _CounterChild:
+    __slots__ = ("_shards", "_base")
+
+    def __init__(self):
+        self._shards = _Shards(lambda: [0])
+        self._base: float = 0
+
+    @property
+    def value(self) -> float:
+        return self._base + sum(cell[0] for cell in self._shards)
+
+    def inc(self, amount: float = 1):
+        self._shards.get()[0] += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1):
+        self._shards.get()[0] -= amount
+
+    def set(self, value: float):
+        # gauges are either set, or moved with inc and dec
+        self._base = value - sum(cell[0] for cell in self._shards)
+
+
+class _HistogramChild:
+    __slots__ = ("_upper_bounds", "_shards")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self._upper_bounds = upper_bounds
+        # a cell holds the bucket counts, with one extra slot for the +Inf
+        # bucket, followed by the sum and the count
+        self._shards = _Shards(lambda: [0] * (len(upper_bounds) + 3))
+
+    def observe(self, value: float):
+        cell = self._shards.get()
+        cell[bisect_left(self._upper_bounds, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """The bucket counts, the sum and the count, over all threads"""
+        totals = [0] * (len(self._upper_bounds) + 3)
+        for cell in self._shards:
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals[:-2], totals[-2], totals[-1]
+
+
+class Metric:
+    """Base class for all metrics.
+
+    Children are created on first use of a set of label values, and can be
+    cached by the caller to keep the hot path down to a single attribute update.
+    """
+
+    type_name: str = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues: str):
+        if len(labelvalues) != len(self._labelnames):
+            raise ValueError(
+                f"{self._name} expects labels {self._labelnames}, got {labelvalues}"
+            )
+        key = tuple(str(value) for value in labelvalues)
+        try:
+            return self._children[key]
+        except KeyError:
+            # setdefault is atomic, so concurrent first uses end up sharing a child
+            return self._children.setdefault(key, self._new_child())
+
+    def _samples(self) -> List[str]:
+        rv = []
+        for labelvalues, child in list(self._children.items()):
+            labels = _format_labels(self._labelnames, labelvalues)
+            rv.append(f"{self._name}{labels} {_format_value(child.value)}")
+        return rv
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self._name} {self._documentation}",
+            f"# TYPE {self._name} {self.type_name}",
+        ]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._upper_bounds: Tuple[float, ...] = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self._upper_bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self) -> List[str]:
+        rv = []
+        bucket_labelnames = self._labelnames + ("le",)
+        for labelvalues, child in list(self._children.items()):
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for upper_bound, bucket_count in zip(
+                self._upper_bounds + (math.inf,), counts
+            ):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    bucket_labelnames,
+                    labelvalues + (_format_value(upper_bound),),
+                )
+                rv.append(f"{self._name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self._labelnames, labelvalues)
+            rv.append(f"{self._name}_sum{labels} {_format_value(total)}")
+            rv.append(f"{self._name}_count{labels} {count}")
+        return rv
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        """Produce the registry contents in the Prometheus text exposition format"""
+        return (
+            "\n".join(metric.render() for metric in self._metrics.values())
+            + "\n"
+        )
+
+
+# the process-wide registry, fed by the DownloadManager and URLObjects
+registry = MetricsRegistry()
+
+BYTES_TRANSFERRED = registry.counter(
+    "rfi_downloader_bytes_total",
+    "Number of bytes written to the destination, per host.",
+    ("host",),
+)
+FILES_COMPLETED = registry.counter(
+    "rfi_downloader_files_completed_total",
+    "Number of files that were downloaded successfully, per host.",
+    ("host",),
+)
+FAILURES = registry.counter(
+    "rfi_downloader_failures_total",
+    "Number of failed downloads, per host and failure class.",
+    ("host", "reason"),
+)
+RETRIES = registry.counter(
+    "rfi_downloader_retries_total",
+    "Number of times a transfer was restarted, per host.",
+    ("host",),
+)
+ACTIVE_JOBS = registry.gauge(
+    "rfi_downloader_active_jobs",
+    "Number of downloads currently in progress.",
+)
+QUEUED_JOBS = registry.gauge(
+    "rfi_downloader_queued_jobs",
+    "Number of downloads waiting to be started.",
+)
+BUFFERED_BYTES = registry.gauge(
+    "rfi_downloader_buffered_bytes",
+    "Number of bytes of the memory budget taken by blocks that are read but not yet written.",
+)
+CONCURRENCY_LIMIT = registry.gauge(
+    "rfi_downloader_concurrency_limit",
+    "Number of downloads that may run simultaneously.",
+)
+CONCURRENCY_ADJUSTMENTS = registry.counter(
+    "rfi_downloader_concurrency_adjustments_total",
+    "Number of changes made by the adaptive concurrency controller, per direction.",
+    ("direction",),
+)
+DEDUPLICATED_FILES = registry.counter(
+    "rfi_downloader_deduplicated_files_total",
+    "Number of files that were copied from an identical local file instead of downloaded, per method.",
+    ("method",),
+)
+DEDUPLICATED_BYTES = registry.counter(
+    "rfi_downloader_deduplicated_bytes_total",
+    "Number of bytes that did not need to be downloaded thanks to deduplication.",
+)
+CACHE_REQUESTS = registry.counter(
+    "rfi_downloader_cache_requests_total",
+    "Number of downloads that consulted the shared cache, per result: hit, miss or stale.",
+    ("result",),
+)
+CACHE_BYTES = registry.counter(
+    "rfi_downloader_cache_bytes_total",
+    "Number of bytes that were copied from the shared cache instead of downloaded.",
+)
+PROCESSING_PENDING = registry.gauge(
+    "rfi_downloader_processing_pending_files",
+    "Number of downloaded files that are waiting for or undergoing post-processing.",
+)
+PROCESSED_FILES = registry.counter(
+    "rfi_downloader_processed_files_total",
+    "Number of files that went through post-processing, per result.",
+    ("result",),
+)
+RESPONSE_LATENCY = registry.histogram(
+    "rfi_downloader_response_latency_seconds",
+    "Time between sending a request and receiving the response headers, per host.",
+    ("host",),
+)
+DOWNLOAD_DURATION = registry.histogram(
+    "rfi_downloader_download_duration_seconds",
+    "Wall-clock duration of completed downloads, per host.",
+    ("host",),
+)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsHTTPServer:
+    """Serves the registry on http://127.0.0.1:<port>/metrics"""
+
+    def __init__(self, port: int, registry: MetricsRegistry = registry):
+        self._server = ThreadingHTTPServer(
+            ("127.0.0.1", port), _MetricsRequestHandler
+        )
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(
+            f"Serving metrics on http://127.0.0.1:{self._server.server_port}/metrics"
+        )
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MetricsTextfileWriter(ExitableThread):
+    """Periodically writes the registry to a node-exporter textfile.
+
+    The file is written to a temporary file in the same directory first,
+    which is then renamed, so node-exporter never sees a partial file.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        interval: float = 15,
+        registry: MetricsRegistry = registry,
+    ):
+        super().__init__()
+        self.daemon = True
+        self._path = Path(path)
+        self._interval = interval
+        self._registry = registry
+
+    def write(self):
+        tmp_path = self._path.with_name(f".{self._path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(self._registry.render())
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self._path}: {e}")
+
+    def run(self):
+        next_write = 0.0
+        while not self.should_exit:
+            if time.monotonic() >= next_write:
+                self.write()
+                next_write = time.monotonic() + self._interval
+            time.sleep(0.1)
+        # final write so the file reflects the end of the run
+        self.write()
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import logging
+from threading import RLock
+import time
+from typing import Dict, Optional, Sequence
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# weight of a new measurement in the moving averages
+_ALPHA = 0.3
+# amount of data a mirror is compared on, in bytes
+_REFERENCE_SIZE = 16 * 1024 * 1024
+# how long a failing mirror is avoided, doubled after every failure
+_PENALTY = 30  # seconds
+_MAX_PENALTY = 3600  # seconds
+
+
+class _MirrorStats:
+    __slots__ = ("latency", "throughput", "failures", "avoid_until")
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.failures: int = 0
+        self.avoid_until: float = 0
+
+
+def _ewma(previous: Optional[float], value: float) -> float:
+    if previous is None:
+        return value
+    return (1 - _ALPHA) * previous + _ALPHA * value
+
+
+class MirrorSelector:
+    """Keeps track of the first-byte latency and throughput of the mirrors,
+    per host, to pick the fastest one for a download.
+
+    Mirrors that were never measured are tried first, in the order given.
+    After that, the mirror with the shortest expected time to transfer
+    a reference amount of data wins. Mirrors that failed recently are only
+    used if all the others failed as well.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._stats: Dict[str, _MirrorStats] = {}
+
+    @staticmethod
+    def _key(url: str) -> str:
+        parsed = urllib.parse.urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _get(self, url: str) -> _MirrorStats:
+        return self._stats.setdefault(self._key(url), _MirrorStats())
+
+    def record_latency(self, url: str, latency: float):
+        with self._lock:
+            stats = self._get(url)
+            stats.latency = _ewma(stats.latency, latency)
+            stats.failures = 0
+            stats.avoid_until = 0
+
+    def record_throughput(self, url: str, throughput: float):
+        with self._lock:
+            stats = self._get(url)
+            stats.throughput = _ewma(stats.throughput, throughput)
+
+    def record_failure(self, url: str):
+        with self._lock:
+            stats = self._get(url)
+            stats.failures += 1
+            penalty = min(_PENALTY * 2 ** (stats.failures - 1), _MAX_PENALTY)
+            stats.avoid_until = time.monotonic() + penalty
+            logger.debug(
+                f"Avoiding {self._key(url)} for {penalty} seconds after {stats.failures} failures"
+            )
+
+    def _expected_time(self, stats: _MirrorStats) -> float:
+        return (stats.latency or 0) + _REFERENCE_SIZE / max(
+            stats.throughput or 1, 1
+        )
+
+    def choose(self, urls: Sequence[str]) -> str:
+        """Pick the most promising of the urls, which must not be empty"""
+        if len(urls) == 1:
+            return urls[0]
+        now = time.monotonic()
+        with self._lock:
+            stats = [(url, self._get(url)) for url in urls]
+            healthy = [
+                (url, _stats)
+                for url, _stats in stats
+                if _stats.avoid_until <= now
+            ]
+            if not healthy:
+                # all failed recently: go for the one that is available first
+                return min(stats, key=lambda item: item[1].avoid_until)[0]
+            for url, _stats in healthy:
+                if _stats.latency is None or _stats.throughput is None:
+                    return url
+            url, _ = min(healthy, key=lambda item: self._expected_time(item[1]))
+            return url
+
+
+# process-wide, shared by all downloads
+mirror_selector = MirrorSelector()
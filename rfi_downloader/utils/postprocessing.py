@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import hashlib
+import importlib
+import importlib.metadata
+import os
+import struct
+from typing import Callable, Dict, List, Optional, Sequence
+
+# a task gets the path of a downloaded file and its metadata from the URLs file,
+# and returns a short description of the outcome, or None if it did not apply.
+# It runs in a worker process, and raises an exception if it fails.
+Task = Callable[[str, Dict[str, str]], Optional[str]]
+
+# third-party packages may register their own tasks under this group
+ENTRY_POINT_GROUP = "rfi_downloader.postprocessing"
+
+_BLOCK_SIZE = 1024 * 1024
+
+MRC_SUFFIXES = (".mrc", ".mrcs", ".map", ".st", ".ali", ".rec")
+# bytes per voxel for each MRC mode, mode 101 packs two voxels in a byte
+_MRC_MODE_SIZES = {0: 1, 1: 2, 2: 4, 3: 4, 4: 8, 6: 2, 12: 2, 101: 0.5}
+_MRC_HEADER_SIZE = 1024
+
+THUMBNAIL_SUFFIXES = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".gif")
+THUMBNAIL_SIZE = (256, 256)
+
+
+def checksum_task(path: str, metadata: Dict[str, str]) -> str:
+    """Write the SHA-256 checksum of the file next to it, in sha256sum format"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(_BLOCK_SIZE):
+            sha256.update(block)
+    digest = sha256.hexdigest()
+    with open(f"{path}.sha256", "w") as f:
+        f.write(f"{digest}  {os.path.basename(path)}\n")
+    return f"sha256 {digest}"
+
+
+def mrc_header_task(path: str, metadata: Dict[str, str]) -> Optional[str]:
+    """Check that the size of an MRC file matches its header"""
+    if not path.lower().endswith(MRC_SUFFIXES):
+        return None
+    with open(path, "rb") as f:
+        header = f.read(_MRC_HEADER_SIZE)
+    if len(header) < _MRC_HEADER_SIZE:
+        raise ValueError("file is smaller than an MRC header")
+    if header[208:212] != b"MAP ":
+        raise ValueError("MAP identifier missing from the MRC header")
+    # the machine stamp tells the byte order, 0x11 means big-endian
+    byte_order = ">" if header[212] == 0x11 else "<"
+    nx, ny, nz, mode = struct.unpack_from(f"{byte_order}4i", header, 0)
+    (extended_header_size,) = struct.unpack_from(f"{byte_order}i", header, 92)
+    if min(nx, ny, nz) < 1 or extended_header_size < 0:
+        raise ValueError(f"invalid dimensions {nx}x{ny}x{nz}")
+    if mode not in _MRC_MODE_SIZES:
+        raise ValueError(f"unsupported mode {mode}")
+    if mode == 101:
+        data_size = (nx + 1) // 2 * ny * nz
+    else:
+        data_size = nx * ny * nz * _MRC_MODE_SIZES[mode]
+    expected_size = _MRC_HEADER_SIZE + extended_header_size + data_size
+    actual_size = os.path.getsize(path)
+    if actual_size != expected_size:
+        raise ValueError(
+            f"expected {expected_size} bytes for {nx}x{ny}x{nz} voxels in mode {mode}, found {actual_size}"
+        )
+    return f"MRC {nx}x{ny}x{nz}, mode {mode}"
+
+
+def thumbnail_task(path: str, metadata: Dict[str, str]) -> Optional[str]:
+    """Save a thumbnail of an image next to it, requires Pillow"""
+    if not path.lower().endswith(THUMBNAIL_SUFFIXES):
+        return None
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ValueError("thumbnails require the Pillow package") from None
+    with Image.open(path) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGB")
+        image.save(f"{path}.thumbnail.png")
+    return "thumbnail saved"
+
+
+TASKS: Dict[str, Task] = {
+    "checksum": checksum_task,
+    "mrc-header": mrc_header_task,
+    "thumbnail": thumbnail_task,
+}
+
+
+def resolve_task(name: str) -> Task:
+    """Look up a task by name: a built-in task, a task registered under
+    the entry point group, or a module:function reference.
+
+    Raises ValueError if it cannot be found.
+    """
+    if name in TASKS:
+        return TASKS[name]
+
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        group = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        group = entry_points.get(ENTRY_POINT_GROUP, [])
+    for entry_point in group:
+        if entry_point.name == name:
+            return entry_point.load()
+
+    module_name, sep, function_name = name.partition(":")
+    if sep:
+        try:
+            task = getattr(importlib.import_module(module_name), function_name)
+        except (ImportError, AttributeError) as e:
+            raise ValueError(f"Cannot load task {name}: {e}") from None
+        if callable(task):
+            return task
+    raise ValueError(
+        f"Unknown task {name}, expected one of {', '.join(TASKS)}, an installed plugin or module:function"
+    )
+
+
+def run_tasks(
+    names: Sequence[str], path: str, metadata: Dict[str, str]
+) -> List[str]:
+    """Run the tasks one after the other on a file, in a worker process.
+
+    Raises ValueError naming the task that failed.
+    """
+    messages: List[str] = []
+    for name in names:
+        try:
+            message = resolve_task(name)(path, metadata)
+        except Exception as e:
+            # the original exception may not survive pickling
+            raise ValueError(f"{name}: {e}") from None
+        if message:
+            messages.append(str(message))
+    return messages
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import math
+from threading import RLock
+import time
+from typing import Dict, Hashable, Optional
+
+from humanfriendly import InvalidSize, parse_size
+
+# sessions that did not receive anything for this many seconds
+# are not using their share of the rate
+_IDLE_TIME = 2.0
+# sessions that use this fraction of their share want all of it, and more
+_HUNGRY = 0.9
+
+
+def parse_rate(value: str) -> int:
+    """Parse a rate like 10MB or 10MB/s into bytes/sec, 0 for unlimited"""
+    if value.lower() == "unlimited":
+        return 0
+    for suffix in ("/sec", "/s"):
+        if value.lower().endswith(suffix):
+            value = value[: -len(suffix)]
+    try:
+        return int(parse_size(value))
+    except InvalidSize:
+        raise ValueError(f"Invalid rate {value}") from None
+
+
+class _Bucket:
+    __slots__ = ("tokens", "last_time", "usage", "window_start", "received")
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.last_time: Optional[float] = None
+        # bytes/sec over the previous second, and what came in since
+        self.usage: float = 0.0
+        self.window_start: Optional[float] = None
+        self.received: int = 0
+
+    def refill(self, now: float, rate: float):
+        if self.last_time is not None and now > self.last_time:
+            self.tokens += (now - self.last_time) * rate
+        self.tokens = min(self.tokens, float(rate))
+        self.last_time = now
+
+    def record(self, nbytes: int, now: float):
+        if self.window_start is None:
+            self.window_start = now
+        elif now - self.window_start >= 1.0:
+            self.usage = self.received / (now - self.window_start)
+            self.window_start = now
+            self.received = 0
+        self.received += nbytes
+
+    def current_usage(self, now: float) -> float:
+        if self.window_start is None or now - self.window_start > _IDLE_TIME:
+            return 0.0
+        return self.usage
+
+
+class RateLimiter:
+    """Caps the number of bytes/sec that the transfers of this process
+    receive, across all of them, with a token bucket.
+
+    A transfer reports every block it received, and is told how long to
+    wait before reading the next one. The bucket holds at most a second
+    worth of tokens, so that an idle period is not followed by a burst.
+    A rate of 0 means no limit.
+
+    The rate is shared fairly between the sessions that joined, one per
+    window: a session gets at least an equal share, and what the others
+    leave unused.
+    """
+
+    def __init__(self, rate: int = 0):
+        self._lock = RLock()
+        self._rate = rate
+        self._bucket = _Bucket(float(rate))
+        self._sessions: Dict[Hashable, _Bucket] = {}
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    @rate.setter
+    def rate(self, value: int):
+        with self._lock:
+            self._rate = max(value, 0)
+            # start the new rate with full buckets, and without a debt
+            self._bucket = _Bucket(float(self._rate))
+            for session in self._sessions:
+                self._sessions[session] = _Bucket(math.inf)
+
+    @property
+    def limited(self) -> bool:
+        return self._rate > 0
+
+    def join(self, session: Hashable):
+        with self._lock:
+            self._sessions.setdefault(session, _Bucket(math.inf))
+
+    def leave(self, session: Hashable):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def share(self, session: Hashable) -> int:
+        """The equal share of the rate of a session, 0 for no limit"""
+        with self._lock:
+            if not self._rate:
+                return 0
+            return max(self._rate // max(len(self._sessions), 1), 1)
+
+    def _allowance(self, session: Hashable, now: float) -> float:
+        # an equal share, and for the sessions that use all of theirs,
+        # an equal part of what the others leave unused
+        share = self._rate / len(self._sessions)
+        hungry = 0
+        unused = 0.0
+        for other, bucket in self._sessions.items():
+            usage = bucket.current_usage(now)
+            if usage >= share * _HUNGRY:
+                hungry += 1
+            elif other != session:
+                unused += share - usage
+        if self._sessions[session].current_usage(now) < share * _HUNGRY:
+            return share
+        return share + unused / hungry
+
+    def consume(
+        self,
+        nbytes: int,
+        session: Optional[Hashable] = None,
+        now: Optional[float] = None,
+    ) -> float:
+        """Take nbytes of tokens, and return the number of seconds
+        to wait for before receiving more"""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if not self._rate:
+                return 0.0
+            own = self._sessions.get(session)
+            if own is not None and len(self._sessions) > 1:
+                # the buckets of the sessions add up to the rate
+                own.record(nbytes, now)
+                allowance = self._allowance(session, now)
+                bucket = own
+            else:
+                allowance = self._rate
+                bucket = self._bucket
+            bucket.refill(now, allowance)
+            # the tokens may go negative: the debt is paid off by waiting
+            bucket.tokens -= nbytes
+            return max(-bucket.tokens / allowance, 0.0)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+from collections import Counter, deque
+import heapq
+import itertools
+import math
+from typing import (
+    Any,
+    Counter as CounterType,
+    Deque,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+ORDERING_MANIFEST = "manifest"
+ORDERING_SMALLEST_FIRST = "smallest-first"
+ORDERING_LARGEST_FIRST = "largest-first"
+ORDERING_HOST_ROUND_ROBIN = "host-round-robin"
+
+ORDERING_POLICIES = (
+    ORDERING_MANIFEST,
+    ORDERING_SMALLEST_FIRST,
+    ORDERING_LARGEST_FIRST,
+    ORDERING_HOST_ROUND_ROBIN,
+)
+
+
+class ReadyQueue(Generic[T]):
+    """Priority queue of jobs that are ready to be started.
+
+    Jobs with a higher priority always go first. Among jobs with the same
+    priority, the ordering policy decides:
+
+    * manifest: the order in which the jobs were added
+    * smallest-first: smallest size first, jobs of unknown size last
+    * largest-first: largest size first, jobs of unknown size last
+    * host-round-robin: cycle through the hosts, in manifest order per host
+
+    Jobs that are pushed with first go before all others of the same
+    priority, whatever their size, e.g. interrupted downloads. For
+    host-round-robin, before the others of the same host.
+
+    Pushing and removing jobs is O(log n): removed and updated jobs are
+    invalidated in place, and discarded once they reach the top of their
+    heap. So is popping, except for host-round-robin, where it visits the
+    heap of every host, which makes it O(h + log n) for h hosts.
+    """
+
+    def __init__(self, policy: str = ORDERING_MANIFEST):
+        if policy not in ORDERING_POLICIES:
+            raise ValueError(
+                f"Unknown ordering policy {policy}, must be one of {', '.join(ORDERING_POLICIES)}"
+            )
+        self._policy = policy
+        self._counter = itertools.count()
+        # entry: [-priority, not first, secondary, sequence, tiebreaker,
+        # host, item], with item
+        # replaced by None when invalidated; the unique tiebreaker keeps
+        # heapq from comparing the items of entries with the same sequence
+        self._entries: Dict[T, List[Any]] = {}
+        # per-host heaps for round-robin, a single heap otherwise
+        self._heaps: Dict[str, List[List[Any]]] = {}
+        self._hosts: Deque[str] = deque()
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, item: T) -> bool:
+        return item in self._entries
+
+    def _key(self, priority: int, size: int, first: bool) -> tuple:
+        if self._policy == ORDERING_SMALLEST_FIRST:
+            secondary = size if size >= 0 else math.inf
+        elif self._policy == ORDERING_LARGEST_FIRST:
+            secondary = -size if size >= 0 else math.inf
+        else:
+            secondary = 0
+        return (-priority, 0 if first else 1, secondary)
+
+    def push(
+        self,
+        item: T,
+        priority: int = 0,
+        size: int = -1,
+        host: str = "",
+        sequence: Optional[int] = None,
+        first: bool = False,
+    ):
+        """Add a job. Pass the sequence of an earlier push to keep its place
+        when a job is re-added, e.g. after changing its priority. With first,
+        the job goes before all others of the same priority, and it keeps
+        doing so when re-added with its sequence."""
+        if item in self._entries:
+            self.remove(item)
+        if first:
+            sequence = -next(self._counter)
+        elif sequence is None:
+            sequence = next(self._counter)
+        if self._policy != ORDERING_HOST_ROUND_ROBIN:
+            host = ""
+        entry = [
+            # the sequences of the jobs that went first are negative
+            *self._key(priority, size, sequence < 0),
+            sequence,
+            next(self._counter),
+            host,
+            item,
+        ]
+        self._entries[item] = entry
+        heap = self._heaps.get(host)
+        if heap is None:
+            heap = self._heaps[host] = []
+            self._hosts.append(host)
+        heapq.heappush(heap, entry)
+
+    def sequence(self, item: T) -> Optional[int]:
+        entry = self._entries.get(item)
+        return entry[3] if entry else None
+
+    def remove(self, item: T):
+        """Remove a job, if it is queued"""
+        entry = self._entries.pop(item, None)
+        if entry is not None:
+            entry[-1] = None
+
+    def _clean_top(self, host: str) -> Optional[List[Any]]:
+        heap = self._heaps[host]
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def pop(self) -> Optional[T]:
+        """Remove and return the next job to be started, or None"""
+        best_host = None
+        best_priority = None
+        # hosts without queued jobs are dropped from the rotation
+        for _ in range(len(self._hosts)):
+            host = self._hosts[0]
+            top = self._clean_top(host)
+            if top is None:
+                self._hosts.popleft()
+                del self._heaps[host]
+                continue
+            # the first host in the rotation with the highest priority wins
+            if best_priority is None or top[0] < best_priority:
+                best_host, best_priority = host, top[0]
+            self._hosts.rotate(-1)
+
+        if best_host is None:
+            return None
+
+        entry = heapq.heappop(self._heaps[best_host])
+        item = entry[-1]
+        del self._entries[item]
+        # move the host that was served to the back of the rotation
+        if len(self._hosts) > 1:
+            self._hosts.remove(best_host)
+            self._hosts.append(best_host)
+        return item
+
+
+class JobRanks:
+    """Turns an ordering policy into a single rank per job, for queues that
+    can only sort on a column, like the jobs table of the LeaseCoordinator.
+
+    Jobs with a lower rank go first, jobs without a rank last, and jobs with
+    the same rank in the order they were added. For host-round-robin, the
+    rank of a job is the number of jobs of its host that came before it.
+    """
+
+    def __init__(self, policy: str = ORDERING_MANIFEST):
+        if policy not in ORDERING_POLICIES:
+            raise ValueError(f"Unknown ordering policy {policy}")
+        self._policy = policy
+        self._counter = itertools.count()
+        self._hosts: CounterType[str] = Counter()
+
+    def rank(self, size: int = -1, host: str = "") -> Optional[int]:
+        sequence = next(self._counter)
+        if self._policy == ORDERING_MANIFEST:
+            return sequence
+        elif self._policy == ORDERING_SMALLEST_FIRST:
+            return size if size >= 0 else None
+        elif self._policy == ORDERING_LARGEST_FIRST:
+            return -size if size >= 0 else None
+        rank = self._hosts[host]
+        self._hosts[host] += 1
+        return rank
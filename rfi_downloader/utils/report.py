@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import csv
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from threading import RLock
+from typing import Any, Dict, List, Optional, Sequence, TextIO, Union
+
+logger = logging.getLogger(__name__)
+
+# the columns of the CSV report, and the fields of the JSON Lines records
+FIELDS = (
+    "record",
+    "url",
+    "path",
+    "size",
+    "started",
+    "finished",
+    "average_throughput",
+    "peak_throughput",
+    "attempts",
+    "status",
+    "error",
+    "checksum",
+    # only in the summary
+    "files",
+    "failures",
+)
+
+FORMAT_CSV = "csv"
+FORMAT_JSON_LINES = "jsonl"
+
+
+def report_format(path: str) -> str:
+    """CSV for .csv files, JSON Lines otherwise"""
+    return FORMAT_CSV if path.lower().endswith(".csv") else FORMAT_JSON_LINES
+
+
+def format_timestamp(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+class _Writer:
+    def __init__(self, path: str):
+        self._format = report_format(path)
+        if parent := os.path.dirname(path):
+            os.makedirs(parent, exist_ok=True)
+        self._file: TextIO = open(path, "w", newline="", encoding="utf-8")
+        if self._format == FORMAT_CSV:
+            self._csv = csv.DictWriter(self._file, fieldnames=FIELDS)
+            self._csv.writeheader()
+            self._file.flush()
+
+    def write(self, record: Dict[str, Any]):
+        if self._format == FORMAT_CSV:
+            self._csv.writerow(record)
+        else:
+            self._file.write(json.dumps(record) + "\n")
+        # a crash leaves all records that were written so far
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RunReport:
+    """Writes a record for every download as soon as it is finished,
+    to any number of CSV and JSON Lines files, followed by a summary
+    record of the whole run once it is over.
+
+    Nothing is kept in memory, so a report can be as long as needed,
+    and a crash leaves a usable partial report.
+    """
+
+    def __init__(self, paths: Sequence[Union[os.PathLike, str]]):
+        self._lock = RLock()
+        self._writers: List[_Writer] = []
+        try:
+            for path in paths:
+                self._writers.append(_Writer(os.fspath(path)))
+        except OSError:
+            self.close()
+            raise
+
+    def _write(self, **fields):
+        record = {field: fields.get(field) for field in FIELDS}
+        with self._lock:
+            for writer in self._writers:
+                try:
+                    writer.write(record)
+                except OSError as e:
+                    logger.warning(f"Could not write to the run report: {e}")
+
+    def add_file(
+        self,
+        url: str,
+        path: str,
+        size: int,
+        started: Optional[float],
+        finished: float,
+        peak_throughput: float,
+        attempts: int,
+        status: str,
+        error: Optional[str],
+        checksum: Optional[str],
+    ):
+        """Record a finished download, times are seconds since the epoch"""
+        duration = finished - started if started is not None else None
+        self._write(
+            record="file",
+            url=url,
+            path=path,
+            size=size,
+            started=format_timestamp(started),
+            finished=format_timestamp(finished),
+            average_throughput=round(size / duration, 1) if duration else None,
+            peak_throughput=round(peak_throughput, 1),
+            attempts=attempts,
+            status=status,
+            error=error,
+            checksum=checksum,
+        )
+
+    def add_summary(
+        self,
+        size: int,
+        started: float,
+        finished: float,
+        peak_throughput: float,
+        files: int,
+        status: str,
+        failures: int,
+    ):
+        """Record the run as a whole"""
+        duration = finished - started
+        self._write(
+            record="summary",
+            size=size,
+            started=format_timestamp(started),
+            finished=format_timestamp(finished),
+            average_throughput=(
+                round(size / duration, 1) if duration > 0 else None
+            ),
+            peak_throughput=round(peak_throughput, 1),
+            status=status,
+            files=files,
+            failures=failures,
+        )
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers:
+                try:
+                    writer.close()
+                except OSError as e:
+                    logger.warning(f"Could not close the run report: {e}")
+            self._writers = []
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import Deque, NamedTuple, Optional, Tuple
+
+# weight of a new measurement in the moving average of the throughput
+_ALPHA = 0.2
+# number of throughput samples kept for the history, one per tick
+HISTORY_LENGTH = 120
+
+
+class RunSummary(NamedTuple):
+    """A snapshot of the progress of a session, for the dashboard"""
+
+    bytes_done: int
+    files_done: int
+    files_failed: int
+    files_active: int
+    files_queued: int
+    throughput: float  # bytes/sec, smoothed
+    # seconds, None if the remaining amount of data is unknown
+    eta: Optional[float]
+    history: Tuple[float, ...]
+
+
+class ThroughputTracker:
+    """Turns the total number of bytes that were transferred, sampled at
+    a fixed rate, into a smoothed throughput, and keeps a fixed number of
+    recent samples for a sparkline."""
+
+    def __init__(self, history_length: int = HISTORY_LENGTH):
+        self._history: Deque[float] = deque(maxlen=history_length)
+        self._last_time: Optional[float] = None
+        self._last_bytes: int = 0
+        self._throughput: Optional[float] = None
+        self._peak: float = 0.0
+
+    def reset(self):
+        self._history.clear()
+        self._last_time = None
+        self._throughput = None
+        self._peak = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self._throughput or 0.0
+
+    @property
+    def peak(self) -> float:
+        """The highest throughput of a single tick since the reset"""
+        return self._peak
+
+    @property
+    def history(self) -> Tuple[float, ...]:
+        return tuple(self._history)
+
+    def update(self, now: float, total_bytes: int):
+        if self._last_time is not None and now > self._last_time:
+            # the total drops when a download restarts from scratch
+            sample = max(total_bytes - self._last_bytes, 0) / (
+                now - self._last_time
+            )
+            if self._throughput is None:
+                self._throughput = sample
+            else:
+                self._throughput = (
+                    1 - _ALPHA
+                ) * self._throughput + _ALPHA * sample
+            self._history.append(sample)
+            self._peak = max(self._peak, sample)
+        self._last_time = now
+        self._last_bytes = total_bytes
+
+    def eta(self, remaining_bytes: Optional[int]) -> Optional[float]:
+        """Seconds until remaining_bytes are transferred at the current rate"""
+        if remaining_bytes is None:
+            return None
+        if remaining_bytes <= 0:
+            return 0.0
+        if not self._throughput:
+            return None
+        return remaining_bytes / self._throughput
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Executor, Future
+import logging
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# S3 refuses parts smaller than this, except for the last one
+MINIMUM_PART_SIZE = 5 * 1024**2
+
+
+def parse_s3_url(url: str) -> Tuple[str, str]:
+    """Split s3://bucket/prefix into the bucket and the prefix"""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != "s3" or not parsed.netloc:
+        raise ValueError(f"Expected s3://BUCKET/PREFIX instead of {url}")
+    return parsed.netloc, parsed.path.strip("/")
+
+
+def make_client(endpoint_url: Optional[str] = None):
+    """An S3 client with the credentials of the environment,
+    for AWS or, given its endpoint_url, any S3-compatible store"""
+    try:
+        import boto3
+    except ImportError:
+        raise ValueError(
+            "Writing to object storage requires the boto3 package"
+        ) from None
+    return boto3.client("s3", endpoint_url=endpoint_url)
+
+
+class MultipartUpload:
+    """Streams an object to S3 in parts, as the data comes in.
+
+    Full parts are uploaded on the executor, with at most max_pending
+    of them in flight for this object: writes wait for the oldest one
+    beyond that, which bounds the memory held to about max_pending + 1
+    parts. Objects smaller than a part are uploaded in a single request.
+
+    Calls are expected one at a time, like the operations on a stream.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        key: str,
+        executor: Executor,
+        part_size: int = 8 * 1024**2,
+        max_pending: int = 4,
+    ):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._executor = executor
+        self._part_size = max(part_size, MINIMUM_PART_SIZE)
+        self._max_pending = max(max_pending, 1)
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._part_number: int = 0
+        self._parts: List[Dict[str, Any]] = []
+        self._pending: Deque[Future] = deque()
+        self._size: int = 0
+
+    @property
+    def size(self) -> int:
+        """The number of bytes written so far"""
+        return self._size
+
+    def write(self, data: bytes):
+        self._buffer += data
+        self._size += len(data)
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[: self._part_size])
+            del self._buffer[: self._part_size]
+            self._submit_part(part)
+
+    def _submit_part(self, data: bytes):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self._bucket, Key=self._key
+            )
+            self._upload_id = response["UploadId"]
+        while len(self._pending) >= self._max_pending:
+            self._wait_oldest()
+        self._part_number += 1
+        self._pending.append(
+            self._executor.submit(
+                self._upload_part, self._upload_id, self._part_number, data
+            )
+        )
+
+    def _upload_part(
+        self, upload_id: str, part_number: int, data: bytes
+    ) -> Dict[str, Any]:
+        response = self._client.upload_part(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def _wait_oldest(self):
+        # raises the error of a failed upload
+        self._parts.append(self._pending.popleft().result())
+
+    def complete(self):
+        """Upload what is left, and put the object together"""
+        if self._upload_id is None:
+            self._client.put_object(
+                Bucket=self._bucket, Key=self._key, Body=bytes(self._buffer)
+            )
+            self._buffer.clear()
+            return
+        if self._buffer:
+            self._submit_part(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._wait_oldest()
+        self._client.complete_multipart_upload(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            MultipartUpload={
+                "Parts": sorted(
+                    self._parts, key=lambda part: part["PartNumber"]
+                )
+            },
+        )
+        self._upload_id = None
+
+    def abort(self):
+        """Throw away the parts that were uploaded, and start over"""
+        while self._pending:
+            try:
+                self._wait_oldest()
+            except Exception:
+                pass
+        if self._upload_id is not None:
+            try:
+                self._client.abort_multipart_upload(
+                    Bucket=self._bucket,
+                    Key=self._key,
+                    UploadId=self._upload_id,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Could not abort the upload of s3://{self._bucket}/{self._key}: {e}"
+                )
+        self._buffer.clear()
+        self._upload_id = None
+        self._part_number = 0
+        self._parts = []
+        self._size = 0
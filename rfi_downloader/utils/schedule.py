@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+from datetime import datetime
+import os
+from typing import FrozenSet, List, NamedTuple, Optional, Sequence, Union
+
+from humanfriendly import format_size
+
+from .ratelimit import parse_rate
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+_MINUTES_PER_DAY = 24 * 60
+
+
+class ScheduleWindow(NamedTuple):
+    """A recurring period of the week, with its own limits"""
+
+    days: FrozenSet[int]  # 0 is Monday
+    # minutes since midnight, the end is before the start if the window
+    # goes past midnight, which then belongs to the day it started on
+    start: int
+    end: int
+    rate: int  # bytes/sec, 0 for no limit
+    max_active: int  # 0 for --max-active
+
+    def contains(self, now: datetime) -> bool:
+        minute = now.hour * 60 + now.minute
+        weekday = now.weekday()
+        if self.start < self.end:
+            return weekday in self.days and self.start <= minute < self.end
+        return (weekday in self.days and minute >= self.start) or (
+            (weekday - 1) % 7 in self.days and minute < self.end
+        )
+
+    def describe(self) -> str:
+        limits = [
+            f"{format_size(self.rate)}/sec" if self.rate else "no rate limit",
+        ]
+        if self.max_active:
+            limits.append(f"at most {self.max_active} downloads")
+        return (
+            f"{_format_minute(self.start)}-{_format_minute(self.end)}"
+            + f" ({', '.join(limits)})"
+        )
+
+
+def _format_minute(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def _parse_day(day: str) -> int:
+    try:
+        return DAYS.index(day[:3].lower())
+    except ValueError:
+        raise ValueError(f"Invalid day {day}") from None
+
+
+def _parse_days(days: str) -> FrozenSet[int]:
+    if days in ("*", "daily"):
+        return frozenset(range(7))
+    result = set()
+    for item in days.split(","):
+        first, _, last = item.partition("-")
+        first_day = _parse_day(first)
+        last_day = _parse_day(last) if last else first_day
+        # ranges may wrap around the end of the week, e.g. fri-mon
+        for offset in range((last_day - first_day) % 7 + 1):
+            result.add((first_day + offset) % 7)
+    return frozenset(result)
+
+
+def _parse_time(value: str) -> int:
+    hours, _, minutes = value.partition(":")
+    try:
+        minute = int(hours) * 60 + int(minutes or 0)
+    except ValueError:
+        raise ValueError(f"Invalid time {value}") from None
+    if not 0 <= minute <= _MINUTES_PER_DAY:
+        raise ValueError(f"Invalid time {value}")
+    return minute
+
+
+def parse_window(spec: str) -> ScheduleWindow:
+    """Parse a window like mon-fri 19:00-07:00 rate=10MB max-active=8.
+
+    Days are a comma-separated list of days and ranges of days, or * for
+    every day. The rate is in bytes/sec, with an optional unit,
+    and both limits are optional.
+    """
+    fields = spec.split()
+    if len(fields) < 2:
+        raise ValueError(f"Expected days and times in {spec}")
+    days = _parse_days(fields[0])
+    start, separator, end = fields[1].partition("-")
+    if not separator:
+        raise ValueError(f"Expected a start and end time in {fields[1]}")
+    start_minute = _parse_time(start)
+    end_minute = _parse_time(end)
+    if start_minute == _MINUTES_PER_DAY:
+        raise ValueError(f"Invalid start time {start}")
+    if start_minute == end_minute:
+        raise ValueError(f"Empty window {fields[1]}")
+    rate, max_active = 0, 0
+    for field in fields[2:]:
+        key, _, value = field.partition("=")
+        if key == "rate":
+            rate = parse_rate(value)
+        elif key == "max-active":
+            try:
+                max_active = int(value)
+            except ValueError:
+                raise ValueError(f"Invalid max-active {value}") from None
+            if max_active < 1:
+                raise ValueError("max-active must be at least 1")
+        else:
+            raise ValueError(f"Unknown limit {key}")
+    return ScheduleWindow(
+        days=days,
+        start=start_minute,
+        end=end_minute % _MINUTES_PER_DAY or _MINUTES_PER_DAY,
+        rate=rate,
+        max_active=max_active,
+    )
+
+
+def parse_schedule(text: str) -> List[ScheduleWindow]:
+    """One window per line, blank lines and comments starting with # are
+    ignored"""
+    windows = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.partition("#")[0].strip()
+        if not line:
+            continue
+        try:
+            windows.append(parse_window(line))
+        except ValueError as e:
+            raise ValueError(f"Line {number} of the schedule: {e}") from None
+    if not windows:
+        raise ValueError("The schedule has no windows")
+    return windows
+
+
+class Schedule:
+    """The windows of the week in which downloads run, each with a rate
+    limit and a cap on the number of simultaneous downloads.
+
+    The first window that contains a point in time applies. Outside of
+    all windows, downloads run without limits, or not at all if
+    pause_outside is set.
+    """
+
+    def __init__(
+        self, windows: Sequence[ScheduleWindow], pause_outside: bool = False
+    ):
+        self._windows = tuple(windows)
+        self._pause_outside = pause_outside
+
+    @classmethod
+    def from_file(
+        cls, path: Union[os.PathLike, str], pause_outside: bool = False
+    ) -> Schedule:
+        with open(path, encoding="utf-8") as f:
+            return cls(parse_schedule(f.read()), pause_outside)
+
+    @property
+    def windows(self) -> Sequence[ScheduleWindow]:
+        return self._windows
+
+    @property
+    def pause_outside(self) -> bool:
+        return self._pause_outside
+
+    def window_at(self, now: datetime) -> Optional[ScheduleWindow]:
+        for window in self._windows:
+            if window.contains(now):
+                return window
+        return None
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+from collections import Counter
+import math
+from threading import RLock
+from typing import Counter as CounterType, Dict, Hashable, Optional, Tuple
+
+
+class SlotScheduler:
+    """Shares the download slots of the application between its sessions,
+    one per window, so that all windows together keep to a maximum number
+    of simultaneous downloads, in total and per host.
+
+    Slots are shared fairly: while another session is waiting for one,
+    a session does not get more than its fair share, the maximum divided
+    by the number of sessions with downloads running or queued.
+    Slots are held by item, releasing an item that holds none is harmless.
+
+    The maximum may be lowered for all sessions by any of them, e.g. by
+    a schedule or an adaptive concurrency controller, see set_limit.
+    """
+
+    def __init__(self, max_active: int, max_per_host: int = 0):
+        self._lock = RLock()
+        self._max_active = max(max_active, 1)
+        self._max_per_host = max_per_host
+        # item -> (session, host)
+        self._holders: Dict[Hashable, Tuple[Hashable, str]] = {}
+        self._active: CounterType[Hashable] = Counter()
+        self._hosts: CounterType[str] = Counter()
+        self._waiting: Dict[Hashable, int] = {}
+        # the limits that sessions put on the maximum
+        self._limits: Dict[Hashable, int] = {}
+
+    @property
+    def max_active(self) -> int:
+        """The number of slots, across all sessions"""
+        with self._lock:
+            return min(self._max_active, *self._limits.values())
+
+    @max_active.setter
+    def max_active(self, value: int):
+        with self._lock:
+            self._max_active = max(value, 1)
+
+    def set_limit(self, session: Hashable, limit: Optional[int]):
+        """Hold the number of slots of all sessions at or below limit,
+        None to lift the limit of session"""
+        with self._lock:
+            if limit is None:
+                self._limits.pop(session, None)
+            else:
+                self._limits[session] = max(limit, 1)
+
+    @property
+    def max_per_host(self) -> int:
+        """0 for no limit"""
+        return self._max_per_host
+
+    def active(self, session: Hashable = None) -> int:
+        """The number of slots held by session, or by all of them"""
+        with self._lock:
+            if session is None:
+                return len(self._holders)
+            return self._active[session]
+
+    def set_waiting(self, session: Hashable, waiting: int):
+        """Tell how many downloads of session are waiting for a slot"""
+        with self._lock:
+            if waiting > 0:
+                self._waiting[session] = waiting
+            else:
+                self._waiting.pop(session, None)
+
+    def _share(self) -> int:
+        contenders = set(self._waiting) | {
+            session for session, active in self._active.items() if active
+        }
+        return math.ceil(self.max_active / max(len(contenders), 1))
+
+    def available(self, session: Hashable) -> int:
+        """The number of slots session may take now, hosts aside"""
+        with self._lock:
+            free = self.max_active - len(self._holders)
+            if free <= 0:
+                return 0
+            share = self._share()
+            others_waiting = any(
+                self._active[other] < share
+                for other in self._waiting
+                if other != session
+            )
+            if not others_waiting:
+                return free
+            return max(min(free, share - self._active[session]), 0)
+
+    def acquire(self, session: Hashable, item: Hashable, host: str) -> bool:
+        """Take a slot for item, returns False if there is none for
+        session, or if host has all it may have"""
+        with self._lock:
+            if item in self._holders:
+                return True
+            if self.available(session) <= 0:
+                return False
+            if self._max_per_host and self._hosts[host] >= self._max_per_host:
+                return False
+            self._holders[item] = (session, host)
+            self._active[session] += 1
+            self._hosts[host] += 1
+            return True
+
+    def release(self, item: Hashable):
+        with self._lock:
+            holder = self._holders.pop(item, None)
+            if holder is None:
+                return
+            session, host = holder
+            self._active[session] -= 1
+            if not self._active[session]:
+                del self._active[session]
+            self._hosts[host] -= 1
+            if not self._hosts[host]:
+                del self._hosts[host]
+
+    def release_all(self, session: Hashable):
+        """Give up all slots of a session that is over"""
+        with self._lock:
+            for item, (holder, _) in list(self._holders.items()):
+                if holder == session:
+                    self.release(item)
+            self._waiting.pop(session, None)
+            self._limits.pop(session, None)
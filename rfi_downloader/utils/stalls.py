@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+from typing import NamedTuple, Optional
+
+
+class StallPolicy(NamedTuple):
+    """When a transfer is considered stalled, in the spirit of curl's
+    --speed-limit and --speed-time. A value of 0 disables a check."""
+
+    # minimum average speed in bytes/sec, over low_speed_time seconds
+    low_speed_limit: int = 0
+    low_speed_time: float = 30
+    # maximum number of seconds without receiving any data
+    idle_timeout: float = 120
+    # how often a stalled transfer is restarted before giving up
+    max_restarts: int = 5
+
+    @property
+    def enabled(self) -> bool:
+        return self.idle_timeout > 0 or (
+            self.low_speed_limit > 0 and self.low_speed_time > 0
+        )
+
+
+class StallDetector:
+    """Applies a StallPolicy to the running total of bytes of a transfer"""
+
+    def __init__(self, policy: StallPolicy, now: float, total_bytes: int = 0):
+        self._policy = policy
+        self.reset(now, total_bytes)
+
+    def reset(self, now: float, total_bytes: int):
+        self._last_bytes = total_bytes
+        self._last_progress = now
+        self._window_start = now
+        self._window_bytes = total_bytes
+
+    def check(self, now: float, total_bytes: int) -> Optional[str]:
+        """Returns the reason why the transfer is stalled, or None"""
+        policy = self._policy
+
+        if total_bytes > self._last_bytes:
+            self._last_bytes = total_bytes
+            self._last_progress = now
+        elif (
+            policy.idle_timeout > 0
+            and now - self._last_progress >= policy.idle_timeout
+        ):
+            return (
+                f"no data received for {now - self._last_progress:.0f} seconds"
+            )
+
+        if policy.low_speed_limit > 0 and policy.low_speed_time > 0:
+            elapsed = now - self._window_start
+            if elapsed >= policy.low_speed_time:
+                speed = (total_bytes - self._window_bytes) / elapsed
+                if speed < policy.low_speed_limit:
+                    return f"{speed:.0f} bytes/sec over {elapsed:.0f} seconds, below {policy.low_speed_limit} bytes/sec"
+                self._window_start = now
+                self._window_bytes = total_bytes
+
+        return None
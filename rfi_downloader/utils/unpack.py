@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import bz2
+import logging
+import lzma
+import os
+import tarfile
+from typing import BinaryIO, Optional
+import zlib
+
+from .directories import directory_cache
+from .manifest import check_path
+
+logger = logging.getLogger(__name__)
+
+# the formats that can be unpacked, by filename suffix, longest first
+FORMATS = (
+    ("tar.gz", (".tar.gz", ".tgz")),
+    ("tar.zst", (".tar.zst", ".tzst")),
+    ("tar.xz", (".tar.xz", ".txz")),
+    ("tar.bz2", (".tar.bz2", ".tbz2")),
+    ("tar", (".tar",)),
+    ("gz", (".gz",)),
+    ("zst", (".zst",)),
+    ("xz", (".xz",)),
+    ("bz2", (".bz2",)),
+)
+
+FORMAT_NAMES = tuple(name for name, _ in FORMATS)
+
+_BLOCK_SIZE = tarfile.BLOCKSIZE
+# pax and GNU long name headers are small, anything bigger is suspicious
+_MAX_HEADER_DATA = 1024 * 1024
+
+
+def detect_format(filename: str) -> Optional[str]:
+    """The format of an archive or compressed file, based on its name"""
+    lower = filename.lower()
+    for name, suffixes in FORMATS:
+        if lower.endswith(suffixes):
+            return name
+    return None
+
+
+def strip_suffix(filename: str, format: str) -> str:
+    """The name of the file a compressed file unpacks into"""
+    lower = filename.lower()
+    for name, suffixes in FORMATS:
+        if name == format:
+            for suffix in suffixes:
+                if lower.endswith(suffix):
+                    return filename[: -len(suffix)]
+    return filename
+
+
+class _Decompressor:
+    def __init__(self, compression: str):
+        self._compression = compression
+        self._decompressor = self._new()
+
+    def _new(self):
+        if self._compression == "gz":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._compression == "xz":
+            return lzma.LZMADecompressor()
+        elif self._compression == "bz2":
+            return bz2.BZ2Decompressor()
+        elif self._compression == "zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError(
+                    "Unpacking zstd requires the zstandard package"
+                ) from None
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError(f"Unknown compression {self._compression}")
+
+    @property
+    def eof(self) -> bool:
+        # older zstandard releases do not report the end of a frame
+        return getattr(self._decompressor, "eof", True)
+
+    def decompress(self, data: bytes) -> bytes:
+        chunks = []
+        while data:
+            if getattr(self._decompressor, "eof", False):
+                # concatenated gzip members, or zstd frames
+                self._decompressor = self._new()
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except Exception as e:
+                # zlib.error, lzma.LZMAError, OSError, zstandard.ZstdError...
+                raise ValueError(
+                    f"Invalid {self._compression} data: {e}"
+                ) from None
+            if getattr(self._decompressor, "eof", False):
+                data = self._decompressor.unused_data
+            else:
+                data = b""
+        return b"".join(chunks)
+
+
+def _create(path: str) -> BinaryIO:
+    return directory_cache.create_in(path, lambda: open(path, "wb"))
+
+
+def _member_name(member: tarfile.TarInfo) -> str:
+    name = member.name
+    while name.startswith("./"):
+        name = name[2:]
+    return name.rstrip("/") if name != "." else ""
+
+
+class _TarExtractor:
+    """Extracts a tar stream that is fed in arbitrary chunks.
+
+    Only regular files and directories are created, links and special
+    files are skipped. Members must stay within the destination.
+    """
+
+    def __init__(self, destination: str):
+        self._destination = destination
+        self._header = bytearray()
+        # the member whose data is being read
+        self._member: Optional[tarfile.TarInfo] = None
+        self._file: Optional[BinaryIO] = None
+        self._path: Optional[str] = None
+        self._header_data: Optional[bytearray] = None
+        self._remaining: int = 0
+        self._padding: int = 0
+        # overrides for the next member, from pax or GNU long name headers
+        self._next_name: Optional[str] = None
+        self._next_size: Optional[int] = None
+        self._finished: bool = False
+        self.files: int = 0
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        position = 0
+        while position < len(view) and not self._finished:
+            if self._remaining:
+                chunk = view[position : position + self._remaining]
+                position += len(chunk)
+                self._remaining -= len(chunk)
+                self._member_data(chunk)
+                if not self._remaining:
+                    self._end_member()
+            elif self._padding:
+                skipped = min(self._padding, len(view) - position)
+                position += skipped
+                self._padding -= skipped
+            else:
+                chunk = view[
+                    position : position + _BLOCK_SIZE - len(self._header)
+                ]
+                position += len(chunk)
+                self._header += chunk
+                if len(self._header) == _BLOCK_SIZE:
+                    header = bytes(self._header)
+                    self._header.clear()
+                    self._start_member(header)
+
+    def _start_member(self, header: bytes):
+        try:
+            member = tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+        except tarfile.EOFHeaderError:
+            # end of archive, anything that follows is padding
+            self._finished = True
+            return
+        except tarfile.HeaderError as e:
+            raise ValueError(f"Invalid tar header: {e}") from None
+
+        if self._next_name is not None:
+            member.name = self._next_name
+        if self._next_size is not None:
+            member.size = self._next_size
+        self._next_name = self._next_size = None
+
+        self._member = member
+        self._remaining = member.size
+        self._padding = -member.size % _BLOCK_SIZE
+
+        if member.type in (
+            tarfile.GNUTYPE_LONGNAME,
+            tarfile.XHDTYPE,
+            tarfile.XGLTYPE,
+            tarfile.GNUTYPE_LONGLINK,
+        ):
+            if member.size > _MAX_HEADER_DATA:
+                raise ValueError(f"Oversized tar header for {member.name}")
+            self._header_data = bytearray()
+        elif member.isdir():
+            if _member_name(member):
+                directory_cache.ensure(self._member_path(member))
+        elif member.isreg() and member.type != tarfile.GNUTYPE_SPARSE:
+            self._path = self._member_path(member)
+            self._file = _create(self._path)
+        else:
+            logger.warning(f"Skipping {member.name}: not a regular file")
+
+        if not self._remaining:
+            self._end_member()
+
+    def _member_path(self, member: tarfile.TarInfo) -> str:
+        try:
+            return os.path.join(
+                self._destination, check_path(_member_name(member))
+            )
+        except ValueError as e:
+            raise ValueError(f"Tar member {member.name!r}: {e}") from None
+
+    def _member_data(self, chunk: memoryview):
+        if self._file:
+            self._file.write(chunk)
+        elif self._header_data is not None:
+            self._header_data += chunk
+
+    def _end_member(self):
+        member = self._member
+        if self._file:
+            self._file.close()
+            self._file = None
+            # like tarfile's data filter: no permissions for others to write
+            os.chmod(self._path, (member.mode & 0o755) | 0o600)
+            os.utime(self._path, (member.mtime, member.mtime))
+            self.files += 1
+        elif self._header_data is not None:
+            data = bytes(self._header_data)
+            self._header_data = None
+            if member.type == tarfile.GNUTYPE_LONGNAME:
+                self._next_name = data.rstrip(b"\0").decode(
+                    "utf-8", "surrogateescape"
+                )
+            elif member.type == tarfile.XHDTYPE:
+                self._read_pax(data)
+        self._member = None
+        self._path = None
+
+    def _read_pax(self, data: bytes):
+        # records look like "%d %s=%s\n" % (length, keyword, value)
+        position = 0
+        while position < len(data):
+            length, sep, _ = data[position : position + 20].partition(b" ")
+            try:
+                length = int(length)
+            except ValueError:
+                raise ValueError("Invalid pax header") from None
+            if not sep or length <= 0:
+                raise ValueError("Invalid pax header")
+            record = data[position : position + length]
+            position += length
+            keyword, _, value = (
+                record.split(b" ", 1)[1].rstrip(b"\n").partition(b"=")
+            )
+            if keyword == b"path":
+                self._next_name = value.decode("utf-8", "surrogateescape")
+            elif keyword == b"size":
+                self._next_size = int(value)
+
+    def close(self):
+        if not self._finished:
+            raise ValueError("The tar archive is truncated")
+
+    def abort(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class _FileWriter:
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._file: Optional[BinaryIO] = None
+        self.files: int = 0
+
+    def write(self, data: bytes):
+        if self._file is None:
+            self._file = _create(self._filename)
+            self.files = 1
+        self._file.write(data)
+
+    def close(self):
+        if self._file is None:
+            # an empty file
+            self.write(b"")
+        self._file.close()
+
+    def abort(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class StreamUnpacker:
+    """Decompresses and unpacks a download while it comes in, so that
+    the archive itself is never written to disk.
+
+    Tar archives are extracted into the directory the archive would have
+    been saved in, compressed files are saved without their suffix.
+    Raises OSError if writing fails, ValueError if the data is invalid.
+    """
+
+    def __init__(self, format: str, filename: str):
+        if format not in FORMAT_NAMES:
+            raise ValueError(f"Unknown archive format {format}")
+        self._format = format
+        self._filename = filename
+        self.reset()
+
+    @property
+    def format(self) -> str:
+        return self._format
+
+    @property
+    def files(self) -> int:
+        """The number of files that were written so far"""
+        return self._writer.files
+
+    def reset(self):
+        """Start over, e.g. when a download could not be resumed"""
+        container, _, compression = self._format.partition(".")
+        if container != "tar":
+            container, compression = "", container
+        self._decompressor = _Decompressor(compression) if compression else None
+        if container == "tar":
+            self._writer = _TarExtractor(os.path.dirname(self._filename))
+        else:
+            self._writer = _FileWriter(
+                strip_suffix(self._filename, self._format)
+            )
+
+    def write(self, data: bytes):
+        if self._decompressor:
+            data = self._decompressor.decompress(data)
+        if data:
+            self._writer.write(data)
+
+    def close(self):
+        """Finish up, raises ValueError if the stream was incomplete"""
+        if self._decompressor and not self._decompressor.eof:
+            self.abort()
+            raise ValueError("The compressed stream is truncated")
+        self._writer.close()
+
+    def abort(self):
+        self._writer.abort()
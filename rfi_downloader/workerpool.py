@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+from gi.repository import GLib
+
+import ctypes
+import logging
+import math
+import multiprocessing
+import queue
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+
+from .urlobject import URLObject
+from .utils import TransferThread
+from .utils.memory import memory_budget
+from .utils.ratelimit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# columns of the shared progress table, one row per slot
+JOB_ID = 0  # -1 when the slot is free
+BYTES_WRITTEN = 1
+FILESIZE = 2
+STATE = 3  # written by the worker
+COMMAND = 4  # written by the parent, cleared by the worker
+NUMBER_OF_COLUMNS = 5
+
+STATE_IDLE = 0
+STATE_RUNNING = 1
+STATE_PAUSED = 2
+
+COMMAND_NONE = 0
+COMMAND_PAUSE = 1
+COMMAND_RESUME = 2
+COMMAND_CANCEL = 3
+
+# how often the progress table is synchronized, in milliseconds
+sync_interval = 250
+
+
+class _Row:
+    """View on a single row of the progress table"""
+
+    __slots__ = ("_table", "_offset")
+
+    def __init__(self, table, index: int):
+        self._table = table
+        self._offset = index * NUMBER_OF_COLUMNS
+
+    def __getitem__(self, column: int) -> int:
+        return self._table[self._offset + column]
+
+    def __setitem__(self, column: int, value: int):
+        self._table[self._offset + column] = value
+
+
+def _worker_main(
+    worker_index: int,
+    slots: int,
+    table,
+    job_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+    memory_limit: int,
+    rate_limit,
+):
+    """Entry point of a worker process.
+
+    Runs the regular URLObject transfer loop on a TransferThread of its own,
+    and mirrors the state of its downloads into its rows of the progress table.
+    Only job submissions and results are pickled, never progress updates.
+    """
+    memory_budget.limit = memory_limit
+    transfer_thread = TransferThread(name=f"worker-{worker_index}")
+    transfer_thread.start()
+
+    rows: List[_Row] = [
+        _Row(table, worker_index * slots + slot) for slot in range(slots)
+    ]
+    active: Dict[int, URLObject] = {}
+    active_lock = RLock()
+
+    def _finished_cb(url_object: URLObject, param, slot: int, job_id: int):
+        if not url_object.props.finished:
+            return
+        row = rows[slot]
+        row[BYTES_WRITTEN] = url_object.get_bytes_written()
+        row[FILESIZE] = url_object.get_filesize()
+        row[STATE] = STATE_IDLE
+        with active_lock:
+            del active[slot]
+        result_queue.put(
+            (
+                job_id,
+                url_object.get_bytes_written(),
+                url_object.get_filesize(),
+                url_object.get_error_class(),
+                url_object.get_error_message(),
+            )
+        )
+
+    def _running_cb(url_object: URLObject, param):
+        # restart stalled transfers straight away, the slot is ours anyway
+        if not url_object.props.running and not url_object.props.finished:
+            url_object.start()
+
+    def _sync_cb():
+        # our share of the rate limit, which changes with the schedule
+        if rate_limiter.rate != rate_limit.value:
+            rate_limiter.rate = rate_limit.value
+        with active_lock:
+            items = list(active.items())
+        for slot, url_object in items:
+            row = rows[slot]
+            command = row[COMMAND]
+            if command != COMMAND_NONE:
+                row[COMMAND] = COMMAND_NONE
+                if command == COMMAND_PAUSE:
+                    url_object.pause()
+                elif command == COMMAND_RESUME:
+                    url_object.start()
+                elif command == COMMAND_CANCEL:
+                    url_object.stop()
+            row[BYTES_WRITTEN] = url_object.get_bytes_written()
+            row[FILESIZE] = url_object.get_filesize()
+            row[STATE] = (
+                STATE_PAUSED if url_object.props.paused else STATE_RUNNING
+            )
+        return GLib.SOURCE_CONTINUE
+
+    transfer_thread.timeout_add(sync_interval, _sync_cb)
+
+    while (job := job_queue.get()) is not None:
+        (
+            slot,
+            job_id,
+            url,
+            filename,
+            relative_path,
+            priority,
+            mirrors,
+            stall_policy,
+            checksum,
+            extract,
+            shared_cache,
+            storage,
+        ) = job
+        url_object = URLObject(
+            url=url,
+            filename=filename,
+            relative_path=relative_path,
+            priority=priority,
+            checksum=checksum,
+            mirrors=mirrors,
+            extract=extract,
+        )
+        url_object.transfer_thread = transfer_thread
+        url_object.stall_policy = stall_policy
+        url_object.shared_cache = shared_cache
+        url_object.storage = storage
+        url_object.connect("notify::finished", _finished_cb, slot, job_id)
+        url_object.connect("notify::running", _running_cb)
+        with active_lock:
+            active[slot] = url_object
+        url_object.start()
+
+    # the parent only sends None once all our jobs have finished
+    transfer_thread.quit()
+
+
+class WorkerPool:
+    """Shards downloads across a number of worker processes.
+
+    Each worker runs its own transfer loop. The parent keeps track of which
+    slot runs which URLObject, and reflects the progress of the workers
+    in its URLObjects by polling a shared-memory table.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        max_active: int,
+        poll_thread: TransferThread,
+        memory_limit: int = 0,
+    ):
+        self._processes = processes
+        self._slots = max(math.ceil(max_active / processes), 1)
+        self._poll_thread = poll_thread
+        # spawn: forking a process with a running GTK main loop and threads is unsafe
+        ctx = multiprocessing.get_context("spawn")
+        self._table = ctx.RawArray(
+            ctypes.c_int64, processes * self._slots * NUMBER_OF_COLUMNS
+        )
+        self._rows: List[_Row] = [
+            _Row(self._table, index) for index in range(processes * self._slots)
+        ]
+        for row in self._rows:
+            row[JOB_ID] = -1
+        # bytes/sec for every worker, 0 for no limit
+        self._rate_limit = ctx.RawValue(ctypes.c_int64, 0)
+        self._result_queue = ctx.Queue()
+        self._job_queues = [ctx.Queue() for _ in range(processes)]
+        self._workers = [
+            ctx.Process(
+                target=_worker_main,
+                args=(
+                    index,
+                    self._slots,
+                    self._table,
+                    self._job_queues[index],
+                    self._result_queue,
+                    # the budget is shared out between the workers
+                    memory_limit // processes,
+                    self._rate_limit,
+                ),
+                name=f"rfi-downloader-worker-{index}",
+                daemon=True,
+            )
+            for index in range(processes)
+        ]
+        self._lock = RLock()
+        self._next_job_id: int = 0
+        # row index -> (job id, url object)
+        self._assigned: Dict[int, Tuple[int, URLObject]] = {}
+        self._row_by_url: Dict[URLObject, int] = {}
+        self._poll_source: Optional[GLib.Source] = None
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        self._poll_source = self._poll_thread.timeout_add(
+            sync_interval, self._poll_cb
+        )
+        logger.info(
+            f"Started {self._processes} worker processes with {self._slots} slots each"
+        )
+
+    def shutdown(self):
+        if self._poll_source:
+            self._poll_source.destroy()
+            self._poll_source = None
+        for job_queue in self._job_queues:
+            job_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def set_rate_limit(self, rate: int):
+        """Share out a limit of rate bytes/sec between the workers,
+        0 for no limit"""
+        self._rate_limit.value = (
+            max(rate // self._processes, 1) if rate > 0 else 0
+        )
+
+    def submit(self, url_object: URLObject):
+        with self._lock:
+            # pick the worker with the most free slots
+            best_worker, best_free_slots = None, 0
+            for worker in range(self._processes):
+                free_slots = sum(
+                    1
+                    for slot in range(self._slots)
+                    if worker * self._slots + slot not in self._assigned
+                )
+                if free_slots > best_free_slots:
+                    best_worker, best_free_slots = worker, free_slots
+            if best_worker is None:
+                raise RuntimeError("No free slots left in the worker pool")
+            slot = next(
+                slot
+                for slot in range(self._slots)
+                if best_worker * self._slots + slot not in self._assigned
+            )
+            index = best_worker * self._slots + slot
+            job_id = self._next_job_id
+            self._next_job_id += 1
+
+            row = self._rows[index]
+            row[BYTES_WRITTEN] = 0
+            row[FILESIZE] = 0
+            row[STATE] = STATE_RUNNING
+            row[COMMAND] = COMMAND_NONE
+            row[JOB_ID] = job_id
+            self._assigned[index] = (job_id, url_object)
+            self._row_by_url[url_object] = index
+
+        self._job_queues[best_worker].put(
+            (
+                slot,
+                job_id,
+                url_object.props.url,
+                url_object.props.filename,
+                url_object.props.relative_path,
+                url_object.props.priority,
+                url_object.get_mirrors(),
+                url_object.stall_policy,
+                url_object.get_checksum(),
+                url_object.get_extract_format(),
+                url_object.shared_cache,
+                url_object.storage,
+            )
+        )
+
+    def _send_command(self, url_object: URLObject, command: int):
+        with self._lock:
+            if (index := self._row_by_url.get(url_object)) is not None:
+                self._rows[index][COMMAND] = command
+
+    def pause(self, url_object: URLObject):
+        self._send_command(url_object, COMMAND_PAUSE)
+
+    def resume(self, url_object: URLObject):
+        self._send_command(url_object, COMMAND_RESUME)
+
+    def cancel(self, url_object: URLObject):
+        self._send_command(url_object, COMMAND_CANCEL)
+
+    def _poll_cb(self):
+        with self._lock:
+            assigned = list(self._assigned.items())
+        for index, (job_id, url_object) in assigned:
+            row = self._rows[index]
+            if row[JOB_ID] != job_id:
+                continue
+            url_object._set_remote_progress(row[BYTES_WRITTEN], row[FILESIZE])
+            if row[STATE] != STATE_IDLE:
+                url_object._set_remote_paused(row[STATE] == STATE_PAUSED)
+
+        while True:
+            try:
+                (
+                    job_id,
+                    bytes_written,
+                    filesize,
+                    error_class,
+                    error_message,
+                ) = self._result_queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                index = next(
+                    index
+                    for index, (_job_id, _) in self._assigned.items()
+                    if _job_id == job_id
+                )
+                _, url_object = self._assigned.pop(index)
+                del self._row_by_url[url_object]
+                self._rows[index][JOB_ID] = -1
+            url_object._set_remote_progress(bytes_written, filesize)
+            url_object._set_remote_finished(error_class, error_message)
+
+        return GLib.SOURCE_CONTINUE
@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+import sqlite3
+from threading import Thread
+import urllib.request
+
+import pytest
+
+from rfi_downloader.utils.leases import (
+    LeaseCoordinator,
+    STATE_DONE,
+    STATE_LEASED,
+    default_node_id,
+)
+from rfi_downloader.utils.readyqueue import (
+    JobRanks,
+    ORDERING_HOST_ROUND_ROBIN,
+    ORDERING_SMALLEST_FIRST,
+)
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(_QuietHandler, directory=str(source))
+    )
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield source, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def _node(db, destination, node_id, urls):
+    # what a DownloadManager does with its coordinator, without the GUI
+    coordinator = LeaseCoordinator(db, node_id=node_id, lease_duration=30)
+    coordinator.add_jobs((url, 0, rank) for rank, url in enumerate(urls))
+    while claimed := coordinator.claim(2):
+        for url in claimed:
+            with urllib.request.urlopen(url) as response:
+                data = response.read()
+            (destination / url.rsplit("/", 1)[-1]).write_bytes(data)
+            coordinator.complete(url)
+    coordinator.close()
+
+
+def test_nodes_share_the_work(tmp_path, http_server):
+    source, base_url = http_server
+    destination = tmp_path / "destination"
+    destination.mkdir()
+    urls = []
+    for i in range(40):
+        (source / f"file{i}").write_bytes(f"content of file {i}".encode())
+        urls.append(f"{base_url}/file{i}")
+    db = tmp_path / "jobs.db"
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_node, args=(db, destination, f"node{i}", urls))
+        for i in range(3)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    for i in range(40):
+        assert (destination / f"file{i}").read_bytes() == (
+            source / f"file{i}"
+        ).read_bytes()
+    with sqlite3.connect(str(db)) as connection:
+        rows = connection.execute("SELECT state, attempts FROM jobs").fetchall()
+    # every file was downloaded exactly once
+    assert rows == [(STATE_DONE, 1)] * 40
+
+
+def test_claims_follow_priority_and_rank(tmp_path):
+    coordinator = LeaseCoordinator(tmp_path / "jobs.db", node_id="a")
+    ranks = JobRanks(ORDERING_SMALLEST_FIRST)
+    coordinator.add_jobs(
+        (url, 0, ranks.rank(size))
+        for url, size in (("big", 300), ("unknown", -1), ("small", 1))
+    )
+    coordinator.add_jobs([("urgent", 0, None)])
+    coordinator.set_priority("urgent", 10)
+    assert coordinator.claim(4) == ["urgent", "small", "big", "unknown"]
+
+
+def test_host_round_robin_ranks():
+    ranks = JobRanks(ORDERING_HOST_ROUND_ROBIN)
+    assert [ranks.rank(host=host) for host in "aaab"] == [0, 1, 2, 0]
+
+
+def test_rerun_with_the_same_node_id(tmp_path):
+    db = tmp_path / "jobs.db"
+    first = LeaseCoordinator(db, node_id="node")
+    first.add_jobs([("done", 0, 0), ("crashed", 0, 1)])
+    assert first.claim(2) == ["done", "crashed"]
+    first.complete("done")
+    # the first run dies here, without releasing its lease on crashed
+    first.close()
+
+    second = LeaseCoordinator(db, node_id="node")
+    assert [url for url, *_ in second.finished_elsewhere()] == ["done"]
+    assert second.claim(2) == ["crashed"]
+    second.complete("crashed")
+    # what it finished itself is not reported back to it
+    assert second.finished_elsewhere() == []
+
+
+def test_released_jobs_are_not_claimed_again_straight_away(tmp_path):
+    db = tmp_path / "jobs.db"
+    a = LeaseCoordinator(db, node_id="a")
+    b = LeaseCoordinator(db, node_id="b")
+    a.add_jobs([("first", 0, 0), ("second", 0, 1)])
+    assert a.claim(1) == ["first"]
+    a.release("first", delay=60)
+    assert a.claim(1) == ["second"]
+    assert b.claim(1) == ["first"]
+
+
+def test_skip_leaves_jobs_of_other_nodes_alone(tmp_path):
+    db = tmp_path / "jobs.db"
+    a = LeaseCoordinator(db, node_id="a")
+    b = LeaseCoordinator(db, node_id="b")
+    a.add_jobs([("cancelled", 0, 0), ("elsewhere", 0, 1)])
+    assert b.claim(1) == ["cancelled"]
+    assert a.claim(1) == ["elsewhere"]
+    b.skip("elsewhere", "Cancelled before it started")
+    a.skip("elsewhere")
+    with sqlite3.connect(str(db)) as connection:
+        rows = dict(connection.execute("SELECT url, state FROM jobs"))
+    assert rows == {"cancelled": STATE_LEASED, "elsewhere": STATE_DONE}
+
+
+def test_default_node_ids_are_unique():
+    assert default_node_id() != default_node_id()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from rfi_downloader.utils.s3 import MINIMUM_PART_SIZE, MultipartUpload
+
+BUCKET = "bkt"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        yield executor
+
+
+def _read(client, key: str) -> bytes:
+    return client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def _pending_uploads(client) -> list:
+    return client.list_multipart_uploads(Bucket=BUCKET).get("Uploads", [])
+
+
+def test_multipart_upload(client, executor):
+    upload = MultipartUpload(
+        client,
+        BUCKET,
+        "big",
+        executor,
+        part_size=MINIMUM_PART_SIZE,
+        max_pending=1,
+    )
+    data = bytes(range(256)) * (MINIMUM_PART_SIZE * 5 // 2 // 256)
+    # in blocks that do not line up with the parts
+    for offset in range(0, len(data), 1024**2 + 1):
+        upload.write(data[offset : offset + 1024**2 + 1])
+    assert upload.size == len(data)
+    upload.complete()
+
+    assert _read(client, "big") == data
+    head = client.head_object(Bucket=BUCKET, Key="big")
+    # three parts: two full ones and the rest
+    assert head["ETag"].endswith('-3"')
+    assert _pending_uploads(client) == []
+
+
+def test_small_objects_are_put_in_one_request(client, executor):
+    upload = MultipartUpload(client, BUCKET, "small", executor)
+    upload.write(b"hello ")
+    upload.write(b"world")
+    upload.complete()
+
+    assert _read(client, "small") == b"hello world"
+    assert "-" not in client.head_object(Bucket=BUCKET, Key="small")["ETag"]
+
+
+def test_abort_and_rewrite(client, executor):
+    upload = MultipartUpload(
+        client, BUCKET, "rewritten", executor, part_size=MINIMUM_PART_SIZE
+    )
+    upload.write(b"x" * (MINIMUM_PART_SIZE + 1))
+    assert len(_pending_uploads(client)) == 1
+    # the server ignored the Range header: start over
+    upload.abort()
+    assert upload.size == 0
+    assert _pending_uploads(client) == []
+
+    data = b"y" * (MINIMUM_PART_SIZE + 2)
+    upload.write(data)
+    upload.complete()
+    assert _read(client, "rewritten") == data
+    assert _pending_uploads(client) == []
+
+
+def test_s3_storage_location():
+    pytest.importorskip("gi")
+    from rfi_downloader.storage import S3Storage
+
+    storage = S3Storage("s3://bkt/some/prefix/")
+    assert (
+        storage.location("/ignored", "dir\\file.txt")
+        == "s3://bkt/some/prefix/dir/file.txt"
+    )
+    assert S3Storage("s3://bkt").location("/ignored", "f") == "s3://bkt/f"